@@ -4,9 +4,8 @@ from datetime import datetime
 
 from banzai.stages import Stage
 from banzai import dbs, logs
-from banzai.utils import qc, import_utils, stage_utils, file_utils
-from banzai.data import stack
-from banzai.utils.image_utils import Section
+from banzai.utils import qc, import_utils, stage_utils, file_utils, cache_utils
+from banzai.data import stack, DEFAULT_STACK_TILE_BYTES
 
 logger = logging.getLogger('banzai')
 
@@ -63,34 +62,10 @@ class CalibrationStacker(CalibrationMaker):
         master_image = master_frame_class.init_master_frame(images, master_calibration_filename,
                                                             grouping_criteria=grouping, hdu_order=hdu_order)
 
-        # turn off memory mapping for each segment
-        for image in images:
-            image.primary_hdu.memmap = False
-        # Split the image into N sections where N is the number of images
-        # This is just for convenience. Technically N can be anything you want.
-        # I assume that you can read a couple of images into memory so order N sections is good for memory management.
-        N = len(images)
-        # Split along the x-direction because the median utils functions are parallelized along the y-direction
-        # detector section (y_stop - y_start) // binning(y) // N, abs(x_stop - x_start) // binning(x)
-        x_step = images[0].shape[1] // N
-        for i in range(N + 1):
-            x_start = 1 + i * x_step
-            if i == N:
-                # If the image divided evenly just move on.
-                if images[0].shape[1] % N == 0:
-                    break
-                # Otherwise, don't forget to do the last %mod sized section
-                x_stop = images[0].shape[1]
-            else:
-                x_stop = (i + 1) * x_step
-
-            section_to_stack = Section(x_start=x_start, x_stop=x_stop,
-                                       y_start=1, y_stop=images[0].data.shape[0])
-
-            data_to_stack = [image.primary_hdu[section_to_stack] for image in images]
-            stacked_data = stack(data_to_stack, 3.0)
-
-            master_image.primary_hdu.copy_in(stacked_data)
+        max_tile_bytes = getattr(self.runtime_context, 'CALIBRATION_STACK_TILE_BYTES', DEFAULT_STACK_TILE_BYTES)
+        n_workers = getattr(self.runtime_context, 'CALIBRATION_STACK_WORKERS', 1)
+        stack([image.primary_hdu for image in images], 3.0, output=master_image.primary_hdu,
+              max_tile_bytes=max_tile_bytes, n_workers=n_workers)
 
         logger.info('Created master calibration stack', image=master_image,
                     extra_tags={'calibration_type': self.calibration_type})
@@ -122,13 +97,30 @@ class CalibrationUser(Stage):
         if master_calibration_file_info is None:
             return self.on_missing_master_calibration(image)
 
-        frame_factory = import_utils.import_attribute(self.runtime_context.FRAME_FACTORY)()
-        master_calibration_image = frame_factory.open(master_calibration_file_info, self.runtime_context)
-        master_calibration_image.is_master = True
+        master_calibration_image = self.open_master_calibration(master_calibration_file_info)
         logger.info('Applying master calibration', image=image,
                     extra_tags={'master_calibration':  master_calibration_image.filename})
         return self.apply_master_calibration(image, master_calibration_image)
 
+    def open_master_calibration(self, file_info):
+        """
+        Open a master calibration frame, reusing a copy that this process has already opened if we can.
+        Cached frames are shared between science frames, so apply_master_calibration must not modify them.
+        """
+        master_calibration_cache = cache_utils.get_master_calibration_cache(self.runtime_context)
+        cache_key = cache_utils.master_calibration_key(file_info)
+        if cache_key is not None:
+            master_calibration_image = master_calibration_cache.get(cache_key)
+            if master_calibration_image is not None:
+                return master_calibration_image
+
+        frame_factory = import_utils.import_attribute(self.runtime_context.FRAME_FACTORY)()
+        master_calibration_image = frame_factory.open(file_info, self.runtime_context)
+        master_calibration_image.is_master = True
+        if cache_key is not None:
+            master_calibration_cache.add(cache_key, master_calibration_image)
+        return master_calibration_image
+
     @abc.abstractmethod
     def apply_master_calibration(self, image, master_calibration_image):
         pass
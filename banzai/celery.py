@@ -6,8 +6,8 @@ from dateutil.parser import parse
 from celery import Celery
 
 from banzai import dbs, calibrations, logs
-from banzai.utils import date_utils, realtime_utils, stage_utils
-from celery.signals import setup_logging, worker_process_init
+from banzai.utils import date_utils, realtime_utils, stage_utils, memory_utils, qc
+from celery.signals import setup_logging, worker_process_init, worker_process_shutdown
 from banzai.context import Context
 from banzai.utils.observation_utils import filter_calibration_blocks_for_type, get_calibration_blocks_for_time_range
 from banzai.utils.date_utils import get_stacking_date_range
@@ -33,6 +33,23 @@ def configure_workers(**kwargs):
     reload(metric_wrappers)
 
 
+@worker_process_shutdown.connect
+def close_worker_memory_arena(**kwargs):
+    logger.info('Closing memory arena', extra_tags=memory_utils.get_arena().stats())
+    memory_utils.close_arena()
+
+
+@worker_process_shutdown.connect
+def flush_worker_qc_results(**kwargs):
+    qc.close_qc_shipper()
+
+
+@worker_process_shutdown.connect
+def close_worker_database_connections(**kwargs):
+    logger.info('Closing database connections', extra_tags=dbs.get_query_stats())
+    dbs.dispose_engines()
+
+
 app = Celery('banzai')
 app.config_from_object('banzai.celeryconfig')
 app.conf.update(broker_url=os.getenv('TASK_HOST', 'redis://localhost:6379/0'))
@@ -173,6 +190,45 @@ def process_image(file_info: dict, runtime_context: dict):
             realtime_utils.increment_try_number(filename, db_address=runtime_context.db_address)
             stage_utils.run_pipeline_stages([file_info], runtime_context)
             realtime_utils.set_file_as_processed(filename, db_address=runtime_context.db_address)
+            logger.debug('Memory arena usage', extra_tags=memory_utils.get_arena().stats())
+            logger.debug('Database usage', extra_tags=dbs.get_query_stats())
     except Exception:
         logger.error("Exception processing frame: {error}".format(error=logs.format_exception()),
                      extra_tags={'file_info': file_info})
+
+
+@app.task(name='celery.process_image_batch')
+def process_image_batch(file_infos: list, runtime_context: dict):
+    """
+    Reduce a batch of frames (usually from the same instrument and configuration) together so that they share
+    master calibrations and the setup of the stages
+
+    :param file_infos: Bodies of queue messages: list of dicts
+    :param runtime_context: Context object with runtime environment info
+    """
+    runtime_context = Context(runtime_context)
+    files_to_process = []
+    for file_info in file_infos:
+        try:
+            if realtime_utils.need_to_process_image(file_info, runtime_context):
+                if 'path' in file_info:
+                    filename = os.path.basename(file_info['path'])
+                else:
+                    filename = file_info.get('filename')
+                files_to_process.append((filename, file_info))
+        except Exception:
+            logger.error("Exception checking frame: {error}".format(error=logs.format_exception()),
+                         extra_tags={'file_info': file_info})
+    if len(files_to_process) == 0:
+        return
+    filenames = [filename for filename, _ in files_to_process]
+    logger.info('Reducing batch of frames', extra_tags={'filenames': filenames})
+    try:
+        realtime_utils.increment_try_numbers(filenames, db_address=runtime_context.db_address)
+        stage_utils.run_pipeline_stages([file_info for _, file_info in files_to_process], runtime_context)
+        realtime_utils.set_files_as_processed(filenames, db_address=runtime_context.db_address)
+        logger.debug('Memory arena usage', extra_tags=memory_utils.get_arena().stats())
+        logger.debug('Database usage', extra_tags=dbs.get_query_stats())
+    except Exception:
+        logger.error("Exception processing batch of frames: {error}".format(error=logs.format_exception()),
+                     extra_tags={'file_infos': file_infos})
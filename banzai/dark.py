@@ -40,8 +40,8 @@ class DarkSubtractor(CalibrationUser):
         return 'dark'
 
     def apply_master_calibration(self, image, master_calibration_image):
-        master_calibration_image *= image.exptime
-        image -= master_calibration_image
+        # Scale a copy of the master so that the (possibly cached) master itself is not changed
+        image -= master_calibration_image.primary_hdu * image.exptime
         image.meta['L1IDDARK'] = master_calibration_image.filename, 'ID of dark frame'
         image.meta['L1STATDA'] = 1, 'Status flag for dark frame correction'
         return image
@@ -1,5 +1,7 @@
 import abc
-import tempfile
+import collections
+import logging
+import multiprocessing
 from typing import Union, Type
 
 import numpy as np
@@ -7,12 +9,12 @@ from astropy.io import fits
 from astropy.table import Table
 
 from banzai.utils.image_utils import Section
-from banzai.utils import fits_utils, stats
+from banzai.utils import fits_utils, memory_utils, median_utils
 
+logger = logging.getLogger('banzai')
 
-class Data(metaclass=abc.ABCMeta):
-    _file_handles = []
 
+class Data(metaclass=abc.ABCMeta):
     def __init__(self, data: Union[np.array, Table], meta: Union[dict, fits.Header],
                  mask: np.array = None, name: str = '', memmap=True):
         self.memmap = memmap
@@ -33,27 +35,27 @@ class Data(metaclass=abc.ABCMeta):
     def _init_array(self, array: np.array = None, dtype: Type = None):
         if not self.memmap:
             return array
-        file_handle = tempfile.NamedTemporaryFile('w+b')
         if array is None:
-            shape = self.data.shape
             if dtype is None:
                 dtype = self.data.dtype
-            array = np.zeros(shape, dtype=dtype)
-        if array.size > 0:
-            memory_mapped_array = np.memmap(file_handle, shape=array.shape, dtype=array.dtype, mode='readwrite')
-            memory_mapped_array.ravel()[:] = array.ravel()[:]
-            self._file_handles.append(file_handle)
+            if self.data.size == 0:
+                return np.zeros(self.data.shape, dtype=dtype)
+            memory_mapped_array = memory_utils.get_arena().allocate(self.data.shape, dtype)
+            memory_mapped_array.fill(0)
+        elif array.size > 0:
+            memory_mapped_array = memory_utils.get_arena().allocate(array.shape, array.dtype)
+            np.copyto(memory_mapped_array, array)
         else:
             memory_mapped_array = array
         return memory_mapped_array
 
     def add_mask(self, mask: np.array):
         self._validate_mask(mask)
-        self.mask = self._init_array(mask)
+        # Masks usually come from a (possibly cached and read-only) master calibration, so always take our own copy
+        self.mask = self._init_array(mask) if self.memmap else np.array(mask)
 
     def __del__(self):
-        for handle in self._file_handles:
-            handle.close()
+        # Dropping our references hands the arena slots back to the pool once any views are gone too
         del self.data
         del self.mask
 
@@ -115,37 +117,97 @@ class ArrayData(Data):
 
 
 class CCDData(Data):
+    # True if our arrays are read-only views into another CCDData object's buffers (see trim)
+    _shares_buffers = False
+    # Per-pixel uncertainties. Until a stage needs them, they are held as a single constant value.
+    _uncertainty = None
+    _constant_uncertainty = None
+
     def __init__(self, data: Union[np.array, Table], meta: fits.Header,
                  mask: np.array = None, name: str = '', uncertainty: np.array = None, memmap=True):
         super().__init__(data=data, meta=meta, mask=mask, name=name, memmap=memmap)
         if uncertainty is None:
-            uncertainty = self.read_noise * np.ones(data.shape, dtype=data.dtype) / self.gain
-        self.uncertainty = self._init_array(uncertainty)
+            # Don't allocate a full array of read noise until somebody asks for it
+            self._constant_uncertainty = self.read_noise / self.gain
+        else:
+            self.uncertainty = self._init_array(uncertainty)
         self._detector_section = Section.parse_region_keyword(self.meta.get('DETSEC'))
         self._data_section = Section.parse_region_keyword(self.meta.get('DATASEC'))
         self._background = None
 
     def __getitem__(self, section):
         """
-        Return a new CCDData object with the given section of data
+        Return a new CCDData object with the given section of data. The new object shares our buffers
+        until it is written to.
         :param section: needs to be  in data coords
         :return:
         """
-        return self.trim(trim_section=section)
+        return self.trim(trim_section=section, copy=False)
+
+    @property
+    def uncertainty(self):
+        if self._uncertainty is None and self._constant_uncertainty is not None:
+            dtype = np.result_type(self.data.dtype, 1.0)
+            if self.memmap:
+                uncertainty = self._init_array(dtype=dtype)
+                uncertainty.fill(self._constant_uncertainty)
+            else:
+                uncertainty = np.full(self.data.shape, self._constant_uncertainty, dtype=dtype)
+            self._uncertainty = uncertainty
+            self._constant_uncertainty = None
+        return self._uncertainty
+
+    @uncertainty.setter
+    def uncertainty(self, value):
+        self._uncertainty = value
+        self._constant_uncertainty = None
+
+    @property
+    def _uncertainty_values(self):
+        """The uncertainty array, or the constant uncertainty if it has not been made into an array yet.
+        Both broadcast against the data."""
+        if self._uncertainty is None:
+            return self._constant_uncertainty
+        return self._uncertainty
+
+    def _set_uncertainty_values(self, value):
+        if np.ndim(value) == 0:
+            self._uncertainty = None
+            self._constant_uncertainty = float(value)
+        else:
+            self.uncertainty = value
 
     def __imul__(self, value):
         # TODO: Handle the case where this is an array. Add SATURATE and GAIN handling when array.
+        self._own_buffers()
         self.data *= value
-        self.uncertainty *= value
+        if self._uncertainty is None and np.ndim(value) == 0:
+            self._constant_uncertainty *= value
+        else:
+            self.uncertainty *= value
         self.meta['SATURATE'] *= value
         self.meta['GAIN'] /= value
         self.meta['MAXLIN'] *= value
         return self
 
+    def __mul__(self, value):
+        uncertainty = self._uncertainty_values * value
+        product = type(self)(data=self.data * value, meta=self.meta, mask=self.mask, name=self.name,
+                             memmap=self.memmap)
+        product._set_uncertainty_values(uncertainty)
+        for keyword in ['SATURATE', 'MAXLIN']:
+            if keyword in product.meta:
+                product.meta[keyword] *= value
+        if 'GAIN' in product.meta:
+            product.meta['GAIN'] /= value
+        return product
+
     def __itruediv__(self, value):
+        self._own_buffers()
         if isinstance(value, CCDData):
             self.uncertainty = np.abs(self.data / value.data) * \
-                               np.sqrt((self.uncertainty / self.data) ** 2 + (value.uncertainty / value.data) ** 2)
+                               np.sqrt((self._uncertainty_values / self.data) ** 2 +
+                                       (value._uncertainty_values / value.data) ** 2)
             self.data /= value.data
             self.mask |= value.mask
         else:
@@ -163,24 +225,28 @@ class CCDData(Data):
 
     def __del__(self):
         super().__del__()
-        del self.uncertainty
+        self._uncertainty = None
 
     def __isub__(self, value):
+        self._own_buffers()
         if isinstance(value, CCDData):
             self.data -= value.data
-            self.uncertainty = np.sqrt(value.uncertainty * value.uncertainty + self.uncertainty * self.uncertainty)
+            self._set_uncertainty_values(np.sqrt(value._uncertainty_values * value._uncertainty_values +
+                                                 self._uncertainty_values * self._uncertainty_values))
             self.mask |= value.mask
         else:
             self.data -= value
         return self
 
     def __sub__(self, other):
-        uncertainty = np.sqrt(self.uncertainty * self.uncertainty + other.uncertainty * other.uncertainty)
-        return type(self)(data=self.data - other.data, meta=self.meta, mask=self.mask|other.mask,
-                          uncertainty=uncertainty)
+        uncertainty = np.sqrt(self._uncertainty_values * self._uncertainty_values +
+                              other._uncertainty_values * other._uncertainty_values)
+        difference = type(self)(data=self.data - other.data, meta=self.meta, mask=self.mask|other.mask)
+        difference._set_uncertainty_values(uncertainty)
+        return difference
 
     def signal_to_noise(self):
-        return np.abs(self.data) / self.uncertainty
+        return np.abs(self.data) / self._uncertainty_values
 
     def get_overscan_region(self):
         return Section.parse_region_keyword(self.meta.get('BIASSEC', 'N/A'))
@@ -205,17 +271,28 @@ class CCDData(Data):
         inner_ny = round(self.data.shape[0] * inner_edge_width)
         return self.data[inner_ny: -inner_ny, inner_nx: -inner_nx]
 
-    def trim(self, trim_section=None):
+    def trim(self, trim_section=None, copy=True):
         """
         :param trim_section: Always in data coords
+        :param copy: If False, the trimmed object is a view that shares our buffers. The shared arrays are
+                     read-only and are only copied when the trimmed object is modified.
         :return:
         """
         if trim_section is None:
             trim_section = Section.parse_region_keyword(self.meta.get('TRIMSEC', 'N/A'))
 
+        if self._uncertainty is None:
+            uncertainty = None
+        else:
+            uncertainty = self._uncertainty[trim_section.to_slice()]
         trimmed_image = type(self)(data=self.data[trim_section.to_slice()], meta=self.meta,
                                    mask=self.mask[trim_section.to_slice()], name=self.name,
-                                   uncertainty=self.uncertainty[trim_section.to_slice()], memmap=self.memmap)
+                                   uncertainty=uncertainty, memmap=self.memmap and copy)
+        if uncertainty is None:
+            trimmed_image._constant_uncertainty = self._constant_uncertainty
+        if not copy:
+            trimmed_image.memmap = self.memmap
+            trimmed_image._share_buffers()
         trimmed_image.detector_section = self.data_to_detector_section(trim_section)
         trimmed_image.data_section = Section(x_start=1, y_start=1,
                                              x_stop=trimmed_image.data.shape[1],
@@ -347,6 +424,53 @@ class CCDData(Data):
 
         return start, stop
 
+    def _buffer_names(self):
+        buffer_names = ['data', 'mask']
+        if self._uncertainty is not None:
+            buffer_names.append('_uncertainty')
+        return buffer_names
+
+    def _share_buffers(self):
+        for array_name in self._buffer_names():
+            getattr(self, array_name).flags.writeable = False
+        self._shares_buffers = True
+
+    def _own_buffers(self):
+        """
+        Copy any arrays that are shared with a parent object (see trim) so that we can write to them
+        """
+        if not self._shares_buffers:
+            return
+        for array_name in self._buffer_names():
+            array = getattr(self, array_name)
+            if not array.flags.writeable:
+                setattr(self, array_name, self._init_array(array) if self.memmap else array.copy())
+        self._shares_buffers = False
+
+    def detach(self):
+        """
+        Take ownership of any buffers shared with a parent object without copying them.
+
+        Only use this when the parent object is being thrown away (e.g. when an image is replaced by its
+        trimmed version). Writing to this object afterwards writes directly into the parent's buffers.
+        """
+        if not self._shares_buffers:
+            return
+        made_writeable = []
+        try:
+            for array_name in self._buffer_names():
+                array = getattr(self, array_name)
+                array.flags.writeable = True
+                made_writeable.append(array)
+        except ValueError:
+            # Part of the parent is itself read-only (e.g. a cached master) so we have to copy all of the buffers,
+            # not just that one, or writes to the others would still go into the parent
+            for array in made_writeable:
+                array.flags.writeable = False
+            self._own_buffers()
+            return
+        self._shares_buffers = False
+
     def copy_in(self, data):
         """
         Copy in the data from another CCDData object based on the detector sections
@@ -354,16 +478,21 @@ class CCDData(Data):
         :param data_to_copy:
         :return:
         """
+        self._own_buffers()
         overlap_section = self.get_overlap(data.detector_section)
-        data_to_copy = data.trim(trim_section=data.detector_to_data_section(overlap_section))
+        data_to_copy = data.trim(trim_section=data.detector_to_data_section(overlap_section), copy=False)
         data_to_copy = data_to_copy.rebin(self.binning)
-        for array_name_to_copy in ['data', 'mask', 'uncertainty']:
+        my_overlap = self.detector_to_data_section(overlap_section).to_slice()
+        for array_name_to_copy in ['data', 'mask']:
             array_to_copy = getattr(data_to_copy, array_name_to_copy)
-            my_overlap = self.detector_to_data_section(overlap_section).to_slice()
             getattr(self, array_name_to_copy)[my_overlap][:] = array_to_copy[:]
+        # A constant uncertainty is broadcast into the overlap region
+        self.uncertainty[my_overlap][:] = data_to_copy._uncertainty_values
 
     def init_poisson_uncertainties(self):
-        self.uncertainty = np.sqrt(self.uncertainty ** 2.0 + np.abs(self.data))
+        # The Poisson term varies per pixel so this is where the uncertainty becomes a full array
+        uncertainty = np.sqrt(self._uncertainty_values ** 2.0 + np.abs(self.data))
+        self.uncertainty = self._init_array(uncertainty) if self._uncertainty is None else uncertainty
 
     @property
     def background(self):
@@ -371,55 +500,157 @@ class CCDData(Data):
 
     @background.setter
     def background(self, value):
+        self._own_buffers()
         if self._background is not None:
             self.data += self._background
         self._background = value
         self.data -= self._background
 
 
-def stack(data_to_stack, nsigma_reject) -> CCDData:
-    """
-    """
-    shape3d = [len(data_to_stack)] + list(data_to_stack[0].shape)
-    a = np.zeros(shape3d, dtype=data_to_stack[0].dtype)
-    uncertainties = np.zeros(shape3d, dtype=data_to_stack[0].dtype)
-    mask = np.zeros(shape3d, dtype=np.uint8)
-
-    for i, data in enumerate(data_to_stack):
-        a[i, :, :] = data.data[:, :]
-        mask[i, :, :] = data.mask[:, :]
-        uncertainties[i, :, :] = data.uncertainty[:, :]
-
-    abs_deviation = stats.absolute_deviation(a, axis=0, mask=mask)
-
-    robust_std = stats.robust_standard_deviation(a, axis=0, abs_deviation=abs_deviation, mask=mask)
+# Default memory budget for the tile buffers used by stack
+DEFAULT_STACK_TILE_BYTES = 128 * 1024 * 1024
 
-    robust_std = np.expand_dims(robust_std, axis=0)
 
-    # Mask values that are N sigma from the median
-    sigma_mask = abs_deviation > (nsigma_reject * robust_std)
-
-    mask3d = np.logical_or(sigma_mask, mask > 0)
-    n_good_pixels = np.logical_not(mask3d).sum(axis=0)
-
-    stacked_mask = np.zeros(n_good_pixels.shape, dtype=np.uint8)
-
-    # If a pixel is bad in all images, make sure we don't divide by zero
-    bad_pixels = n_good_pixels == 0
-
-    # If pixel is bad in all of the images, we take the logical or of all of the bits to go in the final mask
-    stacked_mask[bad_pixels] = np.bitwise_or.reduce(mask, axis=0)[bad_pixels]
+def _stack_tile_shape(n_images, shape, bytes_per_pixel, max_tile_bytes):
+    """
+    Pick the largest tile of whole rows whose buffers (and temporary arrays) for all of the input images
+    fit in max_tile_bytes. If a single row does not fit, the row is split into columns.
+    """
+    ny, nx = shape
+    bytes_per_row = n_images * nx * bytes_per_pixel
+    if bytes_per_row <= max_tile_bytes:
+        return min(ny, max_tile_bytes // bytes_per_row), nx
+    return 1, max(1, min(nx, max_tile_bytes // (n_images * bytes_per_pixel)))
 
-    # If a pixel is bad in all images, fill that pixel with the mean from the images
-    n_good_pixels[bad_pixels] = len(data_to_stack)
-    mask3d[:, bad_pixels] = False
 
-    a[mask3d] = 0.0
-    stacked_data = a.sum(axis=0) / n_good_pixels
+def stack(data_to_stack, nsigma_reject, output=None, max_tile_bytes=DEFAULT_STACK_TILE_BYTES,
+          n_workers=1) -> CCDData:
+    """
+    Sigma clipped mean of a set of images, computed in tiles with a bounded amount of memory
+
+    Parameters
+    ----------
+    data_to_stack : list of CCDData objects
+                    Images to combine. They must all have the same shape.
+    nsigma_reject : float
+                    Pixels more than nsigma_reject robust standard deviations from the median are rejected
+    output : CCDData (default is None)
+             Object to write the stacked data, uncertainty, and mask into. If None, a new object is created.
+    max_tile_bytes : int
+                     Memory budget for the tile buffers. The buffers are allocated once and reused for every tile
+                     so peak memory does not depend on the number of images. The budget is shared between workers.
+    n_workers : int (default is 1)
+                Number of processes to stack tiles in. Each worker is sent a copy of the tile that it stacks.
+
+    Returns
+    -------
+    output : CCDData
+             The stacked image
+    """
+    shape = data_to_stack[0].shape
+    dtype = data_to_stack[0].dtype
+    for data in data_to_stack:
+        if data.shape != shape:
+            raise ValueError('All of the images to stack must have the same shape')
+
+    if output is None:
+        output = CCDData(data=np.zeros(shape, dtype=dtype), meta=data_to_stack[0].meta,
+                         uncertainty=np.zeros(shape, dtype=dtype), mask=np.zeros(shape, dtype=np.uint8))
+    elif output.shape != shape:
+        raise ValueError('The output of the stack must have the same shape as the input images')
+
+    n_workers = max(1, n_workers)
+    # float32 data and uncertainty buffers and the uint8 mask buffer
+    bytes_per_pixel = 9
+    tile_ny, tile_nx = _stack_tile_shape(len(data_to_stack), shape, bytes_per_pixel, max_tile_bytes // n_workers)
+    # Make sure there are enough tiles to keep all of the workers busy
+    tile_ny = min(tile_ny, -(-shape[0] // n_workers))
+
+    tiles = [(slice(y_start, min(y_start + tile_ny, shape[0])), slice(x_start, min(x_start + tile_nx, shape[1])))
+             for y_start in range(0, shape[0], tile_ny) for x_start in range(0, shape[1], tile_nx)]
+
+    tile_stacker = _TileStacker(data_to_stack, (len(data_to_stack), tile_ny, tile_nx), nsigma_reject)
+    output_uncertainty = output.uncertainty
+    for tile, (stacked_data, stacked_uncertainty, stacked_mask) in _map_tiles(tile_stacker, tiles, n_workers):
+        output.data[tile], output_uncertainty[tile], output.mask[tile] = stacked_data, stacked_uncertainty, stacked_mask
+    return output
+
+
+class _TileStacker:
+    """
+    Copies a tile of every input image into reusable buffers and stacks it
+    """
+    def __init__(self, data_to_stack, buffer_shape, nsigma_reject):
+        self.data_to_stack = data_to_stack
+        self.buffer_shape = buffer_shape
+        self.nsigma_reject = nsigma_reject
+        self.buffers = None
 
-    # Again if a pixel is bad in all images, fill the uncertainties with the quadrature sum / N images
-    uncertainties[mask3d] = 0.0
-    uncertainties *= uncertainties
-    stacked_uncertainty = np.sqrt(uncertainties.sum(axis=0) / (n_good_pixels ** 2.0))
+    def tile_arrays(self, tile, buffers=None):
+        """
+        Copy a tile of every input image into views of the buffers that match the tile (tiles at the edges can be
+        smaller), or into new arrays if buffers is None
+        """
+        y_slice, x_slice = tile
+        tile_shape = (len(self.data_to_stack), y_slice.stop - y_slice.start, x_slice.stop - x_slice.start)
+        if buffers is None:
+            a, uncertainties, mask = (np.empty(tile_shape, dtype=dtype) for dtype in [np.float32, np.float32, np.uint8])
+        else:
+            tile_size = int(np.prod(tile_shape))
+            a, uncertainties, mask = (buffer[:tile_size].reshape(tile_shape) for buffer in buffers)
+        for i, data in enumerate(self.data_to_stack):
+            a[i] = data.data[tile]
+            mask[i] = data.mask[tile]
+            uncertainty = data._uncertainty_values
+            uncertainties[i] = uncertainty[tile] if np.ndim(uncertainty) > 0 else uncertainty
+        return a, uncertainties, mask
+
+    def __call__(self, tile):
+        if self.buffers is None:
+            buffer_size = int(np.prod(self.buffer_shape))
+            self.buffers = (np.zeros(buffer_size, dtype=np.float32), np.zeros(buffer_size, dtype=np.float32),
+                            np.zeros(buffer_size, dtype=np.uint8))
+        a, uncertainties, mask = self.tile_arrays(tile, self.buffers)
+        stacked_data, stacked_uncertainty, stacked_mask, _, _, _ = median_utils.sigma_clipped_stack(
+            a, uncertainties, mask, self.nsigma_reject)
+        return tile, (stacked_data, stacked_uncertainty, stacked_mask)
+
+
+def _stack_tile_in_worker(tile, a, uncertainties, mask, nsigma_reject):
+    # The pool already keeps a core busy per worker, so each worker stacks in a single thread
+    stacked_data, stacked_uncertainty, stacked_mask, _, _, _ = median_utils.sigma_clipped_stack(
+        a, uncertainties, mask, nsigma_reject, num_threads=1)
+    return tile, (stacked_data, stacked_uncertainty, stacked_mask)
+
+
+def _map_tiles(tile_stacker, tiles, n_workers):
+    """
+    Run tile_stacker on every tile, in a pool of worker processes if n_workers > 1. Falls back to stacking
+    in this process if we cannot start a pool, e.g. inside a daemonic celery worker.
 
-    return CCDData(data=stacked_data, meta=data_to_stack[0].meta, uncertainty=stacked_uncertainty, mask=stacked_mask)
+    The pipeline runs other threads (prefetching, writing, and shipping QC results), so the workers are started
+    from a forkserver rather than forked from this process. Each worker is sent copies of the tile of the input
+    images that it stacks. Only n_workers tiles are in flight at a time to bound the memory used by the copies.
+    """
+    pool = None
+    if n_workers > 1 and len(tiles) > 1:
+        n_workers = min(n_workers, len(tiles))
+        try:
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload([__name__])
+            pool = context.Pool(n_workers)
+        except (AssertionError, OSError, ValueError) as e:
+            logger.warning(f'Could not start a pool of {n_workers} stacking workers, stacking in one process: {e}')
+    if pool is None:
+        for tile in tiles:
+            yield tile_stacker(tile)
+        return
+    with pool:
+        in_flight = collections.deque()
+        for tile in tiles:
+            in_flight.append(pool.apply_async(_stack_tile_in_worker,
+                                              (tile, *tile_stacker.tile_arrays(tile), tile_stacker.nsigma_reject)))
+            if len(in_flight) >= n_workers:
+                yield in_flight.popleft().get()
+        while in_flight:
+            yield in_flight.popleft().get()
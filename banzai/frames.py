@@ -1,14 +1,14 @@
 import logging
 from banzai import dbs
 from banzai.data import HeaderOnly, CCDData
-from banzai.utils import fits_utils, file_utils
+from banzai.utils import fits_utils, file_utils, upload_utils
 import numpy as np
 from astropy.io import fits
 import abc
 import os
-from io import BytesIO
+import tempfile
+import uuid
 from typing import Optional
-import hashlib
 
 logger = logging.getLogger('banzai')
 
@@ -154,31 +154,73 @@ class ObservationFrame(metaclass=abc.ABCMeta):
     def write(self, runtime_context):
         output_filename = self.get_output_filename(runtime_context)
         self.save_processing_metadata(runtime_context)
-        with BytesIO() as buffer:
-            self.to_fits(runtime_context).writeto(buffer, overwrite=True, output_verify='silentfix')
-            buffer.seek(0)
-            if runtime_context.post_to_archive:
-                archived_image_info = file_utils.post_to_ingester(buffer, self, output_filename)
-                # update file info from ingester response
-                self.frame_id = archived_image_info.get('frameid')
-                buffer.seek(0)
-            if not runtime_context.no_file_cache:
-                os.makedirs(os.path.dirname(output_filename), exist_ok=True)
-                with open(output_filename, 'wb') as f:
-                    f.write(buffer.read())
-                buffer.seek(0)
-            md5 = hashlib.md5(buffer.read()).hexdigest()
-
-        dbs.save_processed_image(output_filename, md5, db_address=runtime_context.db_address)
-
-    def to_fits(self, context):
+        # The frame is serialized once, straight into the output file (or a temporary file if we are not keeping
+        # a copy), and its md5 is computed on the way. The archive upload reads back from the same file.
+        upload_spool = upload_utils.get_upload_spool(runtime_context) if runtime_context.post_to_archive else None
+        if runtime_context.no_file_cache:
+            # The frame only needs to be on disk until it is posted. The upload spool links to it, so it has to be
+            # on the same file system.
+            output_file = tempfile.NamedTemporaryFile(dir=None if upload_spool is None else upload_spool.directory,
+                                                      prefix='.')
+            temporary_filename = output_file.name
+        else:
+            os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+            # Write to a hidden file and move it into place so nobody sees a partially written frame
+            temporary_filename = os.path.join(os.path.dirname(output_filename),
+                                              f'.{os.path.basename(output_filename)}.{uuid.uuid4().hex}')
+            output_file = open(temporary_filename, 'x+b')
+        try:
+            with output_file:
+                hashing_writer = file_utils.HashingWriter(output_file)
+                write_stats = fits_utils.write_fits(self.to_fits(runtime_context, convert_datatypes=False),
+                                                    hashing_writer,
+                                                    n_workers=getattr(runtime_context, 'FPACK_WORKERS', 1),
+                                                    extension_datatypes=runtime_context.REDUCED_DATA_EXTENSION_TYPES)
+                output_file.flush()
+                if runtime_context.fpack:
+                    logger.info('Compressed frame', image=self, extra_tags=write_stats)
+                if runtime_context.post_to_archive and upload_spool is None:
+                    archived_image_info = file_utils.post_to_ingester(
+                        output_file, self, output_filename,
+                        max_tries=getattr(runtime_context, 'UPLOAD_MAX_TRIES', 5),
+                        backoff_base=getattr(runtime_context, 'UPLOAD_BACKOFF_BASE', 5.0),
+                        backoff_max=getattr(runtime_context, 'UPLOAD_BACKOFF_MAX', 600.0))
+                    # update file info from ingester response
+                    self.frame_id = archived_image_info.get('frameid')
+                if not runtime_context.no_file_cache:
+                    os.replace(temporary_filename, output_filename)
+                if upload_spool is not None:
+                    # The uploader saves the frame id once the frame is in the archive
+                    upload_spool.add(temporary_filename if runtime_context.no_file_cache else output_filename,
+                                     output_filename, calibration=isinstance(self, CalibrationFrame))
+        except BaseException:
+            if not runtime_context.no_file_cache and os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+            raise
+
+        dbs.save_processed_image(output_filename, hashing_writer.hexdigest(), db_address=runtime_context.db_address)
+
+    def to_fits(self, context, convert_datatypes=True):
+        """
+        Make the HDUList to write out
+
+        Parameters
+        ----------
+        context : banzai.context.Context
+                  Context object with runtime environment info
+        convert_datatypes : bool
+                            Convert the extensions to REDUCED_DATA_EXTENSION_TYPES. Uncompressed extensions can be
+                            left in their current types for fits_utils.write_fits to convert as it writes them.
+                            Extensions are always converted before they are compressed.
+        """
         hdu_list_to_write = fits.HDUList([])
         for hdu in self._hdus:
             hdu_list_to_write += hdu.to_fits(context)
         fits_utils.reorder_hdus(hdu_list_to_write, self.hdu_order)
         if not isinstance(hdu_list_to_write[0], fits.PrimaryHDU):
             hdu_list_to_write[0] = fits.PrimaryHDU(data=hdu_list_to_write[0].data, header=hdu_list_to_write[0].header)
-        fits_utils.convert_extension_datatypes(hdu_list_to_write, context.REDUCED_DATA_EXTENSION_TYPES)
+        if convert_datatypes or context.fpack:
+            fits_utils.convert_extension_datatypes(hdu_list_to_write, context.REDUCED_DATA_EXTENSION_TYPES)
         if context.fpack:
             hdu_list_to_write = fits_utils.pack(hdu_list_to_write)
         return hdu_list_to_write
@@ -9,6 +9,8 @@ October 2015
 """
 import argparse
 import logging
+import os
+import time
 
 from kombu import Exchange, Connection, Queue
 from kombu.mixins import ConsumerMixin
@@ -17,8 +19,9 @@ from types import ModuleType
 
 from banzai import settings, dbs, logs, calibrations
 from banzai.context import Context
-from banzai.utils import date_utils, stage_utils, import_utils, image_utils, fits_utils, file_utils
-from banzai.celery import process_image, app, schedule_calibration_stacking
+from banzai.utils import date_utils, stage_utils, import_utils, fits_utils, file_utils, reprocessing_utils
+from banzai.utils import realtime_utils, upload_utils
+from banzai.celery import process_image, process_image_batch, app, schedule_calibration_stacking
 from celery.schedules import crontab
 import celery
 import celery.bin.beat
@@ -28,9 +31,22 @@ logger = logging.getLogger('banzai')
 
 
 class RealtimeModeListener(ConsumerMixin):
+    """
+    Send frames from the fits queue to the workers.
+
+    If the batch size is more than one, messages are grouped by instrument and configuration (see
+    REALTIME_BATCH_GROUPING) and each group is sent as a single task once it has batch_size frames or its
+    oldest frame has waited batch_timeout seconds.
+    """
     def __init__(self, runtime_context):
         self.runtime_context = runtime_context
         self.broker_url = runtime_context.broker_url
+        self.batch_size = max(1, getattr(runtime_context, 'batch_size', 1))
+        self.batch_timeout = getattr(runtime_context, 'batch_timeout', 5.0)
+        self.batch_grouping = getattr(runtime_context, 'REALTIME_BATCH_GROUPING', [])
+        # Batches of (message body, message) pairs that have not been sent yet, keyed by group,
+        # along with when the first message in the batch arrived
+        self.batches = {}
 
     def on_connection_error(self, exc, interval):
         logger.error("{0}. Retrying connection in {1} seconds...".format(exc, interval))
@@ -39,13 +55,35 @@ class RealtimeModeListener(ConsumerMixin):
 
     def get_consumers(self, Consumer, channel):
         consumer = Consumer(queues=[self.queue], callbacks=[self.on_message])
-        # Only fetch one thing off the queue at a time
-        consumer.qos(prefetch_count=1)
+        # Only fetch one batch worth of messages off the queue at a time
+        consumer.qos(prefetch_count=self.batch_size)
         return [consumer]
 
     def on_message(self, body, message):
-        process_image.apply_async(args=(body, vars(self.runtime_context)))
-        message.ack()  # acknowledge to the sender we got this message (it can be popped)
+        if self.batch_size == 1:
+            process_image.apply_async(args=(body, vars(self.runtime_context)))
+            message.ack()  # acknowledge to the sender we got this message (it can be popped)
+            return
+        batch_key = tuple(body.get(keyword) for keyword in self.batch_grouping)
+        if batch_key not in self.batches:
+            self.batches[batch_key] = time.monotonic(), []
+        self.batches[batch_key][1].append((body, message))
+        if len(self.batches[batch_key][1]) >= self.batch_size:
+            self.send_batch(batch_key)
+
+    def on_iteration(self):
+        # Called by the consumer loop at least once a second, even if no messages arrive
+        now = time.monotonic()
+        for batch_key, (batch_start, _) in list(self.batches.items()):
+            if now - batch_start >= self.batch_timeout:
+                self.send_batch(batch_key)
+
+    def send_batch(self, batch_key):
+        _, batch = self.batches.pop(batch_key)
+        process_image_batch.apply_async(args=([body for body, _ in batch], vars(self.runtime_context)))
+        # Only acknowledge the messages once the batch has been handed off so they are redelivered if we die
+        for _, message in batch:
+            message.ack()
 
 
 def add_settings_to_context(args, settings):
@@ -122,7 +160,8 @@ def reduce_single_frame():
                                 'kwargs': {'dest': 'path', 'help': 'Full path to the file to process'}}]
     runtime_context = parse_args(settings, extra_console_arguments=extra_console_arguments)
     # Short circuit
-    if not image_utils.image_can_be_processed(fits_utils.get_primary_header(runtime_context.path), runtime_context):
+    if not realtime_utils.header_can_be_processed(fits_utils.get_primary_header(runtime_context.path),
+                                                  os.path.basename(runtime_context.path), runtime_context):
         logger.error('Image cannot be processed. Check to make sure the instrument '
                      'is in the database and that the OBSTYPE is recognized by BANZAI',
                      extra_tags={'filename': runtime_context.path})
@@ -133,6 +172,44 @@ def reduce_single_frame():
         logger.error(logs.format_exception(), extra_tags={'filepath': runtime_context.path})
 
 
+def reduce_directory():
+    extra_console_arguments = [{'args': ['--directory'],
+                                'kwargs': {'dest': 'directory', 'help': 'Directory with the frames to reduce'}},
+                               {'args': ['--glob'],
+                                'kwargs': {'dest': 'glob', 'help': 'Glob pattern that matches the frames to reduce. '
+                                                                   'Use ** to match any number of subdirectories.'}},
+                               {'args': ['--n-processes'],
+                                'kwargs': {'dest': 'n_processes', 'default': 1, 'type': int,
+                                           'help': 'Number of frames to reduce at once'}}]
+    runtime_context = parse_args(settings, extra_console_arguments=extra_console_arguments)
+    if runtime_context.directory is None and runtime_context.glob is None:
+        logger.error('Either --directory or --glob is required')
+        return
+    paths = reprocessing_utils.find_frames(directory=runtime_context.directory, pattern=runtime_context.glob)
+    reprocessing_utils.reduce_frames(paths, runtime_context, n_processes=runtime_context.n_processes)
+
+
+def reduce_night():
+    extra_console_arguments = [{'args': ['--site'],
+                                'kwargs': {'dest': 'site', 'help': 'Site code (e.g. ogg)', 'required': True}},
+                               {'args': ['--camera'],
+                                'kwargs': {'dest': 'camera', 'help': 'Camera (e.g. kb95)', 'required': True}},
+                               {'args': ['--dayobs'],
+                                'kwargs': {'dest': 'dayobs', 'help': 'Day-obs of the night to reduce (e.g. 20210101)',
+                                           'required': True}},
+                               {'args': ['--raw-path'],
+                                'kwargs': {'dest': 'raw_path', 'default': '/archive/engineering',
+                                           'help': 'Top level directory with the raw data'}},
+                               {'args': ['--n-processes'],
+                                'kwargs': {'dest': 'n_processes', 'default': 1, 'type': int,
+                                           'help': 'Number of frames to reduce at once'}}]
+    runtime_context = parse_args(settings, extra_console_arguments=extra_console_arguments)
+    directory = os.path.join(runtime_context.raw_path, runtime_context.site, runtime_context.camera,
+                             runtime_context.dayobs, 'raw')
+    paths = reprocessing_utils.find_frames(directory=directory)
+    reprocessing_utils.reduce_frames(paths, runtime_context, n_processes=runtime_context.n_processes)
+
+
 def make_master_calibrations():
     extra_console_arguments = [{'args': ['--site'],
                                 'kwargs': {'dest': 'site', 'help': 'Site code (e.g. ogg)', 'required': True}},
@@ -174,7 +251,14 @@ def run_realtime_pipeline():
                                            'help': 'Number of listener processes to spawn.', 'type': int}},
                                {'args': ['--queue-name'],
                                 'kwargs': {'dest': 'queue_name', 'default': 'banzai_pipeline',
-                                           'help': 'Name of the queue to listen to from the fits exchange.'}}]
+                                           'help': 'Name of the queue to listen to from the fits exchange.'}},
+                               {'args': ['--batch-size'],
+                                'kwargs': {'dest': 'batch_size', 'default': 1, 'type': int,
+                                           'help': 'Maximum number of frames from the same instrument and '
+                                                   'configuration to reduce in a single task.'}},
+                               {'args': ['--batch-timeout'],
+                                'kwargs': {'dest': 'batch_timeout', 'default': 5.0, 'type': float,
+                                           'help': 'Maximum time in seconds to wait to fill a batch of frames.'}}]
 
     runtime_context = parse_args(settings, extra_console_arguments=extra_console_arguments)
     start_listener(runtime_context)
@@ -201,6 +285,39 @@ def start_listener(runtime_context):
             logger.info('Shutting down pipeline listener.')
 
 
+def run_uploader():
+    extra_console_arguments = [{'args': ['--spool-directory'],
+                                'kwargs': {'dest': 'spool_directory',
+                                           'help': 'Directory with the spool of frames to post to the archive. '
+                                                   'Defaults to UPLOAD_SPOOL_DIRECTORY.'}},
+                               {'args': ['--n-workers'],
+                                'kwargs': {'dest': 'n_workers', 'default': settings.UPLOAD_WORKERS, 'type': int,
+                                           'help': 'Maximum number of frames to post at once'}},
+                               {'args': ['--once'],
+                                'kwargs': {'dest': 'once', 'action': 'store_true', 'default': False,
+                                           'help': 'Try each frame that is due once and exit'}},
+                               {'args': ['--requeue-dead-letters'],
+                                'kwargs': {'dest': 'requeue_dead_letters', 'action': 'store_true', 'default': False,
+                                           'help': 'Try the frames that could not be posted again'}}]
+    runtime_context = parse_args(settings, extra_console_arguments=extra_console_arguments,
+                                 parser_description='Post the frames in the upload spool to the archive.')
+    spool_directory = runtime_context.spool_directory or runtime_context.UPLOAD_SPOOL_DIRECTORY
+    if not spool_directory:
+        logger.error('Either --spool-directory or UPLOAD_SPOOL_DIRECTORY is required')
+        return
+    spool = upload_utils.UploadSpool(spool_directory)
+    if runtime_context.requeue_dead_letters:
+        logger.info('Requeued frames that could not be posted', extra_tags={'n_frames': spool.requeue_dead_letters()})
+    uploader = upload_utils.Uploader(spool, runtime_context, n_workers=runtime_context.n_workers)
+    if runtime_context.once:
+        uploader.run_once()
+        return
+    try:
+        uploader.run(poll_interval=runtime_context.UPLOAD_POLL_INTERVAL)
+    except KeyboardInterrupt:
+        logger.info('Shutting down uploader.')
+
+
 def mark_frame(mark_as):
     parser = argparse.ArgumentParser(description="Set the is_bad flag to mark the frame as {mark_as}"
                                                  "for a calibration frame in the database ".format(mark_as=mark_as))
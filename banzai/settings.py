@@ -59,6 +59,15 @@ CALIBRATION_STACKER_STAGES = {'BIAS': ['banzai.bias.BiasMaker'],
                               'DARK': ['banzai.dark.DarkMaker'],
                               'SKYFLAT': ['banzai.flats.FlatMaker']}
 
+# Memory budget in bytes for the tiles of the input images that are held in memory at once when stacking
+CALIBRATION_STACK_TILE_BYTES = int(os.getenv('CALIBRATION_STACK_TILE_BYTES', 128 * 1024 * 1024))
+
+# Number of processes to stack the tiles of master calibrations in
+CALIBRATION_STACK_WORKERS = int(os.getenv('CALIBRATION_STACK_WORKERS', 1))
+
+# Number of processes to compress the extensions of fpacked output frames in
+FPACK_WORKERS = int(os.getenv('FPACK_WORKERS', 1))
+
 CALIBRATION_IMAGE_TYPES = ['BIAS', 'DARK', 'SKYFLAT', 'BPM']
 
 # Stack delays are expressed in seconds--namely, each is five minutes
@@ -66,6 +75,19 @@ CALIBRATION_STACK_DELAYS = {'BIAS': 300,
                             'DARK': 300,
                             'SKYFLAT': 300}
 
+# Number of frames to read ahead of the one being reduced, and the number of threads reading them.
+# Set the depth to 0 to read each frame only when it is needed.
+PIPELINE_PREFETCH_DEPTH = int(os.getenv('PIPELINE_PREFETCH_DEPTH', 2))
+PIPELINE_PREFETCH_WORKERS = int(os.getenv('PIPELINE_PREFETCH_WORKERS', 2))
+
+# Number of reduced frames that can wait to be written in the background, and the number of threads writing them.
+# Set the depth to 0 to write each frame before reducing the next one.
+PIPELINE_WRITE_DEPTH = int(os.getenv('PIPELINE_WRITE_DEPTH', 2))
+PIPELINE_WRITE_WORKERS = int(os.getenv('PIPELINE_WRITE_WORKERS', 2))
+
+# Header keywords used to group frames from the fits queue into batches in the realtime pipeline
+REALTIME_BATCH_GROUPING = ['SITEID', 'INSTRUME', 'OBSTYPE', 'CONFMODE']
+
 SINISTRO_IMAGE_TYPES = ['BIAS', 'DARK', 'SKYFLAT', 'EXPOSE', 'STANDARD', 'TRAILED', 'EXPERIMENTAL']
 
 SCHEDULE_STACKING_CRON_ENTRIES = {'coj': {'minute': 30, 'hour': 6},
@@ -75,6 +97,48 @@ SCHEDULE_STACKING_CRON_ENTRIES = {'coj': {'minute': 30, 'hour': 6},
                                   'elp': {'minute': 0, 'hour': 23},
                                   'ogg': {'minute': 0, 'hour': 3}}
 
+# Directory to cache files downloaded from the archive in. This can be shared by all of the workers on a node.
+# Caching is turned off if this is not set.
+DOWNLOAD_CACHE_DIRECTORY = os.getenv('DOWNLOAD_CACHE_DIRECTORY')
+
+# Maximum total size of the files in the download cache in bytes
+DOWNLOAD_CACHE_MAX_BYTES = int(os.getenv('DOWNLOAD_CACHE_MAX_BYTES', 20 * 1024 * 1024 * 1024))
+
+# Memory budget in bytes for the opened master calibrations each worker keeps. Set to 0 to turn the cache off.
+MASTER_CALIBRATION_CACHE_BYTES = int(os.getenv('MASTER_CALIBRATION_CACHE_BYTES', 1024 * 1024 * 1024))
+
+# Remember the md5s of the raw frames on disk so that files that have not changed (same size, modification time, and
+# inode) are not read and hashed again every time they come up
+MD5_CACHE = os.getenv('MD5_CACHE', 'true').lower() == 'true'
+
+# Record the time and resources used by each stage. The results are logged and saved with the QC results.
+STAGE_METRICS = os.getenv('STAGE_METRICS', 'false').lower() == 'true'
+
+# If set, each worker serves its stage metrics in the Prometheus text format on the first free port from this one
+STAGE_METRICS_PORT = os.getenv('STAGE_METRICS_PORT')
+
+# QC results are sent to ElasticSearch in the background. These set the maximum number of documents waiting to be
+# sent, the number of documents per bulk request, how long in seconds to wait to fill a request, and how many times
+# to retry a failed request before dropping the results.
+QC_MAX_PENDING = int(os.getenv('QC_MAX_PENDING', 1000))
+QC_BATCH_SIZE = int(os.getenv('QC_BATCH_SIZE', 100))
+QC_FLUSH_INTERVAL = float(os.getenv('QC_FLUSH_INTERVAL', 1.0))
+QC_MAX_RETRIES = int(os.getenv('QC_MAX_RETRIES', 5))
+
+# If set, frames to post to the archive are added to a spool in this directory and posted by banzai_run_uploader,
+# rather than by the reduction workers. Put it on the same file system as the processed data so frames can be
+# hard linked rather than copied into it.
+UPLOAD_SPOOL_DIRECTORY = os.getenv('UPLOAD_SPOOL_DIRECTORY')
+
+# Number of frames the uploader posts at once, how many times to try to post a frame before moving it to the
+# dead-letter directory, the delay in seconds after the first failure (which doubles after each failure, up to
+# the maximum), and how often in seconds to look for new frames
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 4))
+UPLOAD_MAX_TRIES = int(os.getenv('UPLOAD_MAX_TRIES', 8))
+UPLOAD_BACKOFF_BASE = float(os.getenv('UPLOAD_BACKOFF_BASE', 5.0))
+UPLOAD_BACKOFF_MAX = float(os.getenv('UPLOAD_BACKOFF_MAX', 600.0))
+UPLOAD_POLL_INTERVAL = float(os.getenv('UPLOAD_POLL_INTERVAL', 1.0))
+
 ASTROMETRY_SERVICE_URL = os.getenv('ASTROMETRY_SERVICE_URL', 'http://astrometry.lco.gtn/catalog/')
 
 CALIBRATION_FILENAME_FUNCTIONS = {'BIAS': ('banzai.utils.file_utils.config_to_filename',
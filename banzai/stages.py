@@ -4,6 +4,7 @@ import itertools
 from collections.abc import Iterable
 
 from banzai import logs
+from banzai.utils import metrics
 from banzai.frames import ObservationFrame
 
 logger = logging.getLogger('banzai')
@@ -44,8 +45,11 @@ class Stage(abc.ABC):
                 else:
                     image = image_set
                 logger.info('Running {0}'.format(self.stage_name), image=image)
+                measurement = metrics.start_measurement(self.runtime_context)
                 processed_image = self.do_stage(image_set)
                 if processed_image is not None:
+                    if measurement is not None:
+                        metrics.record_stage(self.stage_name, processed_image, measurement, self.runtime_context)
                     processed_images.append(processed_image)
             except Exception:
                 logger.error(logs.format_exception())
@@ -46,6 +46,22 @@ def test_adds_good_bpm(mock_bpm_name, mock_bpm, set_random_seed):
     assert image.meta.get('L1IDMASK') == 'test.fits'
 
 
+@mock.patch('banzai.lco.LCOFrameFactory.open')
+@mock.patch('banzai.calibrations.CalibrationUser.get_calibration_file_info', return_value={'filename': 'test.fits'})
+def test_bpm_from_cached_master_can_be_flagged(mock_bpm_name, mock_bpm, set_random_seed):
+    image = FakeLCOObservationFrame(hdu_list=[FakeCCDData(memmap=False)])
+    bpm = make_test_bpm(101, 103).astype(np.uint8)
+    master_image = FakeLCOObservationFrame(hdu_list=[FakeCCDData(data=bpm.copy(), memmap=False)],
+                                           file_path='test.fits')
+    # Cached masters are read-only
+    master_image.primary_hdu.data.flags.writeable = False
+    mock_bpm.return_value = master_image
+    image = BadPixelMaskLoader(FakeContext()).do_stage(image)
+    image.mask[:10] |= 2
+    np.testing.assert_array_equal(master_image.data, bpm)
+    np.testing.assert_array_equal(image.mask[:10], bpm[:10] | 2)
+
+
 @mock.patch('banzai.lco.LCOFrameFactory.open')
 @mock.patch('banzai.calibrations.CalibrationUser.get_calibration_file_info', return_value={'filename': 'test.fits'})
 def test_adds_good_bpm_3d(mock_bpm_name, mock_bpm, set_random_seed):
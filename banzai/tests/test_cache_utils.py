@@ -0,0 +1,146 @@
+import os
+
+import mock
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from banzai.dark import DarkSubtractor
+from banzai.utils import cache_utils, fits_utils
+from banzai.tests.utils import FakeCCDData, FakeContext, FakeLCOObservationFrame
+
+pytestmark = pytest.mark.cache_utils
+
+
+def _write(contents):
+    def write_function(output_file):
+        output_file.write(contents)
+    return write_function
+
+
+def test_file_info_to_key():
+    assert cache_utils.file_info_to_key({'frameid': 1234}) == '1234'
+    assert cache_utils.file_info_to_key({'frameid': 1234, 'version_set': [{'md5': 'abcd'}]}) == '1234-abcd'
+    assert cache_utils.file_info_to_key({'path': '/tmp/test.fits'}) is None
+
+
+def test_store_and_open(tmpdir):
+    cache = cache_utils.DownloadCache(str(tmpdir), max_bytes=1000)
+    assert cache.open('1') is None
+    with cache.store('1', _write(b'hello')) as cached_file:
+        assert cached_file.read() == b'hello'
+    with cache.open('1') as cached_file:
+        assert cached_file.read() == b'hello'
+    # No temporary files should be left behind
+    assert sorted(os.listdir(str(tmpdir))) == ['.lock', '1']
+
+
+def test_failed_write_is_not_cached(tmpdir):
+    cache = cache_utils.DownloadCache(str(tmpdir), max_bytes=1000)
+
+    def failing_write(output_file):
+        output_file.write(b'partial')
+        raise IOError('Download failed')
+
+    with pytest.raises(IOError):
+        cache.store('1', failing_write)
+    assert cache.open('1') is None
+    assert [filename for filename in os.listdir(str(tmpdir)) if filename != '.lock'] == []
+
+
+def test_least_recently_used_files_are_evicted(tmpdir):
+    cache = cache_utils.DownloadCache(str(tmpdir), max_bytes=250)
+    for i, key in enumerate(['1', '2']):
+        cache.store(key, _write(b'a' * 100)).close()
+        os.utime(os.path.join(str(tmpdir), key), (1000 + i, 1000 + i))
+    # Using file 1 makes file 2 the least recently used
+    cache.open('1').close()
+    cache.store('3', _write(b'a' * 100)).close()
+    assert cache.open('2') is None
+    assert cache.open('1') is not None
+    assert cache.open('3') is not None
+
+
+@mock.patch('banzai.utils.fits_utils.download_from_s3')
+def test_open_fits_file_only_downloads_once(mock_download, tmpdir):
+    data = np.random.normal(size=(20, 30)).astype(np.float32)
+    compressed_hdu = fits.CompImageHDU(data=data, quantize_level=-0.01)
+    compressed_hdu.header['OBSTYPE'] = 'BIAS'
+    hdu_list = fits.HDUList([fits.PrimaryHDU(), compressed_hdu])
+
+    def download(file_info, context, is_raw_frame=False, output_file=None):
+        hdu_list.writeto(output_file)
+        return output_file
+    mock_download.side_effect = download
+    context = mock.MagicMock(DOWNLOAD_CACHE_DIRECTORY=str(tmpdir), DOWNLOAD_CACHE_MAX_BYTES=10 * 1024 * 1024)
+
+    for i in range(3):
+        opened_hdu_list, filename, frame_id = fits_utils.open_fits_file({'frameid': 1234, 'filename': 'bias.fits'},
+                                                                        context)
+        np.testing.assert_allclose(opened_hdu_list[0].data, data, atol=0.01)
+    assert mock_download.call_count == 1
+
+
+def _make_master(value=1.0, nx=10, ny=10):
+    return FakeLCOObservationFrame(hdu_list=[FakeCCDData(data=np.ones((ny, nx), dtype=np.float32) * value,
+                                                         uncertainty=np.ones((ny, nx), dtype=np.float32),
+                                                         meta=fits.Header({'EXPTIME': 1.0}))])
+
+
+def test_master_calibration_key(tmpdir):
+    assert cache_utils.master_calibration_key({'filename': 'test.fits'}) is None
+    assert cache_utils.master_calibration_key({'filename': 'test.fits', 'frameid': 12}) == ('test.fits', 12, None)
+    path = tmpdir.join('test.fits')
+    path.write('a')
+    key = cache_utils.master_calibration_key({'filename': 'test.fits', 'path': str(path)})
+    path.write('ab')
+    assert cache_utils.master_calibration_key({'filename': 'test.fits', 'path': str(path)}) != key
+
+
+def test_master_calibration_cache_evicts_by_size():
+    master_nbytes = cache_utils._frame_nbytes(_make_master())
+    cache = cache_utils.MasterCalibrationCache(2 * master_nbytes)
+    for i in range(3):
+        cache.add((f'master{i}.fits', i, None), _make_master())
+    assert cache.get(('master0.fits', 0, None)) is None
+    assert cache.get(('master2.fits', 2, None)) is not None
+    assert cache.nbytes == 2 * master_nbytes
+    cache.invalidate('master2.fits')
+    assert cache.get(('master2.fits', 2, None)) is None
+
+
+def test_cached_masters_are_not_modified():
+    cache = cache_utils.MasterCalibrationCache(1024 * 1024)
+    master = _make_master(value=2.0)
+    master.meta.update({'GAIN': 1.0, 'SATURATE': 1000.0, 'MAXLIN': 1000.0})
+    cache.add(('master.fits', 1, None), master)
+    assert not master.primary_hdu.data.flags.writeable
+    # Writing to a master from the cache copies its arrays rather than raising or changing the cached data
+    copied_master = cache.get(('master.fits', 1, None))
+    copied_master.primary_hdu -= 1.0
+    copied_master.primary_hdu *= 2.0
+    np.testing.assert_allclose(copied_master.primary_hdu.data, 2.0)
+    # Nor can the frame that was added change the cached copy
+    master.primary_hdu -= 2.0
+    cached_master = cache.get(('master.fits', 1, None))
+    np.testing.assert_allclose(cached_master.primary_hdu.data, 2.0)
+    assert not cached_master.primary_hdu.data.flags.writeable
+    assert cached_master.primary_hdu.meta['GAIN'] == 1.0
+
+
+@mock.patch('banzai.calibrations.cache_utils.get_master_calibration_cache')
+@mock.patch('banzai.calibrations.CalibrationUser.get_calibration_file_info',
+            return_value={'filename': 'dark.fits', 'frameid': 1234})
+@mock.patch('banzai.lco.LCOFrameFactory.open')
+def test_dark_subtractor_reuses_unmodified_master(mock_open, mock_file_info, mock_get_cache):
+    cache = cache_utils.MasterCalibrationCache(1024 * 1024)
+    mock_get_cache.return_value = cache
+    mock_open.return_value = _make_master(value=2.0)
+    stage = DarkSubtractor(FakeContext())
+    for i in range(2):
+        image = FakeLCOObservationFrame(hdu_list=[FakeCCDData(data=np.ones((10, 10), dtype=np.float32) * 10.0,
+                                                              meta=fits.Header({'EXPTIME': 3.0}))])
+        image = stage.do_stage(image)
+        np.testing.assert_allclose(image.data, 4.0)
+    assert mock_open.call_count == 1
+    np.testing.assert_allclose(cache.get(('dark.fits', 1234, None)).data, 2.0)
@@ -7,7 +7,8 @@ from unittest.mock import ANY
 from astropy.io.fits import Header
 from celery.exceptions import Retry
 
-from banzai.celery import stack_calibrations, schedule_calibration_stacking
+from banzai.celery import stack_calibrations, schedule_calibration_stacking, process_image_batch
+from banzai.main import RealtimeModeListener
 from banzai.settings import CALIBRATION_STACK_DELAYS
 from banzai.utils import date_utils
 from banzai.context import Context
@@ -242,3 +243,67 @@ class TestMain():
             stack_calibrations(self.min_date, self.max_date, 1, self.frame_type, self.context,
                                [self.fake_blocks_response_json['results'][0]])
         assert e.type is Retry
+
+    @mock.patch('banzai.celery.realtime_utils.set_files_as_processed')
+    @mock.patch('banzai.celery.realtime_utils.increment_try_numbers')
+    @mock.patch('banzai.celery.stage_utils.run_pipeline_stages')
+    @mock.patch('banzai.celery.realtime_utils.need_to_process_image')
+    def test_process_image_batch(self, mock_need_to_process, mock_run_stages, mock_increment, mock_set_processed,
+                                 setup):
+        file_infos = [{'path': '/archive/frame1.fits.fz'}, {'filename': 'frame2.fits.fz'},
+                      {'filename': 'frame3.fits.fz'}]
+        mock_need_to_process.side_effect = [True, True, False]
+        process_image_batch(file_infos, vars(self.context))
+        mock_run_stages.assert_called_once_with(file_infos[:2], ANY)
+        mock_increment.assert_called_once_with(['frame1.fits.fz', 'frame2.fits.fz'], db_address=ANY)
+        mock_set_processed.assert_called_once_with(['frame1.fits.fz', 'frame2.fits.fz'], db_address=ANY)
+
+    @mock.patch('banzai.celery.realtime_utils.set_files_as_processed')
+    @mock.patch('banzai.celery.realtime_utils.increment_try_numbers')
+    @mock.patch('banzai.celery.stage_utils.run_pipeline_stages')
+    @mock.patch('banzai.celery.realtime_utils.need_to_process_image')
+    def test_process_image_batch_nothing_to_do(self, mock_need_to_process, mock_run_stages, mock_increment,
+                                               mock_set_processed, setup):
+        mock_need_to_process.return_value = False
+        process_image_batch([{'filename': 'frame1.fits.fz'}], vars(self.context))
+        assert not mock_run_stages.called
+        assert not mock_set_processed.called
+
+
+class TestRealtimeBatching:
+    def make_listener(self, batch_size, batch_timeout=5.0):
+        return RealtimeModeListener(Context({'broker_url': 'memory://', 'batch_size': batch_size,
+                                             'batch_timeout': batch_timeout,
+                                             'REALTIME_BATCH_GROUPING': ['INSTRUME', 'OBSTYPE']}))
+
+    @mock.patch('banzai.main.process_image.apply_async')
+    def test_no_batching(self, mock_process_image):
+        listener = self.make_listener(1)
+        message = mock.MagicMock()
+        listener.on_message({'filename': 'frame1.fits.fz'}, message)
+        mock_process_image.assert_called_once_with(args=({'filename': 'frame1.fits.fz'}, ANY))
+        assert message.ack.called
+
+    @mock.patch('banzai.main.process_image_batch.apply_async')
+    def test_batches_are_sent_when_full(self, mock_process_batch):
+        listener = self.make_listener(2)
+        bodies = [{'filename': f'frame{i}.fits.fz', 'INSTRUME': instrument, 'OBSTYPE': 'EXPOSE'}
+                  for i, instrument in enumerate(['fa01', 'fa02', 'fa01'])]
+        messages = [mock.MagicMock() for _ in bodies]
+        for body, message in zip(bodies, messages):
+            listener.on_message(body, message)
+        mock_process_batch.assert_called_once_with(args=([bodies[0], bodies[2]], ANY))
+        assert messages[0].ack.called and messages[2].ack.called
+        # The other instrument is still waiting for its batch to fill
+        assert not messages[1].ack.called
+
+    @mock.patch('banzai.main.process_image_batch.apply_async')
+    def test_batches_are_sent_after_timeout(self, mock_process_batch):
+        listener = self.make_listener(10, batch_timeout=0.0)
+        message = mock.MagicMock()
+        listener.on_message({'filename': 'frame1.fits.fz', 'INSTRUME': 'fa01', 'OBSTYPE': 'EXPOSE'}, message)
+        assert not mock_process_batch.called
+        listener.on_iteration()
+        mock_process_batch.assert_called_once()
+        assert message.ack.called
+        assert listener.batches == {}
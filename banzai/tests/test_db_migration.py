@@ -0,0 +1,44 @@
+import pytest
+from sqlalchemy import inspect
+
+from banzai import dbs
+from banzai.utils import db_migration
+
+pytestmark = pytest.mark.db_migration
+
+
+def test_upgrade_adds_master_search_index(tmpdir):
+    db_address = f"sqlite:///{tmpdir.join('test.db')}"
+    dbs.create_db(db_address)
+    engine, _ = dbs.get_engine(db_address)
+    # A database made before the index existed
+    engine.execute('DROP INDEX ix_calimages_master_search')
+    assert 'ix_calimages_master_search' not in db_migration._index_names(engine, 'calimages')
+
+    db_migration.upgrade_schema(db_address)
+    indexes = {index['name']: index for index in inspect(engine).get_indexes('calimages')}
+    assert indexes['ix_calimages_master_search']['column_names'] == ['instrument_id', 'type', 'is_master', 'is_bad',
+                                                                     'dateobs']
+    # Running it again does nothing
+    db_migration.upgrade_schema(db_address)
+
+
+def test_upgrade_makes_processed_image_filenames_unique(tmpdir):
+    db_address = f"sqlite:///{tmpdir.join('test.db')}"
+    dbs.create_db(db_address)
+    engine, _ = dbs.get_engine(db_address)
+    # A database made before the filenames were unique, with some duplicate rows
+    engine.execute('DROP INDEX ix_processedimages_filename')
+    engine.execute('CREATE INDEX ix_processedimages_filename ON processedimages (filename)')
+    assert not dbs.processed_image_filenames_are_unique(engine)
+    rows = [('a.fits', False, 1), ('a.fits', True, 2), ('a.fits', False, 3), ('b.fits', False, 1),
+            ('b.fits', False, 2), ('c.fits', True, 1)]
+    engine.execute(dbs.ProcessedImage.__table__.insert(),
+                   [{'filename': filename, 'success': success, 'tries': tries} for filename, success, tries in rows])
+
+    db_migration.upgrade_schema(db_address)
+    assert dbs.processed_image_filenames_are_unique(engine)
+    with dbs.get_session(db_address) as db_session:
+        kept = {row.filename: (row.success, row.tries) for row in db_session.query(dbs.ProcessedImage)}
+    assert kept == {'a.fits': (True, 2), 'b.fits': (False, 2), 'c.fits': (True, 1)}
+    db_migration.upgrade_schema(db_address)
@@ -0,0 +1,38 @@
+import hashlib
+import os
+
+import mock
+import pytest
+
+from banzai.utils import file_utils
+
+pytestmark = pytest.mark.file_utils
+
+
+@mock.patch('banzai.utils.file_utils.MD5_CHUNK_SIZE', 7)
+def test_get_md5_in_chunks(tmpdir):
+    path = str(tmpdir.join('test.fits'))
+    contents = os.urandom(100)
+    with open(path, 'wb') as test_file:
+        test_file.write(contents)
+    assert file_utils.get_md5(path) == hashlib.md5(contents).hexdigest()
+
+
+def test_get_md5_cache(tmpdir):
+    path = str(tmpdir.join('test.fits'))
+    with open(path, 'wb') as test_file:
+        test_file.write(b'a' * 100)
+    md5 = file_utils.get_md5(path, use_cache=True)
+    assert md5 == hashlib.md5(b'a' * 100).hexdigest()
+    stat = os.stat(path)
+
+    # Change the contents in place, keeping the size and the modification time, so the cached md5 is used
+    with open(path, 'r+b') as test_file:
+        test_file.write(b'b' * 100)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert file_utils.get_md5(path, use_cache=True) == md5
+    # Without the cache, the file is always read
+    assert file_utils.get_md5(path) == hashlib.md5(b'b' * 100).hexdigest()
+
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert file_utils.get_md5(path, use_cache=True) == hashlib.md5(b'b' * 100).hexdigest()
@@ -1,3 +1,7 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import mock
 import numpy as np
 from astropy.io.fits import Header
 from astropy.table import Table
@@ -83,3 +87,113 @@ def test_open_image():
         # Read an image with a single extension and a datacube
         # Read an image with multiple sci extensions
         pass
+
+
+@mock.patch('banzai.utils.fits_utils.requests.get')
+def test_open_fits_file_streams_download(mock_get):
+    data = np.random.normal(size=(50, 60)).astype(np.float32)
+    compressed_hdu = fits.CompImageHDU(data=data, quantize_level=-0.01)
+    compressed_hdu.header['OBSTYPE'] = 'EXPOSE'
+    hdu_list = fits.HDUList([fits.PrimaryHDU(), compressed_hdu])
+    fpacked_file = io.BytesIO()
+    hdu_list.writeto(fpacked_file)
+    file_contents = fpacked_file.getvalue()
+
+    file_response = mock.MagicMock()
+    file_response.__enter__.return_value.iter_content.return_value = [file_contents[i:i + 2880]
+                                                                      for i in range(0, len(file_contents), 2880)]
+    mock_get.side_effect = [mock.MagicMock(json=mock.MagicMock(return_value={'url': 'https://example.com/file'})),
+                            file_response]
+    context = mock.MagicMock(ARCHIVE_FRAME_URL='https://archive', ARCHIVE_AUTH_HEADER={}, DOWNLOAD_CACHE_DIRECTORY=None)
+
+    unpacked_hdu_list, filename, frame_id = fits_utils.open_fits_file({'frameid': 1234, 'filename': 'test.fits.fz'},
+                                                                      context)
+    assert filename == 'test.fits.fz'
+    assert frame_id == 1234
+    assert unpacked_hdu_list[0].header['OBSTYPE'] == 'EXPOSE'
+    np.testing.assert_allclose(unpacked_hdu_list[0].data, data, atol=0.01)
+
+
+def make_hdu_list_to_pack():
+    data = np.random.normal(1000.0, 10.0, size=(200, 300)).astype(np.float32)
+    primary_hdu = fits.PrimaryHDU(data=data, header=fits.Header({'OBSTYPE': 'EXPOSE', 'EXTNAME': 'SCI'}))
+    bpm_hdu = fits.ImageHDU(data=np.zeros(data.shape, dtype=np.uint8), name='BPM')
+    error_hdu = fits.ImageHDU(data=np.sqrt(data), name='ERR')
+    catalog_hdu = fits_utils.table_to_fits(Table({'x': [1.0, 2.0], 'y': [3.0, 4.0]}))
+    return fits.HDUList([primary_hdu, bpm_hdu, catalog_hdu, error_hdu])
+
+
+def write_serially(packed_hdu_list):
+    output_file = io.BytesIO()
+    packed_hdu_list.writeto(output_file, output_verify='silentfix')
+    return output_file.getvalue()
+
+
+def test_write_fits_in_parallel_matches_serial():
+    hdu_list = make_hdu_list_to_pack()
+    packed_hdu_list = fits_utils.pack(hdu_list)
+    expected = write_serially(packed_hdu_list)
+
+    output_file = io.BytesIO()
+    stats = fits_utils.write_fits(packed_hdu_list, output_file, n_workers=4)
+    assert output_file.getvalue() == expected
+    assert stats['fpack.workers'] == 3
+    assert stats['fpack.input_bytes'] == sum(hdu.data.nbytes for hdu in hdu_list if hdu.is_image)
+    assert stats['fpack.output_bytes'] == len(expected)
+
+
+def test_write_fits_header_only_primary():
+    hdu_list = make_hdu_list_to_pack()
+    hdu_list[0] = fits.PrimaryHDU(header=hdu_list[0].header)
+    packed_hdu_list = fits_utils.pack(hdu_list)
+    expected = write_serially(packed_hdu_list)
+
+    output_file = io.BytesIO()
+    fits_utils.write_fits(packed_hdu_list, output_file, n_workers=2)
+    assert output_file.getvalue() == expected
+
+
+def test_write_fits_from_several_threads_at_once():
+    packed_hdu_lists = []
+    for scale in [10.0, 1000.0]:
+        hdu_list = make_hdu_list_to_pack()
+        hdu_list[0].data *= scale
+        packed_hdu_lists.append(fits_utils.pack(hdu_list))
+    expected = [write_serially(packed_hdu_list) for packed_hdu_list in packed_hdu_lists]
+
+    output_files = [io.BytesIO() for _ in packed_hdu_lists]
+    with ThreadPoolExecutor(max_workers=len(packed_hdu_lists)) as executor:
+        futures = [executor.submit(fits_utils.write_fits, packed_hdu_list, output_file, n_workers=2)
+                   for packed_hdu_list, output_file in zip(packed_hdu_lists, output_files)]
+        for future in futures:
+            assert future.result()['fpack.workers'] == 2
+    assert [output_file.getvalue() for output_file in output_files] == expected
+
+
+@mock.patch('banzai.utils.fits_utils.multiprocessing.get_context')
+def test_write_fits_falls_back_to_one_process(mock_get_context):
+    mock_get_context.return_value.Pool.side_effect = AssertionError('daemonic processes cannot have children')
+    packed_hdu_list = fits_utils.pack(make_hdu_list_to_pack())
+    expected = write_serially(packed_hdu_list)
+
+    output_file = io.BytesIO()
+    stats = fits_utils.write_fits(packed_hdu_list, output_file, n_workers=4)
+    assert output_file.getvalue() == expected
+    assert stats['fpack.workers'] == 1
+
+
+@mock.patch('banzai.utils.fits_utils.WRITE_BLOCK_BYTES', 4096)
+def test_write_fits_converts_datatypes_as_it_writes():
+    hdu_list = make_hdu_list_to_pack()
+    hdu_list[0].data = hdu_list[0].data.astype(np.float64)
+    hdu_list['ERR'].data = hdu_list['ERR'].data.astype(np.float64)
+    extension_datatypes = {'SCI': 'float32', 'BPM': 'uint8', 'ERR': 'float32'}
+    output_file = io.BytesIO()
+    fits_utils.write_fits(hdu_list, output_file, extension_datatypes=extension_datatypes)
+    # The HDUs that were passed in are left as they were
+    assert hdu_list[0].data.dtype == np.float64
+
+    fits_utils.convert_extension_datatypes(hdu_list, extension_datatypes)
+    expected = io.BytesIO()
+    hdu_list.writeto(expected, output_verify='silentfix')
+    assert output_file.getvalue() == expected.getvalue()
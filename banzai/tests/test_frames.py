@@ -1,8 +1,13 @@
+import hashlib
+import os
+
+import mock
 import pytest
 import numpy as np
 from astropy.table import Table
 from astropy.io.fits import ImageHDU, Header
 
+from banzai.utils import upload_utils
 from banzai.utils.image_utils import Section
 from banzai.data import CCDData, DataTable
 from banzai.tests.utils import FakeCCDData, FakeLCOObservationFrame, FakeContext
@@ -117,6 +122,16 @@ def test_uncertainty_propagation_on_subtract():
     assert np.allclose(data1.uncertainty, 2)
 
 
+def test_uncertainty_is_constant_until_needed():
+    data1 = CCDData(data=np.ones((10, 12), dtype=np.float32), meta=Header({'RDNOISE': 6.0, 'GAIN': 2.0}))
+    data2 = CCDData(data=np.ones((10, 12), dtype=np.float32), meta=Header({'RDNOISE': 8.0, 'GAIN': 2.0}))
+    data1 -= data2
+    assert data1._uncertainty is None
+    assert data1.uncertainty.shape == (10, 12)
+    assert data1.uncertainty.dtype == np.float32
+    np.testing.assert_allclose(data1.uncertainty, 5.0)
+
+
 def test_trim():
     test_data = FakeCCDData(nx=1000, ny=1000,
                             meta={'TRIMSEC': '[1:950, 1:945]',
@@ -131,6 +146,56 @@ def test_trim():
     assert trimmed_data.uncertainty.shape == (945, 950)
 
 
+def test_trim_without_copy_shares_buffers():
+    test_data = FakeCCDData(nx=100, ny=100,
+                            meta={'TRIMSEC': '[1:95, 1:90]',
+                                  'DATASEC': '[1:100, 1:100]',
+                                  'DETSEC': '[1:100, 1:100]'},
+                            memmap=False)
+
+    trimmed_data = test_data.trim(copy=False)
+    assert np.shares_memory(trimmed_data.data, test_data.data)
+    assert not trimmed_data.data.flags.writeable
+
+    # Writing to the trimmed data should not change the original
+    trimmed_data -= 1.0
+    assert not np.shares_memory(trimmed_data.data, test_data.data)
+    np.testing.assert_allclose(trimmed_data.data, 0.0)
+    np.testing.assert_allclose(test_data.data, 1.0)
+    assert test_data.data.flags.writeable
+
+
+def test_detach_takes_over_buffers():
+    test_data = FakeCCDData(nx=100, ny=100,
+                            meta={'TRIMSEC': '[1:95, 1:90]',
+                                  'DATASEC': '[1:100, 1:100]',
+                                  'DETSEC': '[1:100, 1:100]'},
+                            memmap=False)
+
+    trimmed_data = test_data.trim(copy=False)
+    trimmed_data.detach()
+    assert np.shares_memory(trimmed_data.data, test_data.data)
+    assert trimmed_data.data.flags.writeable
+
+
+def test_detach_copies_every_buffer_if_one_parent_buffer_is_read_only():
+    test_data = FakeCCDData(nx=100, ny=100,
+                            meta={'TRIMSEC': '[1:95, 1:90]',
+                                  'DATASEC': '[1:100, 1:100]',
+                                  'DETSEC': '[1:100, 1:100]'},
+                            memmap=False)
+    test_data.mask.flags.writeable = False
+
+    trimmed_data = test_data.trim(copy=False)
+    trimmed_data.detach()
+    for array_name in ['data', 'mask', 'uncertainty']:
+        assert not np.shares_memory(getattr(trimmed_data, array_name), getattr(test_data, array_name))
+    trimmed_data.data[:] = 5.0
+    trimmed_data.mask[:] = 1
+    np.testing.assert_allclose(test_data.data, 1.0)
+    np.testing.assert_array_equal(test_data.mask, 0)
+
+
 def test_init_poisson_uncertainties():
     # Make sure the uncertainties add in quadrature
     test_data = FakeCCDData(image_multiplier=16, uncertainty=3)
@@ -146,6 +211,83 @@ def test_get_output_filename():
     assert filename == '/tmp/cpt/fa16/20160101/processed/test_image_91.fits.fz'
 
 
+def make_frame_to_write():
+    meta = {'EXTNAME': 'SCI', 'OBSTYPE': 'EXPOSE', 'PROPID': 'LCOEngineering', 'DATE-OBS': '2016-01-01T00:00:00.000'}
+    return FakeLCOObservationFrame(hdu_list=[FakeCCDData(meta=Header(meta))], file_path='test_image_00.fits')
+
+
+@pytest.mark.parametrize('fpack', [True, False])
+@mock.patch('banzai.frames.dbs.save_processed_image')
+def test_write_saves_md5_of_output_file(mock_save_processed_image, fpack, tmp_path):
+    test_frame = make_frame_to_write()
+    test_context = FakeContext(fpack=fpack, processed_path=str(tmp_path), no_file_cache=False, post_to_archive=False)
+    test_frame.write(test_context)
+
+    output_filename = test_frame.get_output_filename(test_context)
+    with open(output_filename, 'rb') as output_file:
+        md5 = hashlib.md5(output_file.read()).hexdigest()
+    mock_save_processed_image.assert_called_with(output_filename, md5, db_address=test_context.db_address)
+    # The temporary file has been moved into place
+    assert os.listdir(os.path.dirname(output_filename)) == [os.path.basename(output_filename)]
+
+
+@mock.patch('banzai.frames.file_utils.post_to_ingester')
+@mock.patch('banzai.frames.dbs.save_processed_image')
+def test_write_without_file_cache_posts_to_archive(mock_save_processed_image, mock_post_to_ingester, tmp_path):
+    uploaded = {}
+
+    def post_to_ingester(file_object, image, output_filename, **kwargs):
+        file_object.seek(0)
+        uploaded['data'] = file_object.read()
+        return {'frameid': 1234}
+    mock_post_to_ingester.side_effect = post_to_ingester
+
+    test_frame = make_frame_to_write()
+    test_context = FakeContext(processed_path=str(tmp_path), no_file_cache=True, post_to_archive=True,
+                               UPLOAD_BACKOFF_BASE=1.0, UPLOAD_BACKOFF_MAX=2.0)
+    test_frame.write(test_context)
+
+    assert test_frame.frame_id == 1234
+    assert mock_post_to_ingester.call_args[1]['backoff_base'] == 1.0
+    assert mock_post_to_ingester.call_args[1]['backoff_max'] == 2.0
+    assert os.listdir(str(tmp_path)) == []
+    output_filename = test_frame.get_output_filename(test_context)
+    mock_save_processed_image.assert_called_with(output_filename, hashlib.md5(uploaded['data']).hexdigest(),
+                                                 db_address=test_context.db_address)
+
+
+@pytest.mark.parametrize('no_file_cache', [True, False])
+@mock.patch('banzai.frames.file_utils.post_to_ingester')
+@mock.patch('banzai.frames.dbs.save_processed_image')
+def test_write_adds_frame_to_upload_spool(mock_save_processed_image, mock_post_to_ingester, no_file_cache, tmp_path):
+    test_frame = make_frame_to_write()
+    test_context = FakeContext(processed_path=str(tmp_path / 'processed'), no_file_cache=no_file_cache,
+                               post_to_archive=True, UPLOAD_SPOOL_DIRECTORY=str(tmp_path / 'spool'))
+    test_frame.write(test_context)
+
+    assert not mock_post_to_ingester.called
+    spool = upload_utils.UploadSpool(str(tmp_path / 'spool'))
+    [entry_id] = spool.entries()
+    output_filename = test_frame.get_output_filename(test_context)
+    assert spool.read_manifest(entry_id)['output_filename'] == output_filename
+    with open(spool.data_path(entry_id), 'rb') as spooled_file:
+        md5 = hashlib.md5(spooled_file.read()).hexdigest()
+    mock_save_processed_image.assert_called_with(output_filename, md5, db_address=test_context.db_address)
+    # No temporary files are left in the spool directory
+    assert sorted(os.listdir(str(tmp_path / 'spool'))) == ['dead-letter', 'pending']
+
+
+@mock.patch('banzai.frames.fits_utils.write_fits', side_effect=OSError('disk full'))
+@mock.patch('banzai.frames.dbs.save_processed_image')
+def test_write_removes_partial_file_on_failure(mock_save_processed_image, mock_write_fits, tmp_path):
+    test_frame = make_frame_to_write()
+    test_context = FakeContext(processed_path=str(tmp_path), no_file_cache=False, post_to_archive=False)
+    with pytest.raises(OSError):
+        test_frame.write(test_context)
+    assert os.listdir(os.path.dirname(test_frame.get_output_filename(test_context))) == []
+    assert not mock_save_processed_image.called
+
+
 def test_section_transformation():
     nx = 1024
     ny = 1024
@@ -184,6 +184,69 @@ def test_median2d_uniform_distribution_nomask():
         _compare_median2d(a.astype('f4'), np.zeros((size_y, size_x), dtype=np.uint8))
 
 
+def test_median2d_small_columns():
+    # Short columns take the insertion sort path, longer ones use quick select
+    for size_x in range(1, 41):
+        a = np.random.normal(0.0, 10.0, size=(50, size_x))
+        a[:, ::3] = np.round(a[:, ::3])
+        _compare_median2d(a.astype('f4'), np.zeros(a.shape, dtype=np.uint8))
+
+
+def test_median1d_even_sizes_with_duplicates():
+    for size in range(2, 200, 2):
+        a = np.random.randint(0, 5, size=size).astype(np.float32)
+        _compare_median1d(a, np.zeros(size, dtype=np.uint8))
+
+
+def test_median_without_mask():
+    a = np.random.normal(0.0, 10.0, size=(37, 52)).astype(np.float32)
+    np.testing.assert_allclose(median_utils.median2d(a), np.median(a, axis=1))
+    a_copy = a.copy()
+    assert median_utils.median1d(a.ravel()) == np.float32(np.median(a))
+    # We select on a copy so the input should not be reordered
+    np.testing.assert_array_equal(a, a_copy)
+
+
+def test_median2d_mixed_masked_and_unmasked_rows():
+    a = np.random.normal(0.0, 10.0, size=(20, 31)).astype(np.float32)
+    mask = np.zeros(a.shape, dtype=np.uint8)
+    mask[::2, 5] = 1
+    expected = [np.median(row[row_mask == 0]) for row, row_mask in zip(a, mask)]
+    np.testing.assert_allclose(median_utils.median2d(a, mask), expected)
+
+
+def test_sigma_clipped_stack_matches_numpy():
+    n, ny, nx = 11, 23, 17
+    data = np.random.normal(100.0, 5.0, size=(n, ny, nx)).astype(np.float32)
+    data[2, 3:6, :] = 1e4
+    uncertainty = np.random.uniform(1.0, 3.0, size=(n, ny, nx)).astype(np.float32)
+    mask = (np.random.uniform(size=(n, ny, nx)) > 0.8).astype(np.uint8) * 2
+    mask[:, 0, 0] = 1
+    mask[0, 0, 0] = 4
+
+    mean, stacked_uncertainty, stacked_mask, n_good, median, mad = \
+        median_utils.sigma_clipped_stack(data, uncertainty, mask, 3.0)
+
+    masked_data = np.ma.array(data, mask=mask > 0)
+    expected_median = np.ma.median(masked_data, axis=0).filled(0.0)
+    np.testing.assert_allclose(median, expected_median, rtol=1e-6)
+    abs_deviation = np.abs(data - expected_median)
+    expected_mad = np.ma.median(np.ma.array(abs_deviation, mask=mask > 0), axis=0).filled(0.0)
+    np.testing.assert_allclose(mad, expected_mad, rtol=1e-5)
+
+    good = np.logical_and(mask == 0, abs_deviation <= 3.0 * 1.4826 * expected_mad)
+    np.testing.assert_array_equal(n_good, good.sum(axis=0))
+    expected_mean = np.where(good, data, 0.0).sum(axis=0) / np.maximum(good.sum(axis=0), 1)
+    expected_uncertainty = np.sqrt(np.where(good, uncertainty ** 2, 0.0).sum(axis=0)) / np.maximum(good.sum(axis=0), 1)
+    np.testing.assert_allclose(mean[1:, :], expected_mean[1:, :], rtol=1e-6)
+    np.testing.assert_allclose(stacked_uncertainty[1:, :], expected_uncertainty[1:, :], rtol=1e-6)
+    assert np.all(stacked_mask[1:, :] == 0)
+
+    # Every pixel is masked so we fall back to the mean of everything and keep the mask bits
+    assert n_good[0, 0] == 0
+    assert stacked_mask[0, 0] == 5
+    np.testing.assert_allclose(mean[0, 0], data[:, 0, 0].astype(np.float64).mean(), rtol=1e-6)
+
 # def test_median2d_bimodel_arange_nomask():
 #     for i in range(100):
 #         size1 = np.random.randint(1, 10000)
@@ -0,0 +1,78 @@
+import gc
+
+import numpy as np
+import pytest
+
+from banzai.data import CCDData
+from banzai.utils import memory_utils
+
+pytestmark = pytest.mark.memory_utils
+
+
+def test_slot_size_rounds_to_power_of_two():
+    assert memory_utils.MemoryMappedArena.slot_size(1) == memory_utils.MIN_SLOT_SIZE
+    assert memory_utils.MemoryMappedArena.slot_size(memory_utils.MIN_SLOT_SIZE + 1) == 2 * memory_utils.MIN_SLOT_SIZE
+
+
+def test_slots_are_reused_when_freed():
+    arena = memory_utils.MemoryMappedArena()
+    a = arena.allocate((100, 100), np.float32)
+    a[:] = 5.0
+    del a
+    gc.collect()
+    b = arena.allocate((50, 200), np.float32)
+    stats = arena.stats()
+    assert stats['arena.allocations'] == 2
+    assert stats['arena.reused_slots'] == 1
+    assert stats['arena.released_slots'] == 1
+    assert stats['arena.open_files'] == 1
+    assert b.shape == (50, 200)
+    arena.close()
+
+
+def test_slot_not_reused_while_view_is_alive():
+    arena = memory_utils.MemoryMappedArena()
+    a = arena.allocate((10, 10), np.float64)
+    a[:] = 1.0
+    view = a[2:5, 2:5]
+    del a
+    gc.collect()
+    b = arena.allocate((10, 10), np.float64)
+    b[:] = 2.0
+    np.testing.assert_array_equal(view, 1.0)
+    assert arena.stats()['arena.reused_slots'] == 0
+    arena.close()
+
+
+def test_bytes_in_use_tracks_live_arrays():
+    arena = memory_utils.MemoryMappedArena()
+    a = arena.allocate((500,), np.float64)
+    b = arena.allocate((1000,), np.uint8)
+    assert arena.stats()['arena.bytes_in_use'] == 2 * memory_utils.MIN_SLOT_SIZE
+    del a, b
+    gc.collect()
+    stats = arena.stats()
+    assert stats['arena.bytes_in_use'] == 0
+    assert stats['arena.peak_bytes_in_use'] == 2 * memory_utils.MIN_SLOT_SIZE
+    arena.close()
+
+
+def test_close_keeps_live_arrays_valid():
+    arena = memory_utils.MemoryMappedArena()
+    a = arena.allocate((10, 10), np.float32)
+    a[:] = 3.0
+    arena.close()
+    np.testing.assert_array_equal(a, 3.0)
+    assert arena.stats()['arena.open_files'] == 0
+    with pytest.raises(ValueError):
+        arena.allocate((10, 10), np.float32)
+
+
+def test_ccd_data_arrays_come_from_the_arena():
+    data = np.random.uniform(size=(103, 101))
+    ccd_data = CCDData(data=data, meta={'RDNOISE': 3.0})
+    np.testing.assert_array_equal(ccd_data.data, data)
+    assert ccd_data.data is not data
+    assert np.all(ccd_data.mask == 0)
+    assert ccd_data.mask.dtype == np.uint8
+    np.testing.assert_allclose(ccd_data.uncertainty, 3.0)
@@ -0,0 +1,81 @@
+import urllib.request
+
+import mock
+import numpy as np
+import pytest
+
+from banzai.context import Context
+from banzai.stages import Stage
+from banzai.utils import metrics, memory_utils
+
+pytestmark = pytest.mark.metrics
+
+
+class FakeFrame:
+    obstype = 'EXPOSE'
+
+
+class AllocatingStage(Stage):
+    def do_stage(self, image):
+        image.data = memory_utils.get_arena().allocate((100, 100), np.float32)
+        image.data[:] = 1.0
+        return image
+
+
+def test_metrics_are_not_recorded_when_turned_off():
+    image = AllocatingStage(Context({'STAGE_METRICS': False})).run([FakeFrame()])[0]
+    assert getattr(image, 'stage_metrics', None) is None
+
+
+def test_stage_metrics_are_recorded():
+    runtime_context = Context({'STAGE_METRICS': True})
+    stage = AllocatingStage(runtime_context)
+    image = stage.run([FakeFrame()])[0]
+    measurements = image.stage_metrics[stage.stage_name]
+    assert measurements['wall_time'] > 0
+    assert measurements['cpu_time'] >= 0
+    assert measurements['allocations'] == 1
+    totals = metrics.get_registry(runtime_context).totals()[stage.stage_name]
+    assert totals['runs'] >= 1
+    assert totals['allocations'] >= 1
+
+
+def test_openmetrics_format():
+    registry = metrics.StageMetricsRegistry()
+    measurements = {name: 2 for name, _ in metrics.STAGE_METRICS}
+    registry.add('banzai.bias.BiasSubtractor', measurements)
+    registry.add('banzai.bias.BiasSubtractor', measurements)
+    text = registry.to_openmetrics()
+    assert 'banzai_stage_runs_total{stage="banzai.bias.BiasSubtractor"} 2' in text
+    assert 'banzai_stage_wall_time_total{stage="banzai.bias.BiasSubtractor"} 4' in text
+    assert '# TYPE banzai_stage_read_bytes counter' in text
+    assert text.endswith('# EOF\n')
+
+
+def test_metrics_server():
+    server = metrics.start_metrics_server(0)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f'http://localhost:{port}/metrics') as response:
+            assert response.status == 200
+            assert b'banzai_process_max_rss_bytes' in response.read()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@mock.patch('banzai.utils.metrics.qc.save_qc_results')
+def test_frame_summary_is_saved_with_qc_results(mock_save_qc):
+    image = FakeFrame()
+    image.stage_metrics = {'stage1': {name: 1 for name, _ in metrics.STAGE_METRICS},
+                           'stage2': {name: 2 for name, _ in metrics.STAGE_METRICS}}
+    metrics.save_frame_summary(image, Context({}))
+    qc_results = mock_save_qc.call_args[0][1]['stage_metrics']
+    assert qc_results['total']['wall_time'] == 3
+    assert [stage['stage'] for stage in qc_results['stages']] == ['stage1', 'stage2']
+
+
+@mock.patch('banzai.utils.metrics.qc.save_qc_results')
+def test_no_frame_summary_without_metrics(mock_save_qc):
+    metrics.save_frame_summary(FakeFrame(), Context({}))
+    assert not mock_save_qc.called
@@ -1,8 +1,9 @@
 import mock
 import pytest
+from astropy.io.fits import Header
 
-from banzai.tests.utils import FakeContext
-from banzai.utils.realtime_utils import need_to_process_image
+from banzai.tests.utils import FakeContext, FakeInstrument
+from banzai.utils.realtime_utils import need_to_process_image, header_can_be_processed
 
 md5_hash1 = '49a6bb35cdd3859224c0214310b1d9b6'
 md5_hash2 = 'aec5ef355e7e43a59fedc88ac95caed6'
@@ -20,7 +21,7 @@ class FakeRealtimeImage(object):
 @mock.patch('banzai.utils.file_utils.get_md5')
 @mock.patch('banzai.dbs.get_processed_image')
 @mock.patch('banzai.utils.fits_utils.get_primary_header')
-@mock.patch('banzai.utils.image_utils.image_can_be_processed')
+@mock.patch('banzai.utils.realtime_utils.header_can_be_processed')
 def test_no_processing_if_previous_success(mock_can_process, mock_header, mock_processed, mock_md5):
     mock_can_process.return_value = True
     mock_processed.return_value = FakeRealtimeImage(success=True, checksum=md5_hash1)
@@ -32,7 +33,7 @@ def test_no_processing_if_previous_success(mock_can_process, mock_header, mock_p
 @mock.patch('banzai.utils.file_utils.get_md5')
 @mock.patch('banzai.dbs.get_processed_image')
 @mock.patch('banzai.utils.fits_utils.get_primary_header')
-@mock.patch('banzai.utils.image_utils.image_can_be_processed')
+@mock.patch('banzai.utils.realtime_utils.header_can_be_processed')
 def test_do_process_if_never_tried(mock_can_process, mock_header, mock_processed, mock_md5, mock_commit):
     mock_can_process.return_value = True
     mock_processed.return_value = FakeRealtimeImage(success=False, checksum=md5_hash1, tries=0)
@@ -44,7 +45,7 @@ def test_do_process_if_never_tried(mock_can_process, mock_header, mock_processed
 @mock.patch('banzai.utils.file_utils.get_md5')
 @mock.patch('banzai.dbs.get_processed_image')
 @mock.patch('banzai.utils.fits_utils.get_primary_header')
-@mock.patch('banzai.utils.image_utils.image_can_be_processed')
+@mock.patch('banzai.utils.realtime_utils.header_can_be_processed')
 def test_do_process_if_tries_less_than_max(mock_can_process, mock_header, mock_processed, mock_md5, mock_commit):
     mock_can_process.return_value = True
     mock_processed.return_value = FakeRealtimeImage(success=False, checksum=md5_hash1, tries=3)
@@ -58,7 +59,7 @@ def test_do_process_if_tries_less_than_max(mock_can_process, mock_header, mock_p
 @mock.patch('banzai.utils.file_utils.get_md5')
 @mock.patch('banzai.dbs.get_processed_image')
 @mock.patch('banzai.utils.fits_utils.get_primary_header')
-@mock.patch('banzai.utils.image_utils.image_can_be_processed')
+@mock.patch('banzai.utils.realtime_utils.header_can_be_processed')
 def test_no_processing_if_tries_at_max(mock_can_process, mock_header, mock_processed, mock_md5, mock_commit):
     mock_can_process.return_value = True
     max_tries = 5
@@ -73,7 +74,7 @@ def test_no_processing_if_tries_at_max(mock_can_process, mock_header, mock_proce
 @mock.patch('banzai.utils.file_utils.get_md5')
 @mock.patch('banzai.dbs.get_processed_image')
 @mock.patch('banzai.utils.fits_utils.get_primary_header')
-@mock.patch('banzai.utils.image_utils.image_can_be_processed')
+@mock.patch('banzai.utils.realtime_utils.header_can_be_processed')
 def test_do_process_if_new_checksum(mock_can_process, mock_header, mock_processed, mock_md5, mock_commit):
     # assert that tries and success are reset to 0
     image = FakeRealtimeImage(success=True, checksum=md5_hash1, tries=3)
@@ -84,3 +85,35 @@ def test_do_process_if_new_checksum(mock_can_process, mock_header, mock_processe
     assert not image.success
     assert image.tries == 0
     assert image.checksum == md5_hash2
+
+
+def make_raw_header(**kwargs):
+    header = Header({'OBSTYPE': 'EXPOSE', 'RLEVEL': 0, 'SITEID': 'cpt', 'INSTRUME': 'fa16', 'TELESCOP': '1m0-10'})
+    header.update(kwargs)
+    return header
+
+
+@mock.patch('banzai.utils.file_utils.get_md5')
+@mock.patch('banzai.dbs.get_processed_image')
+@mock.patch('banzai.utils.fits_utils.get_primary_header')
+def test_header_is_checked_before_the_file_is_hashed(mock_header, mock_processed, mock_md5):
+    for header in [make_raw_header(RLEVEL=91), make_raw_header(OBSTYPE='GUIDE'), None]:
+        mock_header.return_value = header
+        assert not need_to_process_image({'path': 'test.fits'}, FakeContext())
+    assert not mock_md5.called
+    assert not mock_processed.called
+
+
+@mock.patch('banzai.lco.LCOFrameFactory.get_instrument_from_header')
+def test_header_can_be_processed(mock_instrument):
+    mock_instrument.return_value = FakeInstrument(0, 'cpt', 'fa16', 'doma', '1m0a', '1M-SCICAM-SINISTRO')
+    assert header_can_be_processed(make_raw_header(), 'test.fits', FakeContext())
+    # Header-only checks do not need the database
+    mock_instrument.reset_mock()
+    assert not header_can_be_processed(make_raw_header(RLEVEL=91), 'test.fits', FakeContext())
+    assert not header_can_be_processed(make_raw_header(OBSTYPE='GUIDE'), 'test.fits', FakeContext())
+    assert not mock_instrument.called
+    mock_instrument.return_value = FakeInstrument(0, 'cpt', 'fa16', 'doma', '1m0a', 'NRES')
+    assert not header_can_be_processed(make_raw_header(), 'test.fits', FakeContext())
+    mock_instrument.return_value = None
+    assert not header_can_be_processed(make_raw_header(), 'test.fits', FakeContext())
@@ -0,0 +1,48 @@
+import os
+
+import mock
+import pytest
+
+from banzai.context import Context
+from banzai.utils import reprocessing_utils
+
+pytestmark = pytest.mark.reprocessing_utils
+
+
+def make_frames(directory, filenames):
+    os.makedirs(directory, exist_ok=True)
+    for filename in filenames:
+        open(os.path.join(directory, filename), 'w').close()
+
+
+def test_find_frames_in_directory(tmpdir):
+    make_frames(str(tmpdir), ['frame2.fits.fz', 'frame1.fits', 'notes.txt'])
+    assert reprocessing_utils.find_frames(directory=str(tmpdir)) == [os.path.join(str(tmpdir), 'frame1.fits'),
+                                                                      os.path.join(str(tmpdir), 'frame2.fits.fz')]
+
+
+def test_find_frames_with_glob_skips_duplicate_filenames(tmpdir):
+    make_frames(os.path.join(str(tmpdir), 'night1', 'raw'), ['frame1.fits.fz', 'frame2.fits.fz'])
+    make_frames(os.path.join(str(tmpdir), 'night2', 'raw'), ['frame1.fits.fz', 'frame3.fits.fz'])
+    paths = reprocessing_utils.find_frames(pattern=os.path.join(str(tmpdir), '**', '*.fits.fz'))
+    assert [os.path.basename(path) for path in paths] == ['frame1.fits.fz', 'frame2.fits.fz', 'frame3.fits.fz']
+
+
+@pytest.mark.parametrize('n_processes', [1, 2])
+@mock.patch('banzai.utils.reprocessing_utils.realtime_utils')
+@mock.patch('banzai.utils.reprocessing_utils.stage_utils.run_pipeline_stages')
+def test_reduce_frames(mock_run_stages, mock_realtime_utils, n_processes):
+    # Frames that were already reduced are skipped and failures do not stop the run
+    mock_realtime_utils.need_to_process_image.side_effect = lambda file_info, context: 'done' not in file_info['path']
+    mock_run_stages.side_effect = lambda file_infos, context: 1 / ('bad' not in file_infos[0]['path'])
+    paths = ['/data/frame1.fits', '/data/done.fits', '/data/bad.fits', '/data/frame2.fits']
+    summary = reprocessing_utils.reduce_frames(paths, Context({'db_address': 'sqlite:///test.db'}),
+                                               n_processes=n_processes)
+    assert summary['n_frames'] == 4
+    assert summary['n_reduced'] == 2
+    assert summary['n_skipped'] == 1
+    assert summary['n_failed'] == 1
+    assert summary['frames_per_hour'] > 0
+    if n_processes == 1:
+        assert [call[0][0] for call in mock_realtime_utils.set_file_as_processed.call_args_list] == \
+            ['/data/frame1.fits', '/data/frame2.fits']
@@ -51,12 +51,63 @@ def test_save_qc_results_no_post_to_elasticsearch_attribute():
     assert qc.save_qc_results(stage.runtime_context, {}, image) == {}
 
 
+@mock.patch('banzai.utils.qc.elasticsearch.helpers.bulk', return_value=(1, []))
 @mock.patch('banzai.utils.qc.elasticsearch.Elasticsearch')
-def test_save_qc_results(mock_es):
+def test_save_qc_results(mock_es, mock_bulk):
     context = FakeContext()
     image = FakeLCOObservationFrame([FakeCCDData(meta=test_header)])
     context.post_to_elasticsearch = True
     context.elasticsearch_url = '/'
     stage = FakeStage(context)
     qc.save_qc_results(stage.runtime_context, {}, image)
+    qc.close_qc_shipper()
     assert mock_es.called
+    assert mock_bulk.called
+
+
+def make_shipper(**kwargs):
+    with mock.patch('banzai.utils.qc.elasticsearch.Elasticsearch'):
+        return qc.QCShipper('/', 'banzai_qc', 'qc', **kwargs)
+
+
+@mock.patch('banzai.utils.qc.elasticsearch.helpers.bulk', return_value=(1, []))
+def test_qc_results_for_a_frame_are_merged(mock_bulk):
+    shipper = make_shipper(flush_interval=10.0)
+    shipper.add('frame1', {'header.bias': 1.0})
+    shipper.add('frame1', {'header.saturation': False})
+    shipper.add('frame2', {'header.bias': 2.0})
+    assert shipper.flush(timeout=5)
+    shipper.close()
+    actions = mock_bulk.call_args[0][1]
+    assert [action['_id'] for action in actions] == ['frame1', 'frame2']
+    assert actions[0]['doc'] == {'header.bias': 1.0, 'header.saturation': False}
+    assert actions[0]['doc_as_upsert']
+    assert shipper.stats()['qc.merged'] == 1
+
+
+def test_qc_results_are_retried_then_dropped():
+    errors = [{'update': {'_id': 'frame2', 'status': 500, 'error': 'Server error'}}]
+    with mock.patch('banzai.utils.qc.elasticsearch.helpers.bulk', side_effect=[(1, errors), (0, errors)]) as mock_bulk,\
+            mock.patch('banzai.utils.qc.time.sleep'):
+        shipper = make_shipper(max_retries=1)
+        shipper.add('frame1', {'header.bias': 1.0})
+        shipper.add('frame2', {'header.bias': 2.0})
+        assert shipper.flush(timeout=5)
+        shipper.close()
+    assert [action['_id'] for action in mock_bulk.call_args[0][1]] == ['frame2']
+    stats = shipper.stats()
+    assert stats['qc.sent'] == 1
+    assert stats['qc.retries'] == 1
+    assert stats['qc.dropped'] == 1
+
+
+def test_qc_results_are_dropped_when_the_queue_is_full():
+    with mock.patch('banzai.utils.qc.elasticsearch.helpers.bulk', return_value=(1, [])):
+        shipper = make_shipper(max_pending=1, flush_interval=10.0)
+        # Hold the shipper's lock so the results cannot be sent in the meantime
+        with shipper._condition:
+            shipper.add('frame1', {'header.bias': 1.0})
+            shipper.add('frame1', {'header.bias': 1.5})
+            shipper.add('frame2', {'header.bias': 2.0})
+        shipper.close()
+    assert shipper.stats()['qc.dropped'] == 1
@@ -1,3 +1,8 @@
+import os
+import subprocess
+import sys
+import textwrap
+
 import numpy as np
 import pytest
 
@@ -47,3 +52,52 @@ def test_stacking_with_different_pixels(set_random_seed):
     np.testing.assert_allclose(stacked_data.data, 4.0 * d)
     np.testing.assert_allclose(stacked_data.uncertainty, np.ones((ny, nx)))
     assert np.all(stacked_data.mask == 0)
+
+
+@pytest.mark.parametrize('max_tile_bytes', [10000, 500])
+def test_tiled_stacking_matches_single_tile(set_random_seed, max_tile_bytes):
+    nx, ny = 102, 105
+    test_data = [FakeCCDData(data=np.random.normal(0.0, 3.0, size=(ny, nx)),
+                             mask=(np.random.uniform(size=(ny, nx)) > 0.9).astype(np.uint8),
+                             uncertainty=np.random.uniform(1.0, 3.0, size=(ny, nx))) for i in range(11)]
+    # Add some outliers to reject
+    test_data[3].data[10:20, 10:20] = 1000.0
+
+    expected = stack(test_data, 3.0)
+    tiled = stack(test_data, 3.0, max_tile_bytes=max_tile_bytes)
+    np.testing.assert_allclose(tiled.data, expected.data)
+    np.testing.assert_allclose(tiled.uncertainty, expected.uncertainty)
+    np.testing.assert_array_equal(tiled.mask, expected.mask)
+
+
+def test_parallel_stacking_matches_serial(set_random_seed):
+    nx, ny = 102, 105
+    test_data = [FakeCCDData(data=np.random.normal(0.0, 3.0, size=(ny, nx)),
+                             mask=(np.random.uniform(size=(ny, nx)) > 0.9).astype(np.uint8),
+                             uncertainty=np.random.uniform(1.0, 3.0, size=(ny, nx))) for i in range(11)]
+    test_data[3].data[10:20, 10:20] = 1000.0
+
+    expected = stack(test_data, 3.0)
+    parallel = stack(test_data, 3.0, max_tile_bytes=100000, n_workers=3)
+    np.testing.assert_allclose(parallel.data, expected.data)
+    np.testing.assert_allclose(parallel.uncertainty, expected.uncertainty)
+    np.testing.assert_array_equal(parallel.mask, expected.mask)
+
+
+def test_parallel_stacking_after_openmp_in_the_parent():
+    # The OpenMP thread pool of the parent does not survive a fork, so workers forked from it that use it hang.
+    # Run this in a separate interpreter so a hang fails the test instead of the whole suite.
+    script = textwrap.dedent("""
+        import numpy as np
+        from banzai.data import stack
+        from banzai.tests.utils import FakeCCDData
+        from banzai.utils import median_utils
+
+        data = np.random.normal(0.0, 3.0, size=(5, 64, 64)).astype(np.float32)
+        median_utils.sigma_clipped_stack(data, np.ones_like(data), np.zeros(data.shape, dtype=np.uint8), 3.0)
+        test_data = [FakeCCDData(data=np.random.normal(0.0, 3.0, size=(105, 102)), mask=np.zeros((105, 102)),
+                                 uncertainty=np.ones((105, 102))) for i in range(5)]
+        stack(test_data, 3.0, max_tile_bytes=100000, n_workers=4)
+    """)
+    environment = dict(os.environ, OMP_NUM_THREADS='4', PYTHONPATH=os.pathsep.join(sys.path))
+    subprocess.run([sys.executable, '-c', script], env=environment, check=True, timeout=60)
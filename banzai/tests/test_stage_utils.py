@@ -0,0 +1,144 @@
+import threading
+
+import mock
+import pytest
+
+from banzai.context import Context
+from banzai.stages import Stage
+from banzai.utils import stage_utils
+
+pytestmark = pytest.mark.stage_utils
+
+
+class FakeFrame:
+    def __init__(self, filename, obstype='EXPOSE', events=None):
+        self.filename = filename
+        self.obstype = obstype
+        self.events = events
+        self.stages = []
+
+    def write(self, runtime_context):
+        self.events.append(('write', self.filename))
+
+
+class FakeFrameFactory:
+    events = None
+
+    def open(self, file_info, runtime_context):
+        self.events.append(('open', file_info['filename']))
+        if file_info.get('bad'):
+            return None
+        return FakeFrame(file_info['filename'], obstype=file_info.get('obstype', 'EXPOSE'), events=self.events)
+
+
+class PassThroughStage(Stage):
+    def do_stage(self, image):
+        image.stages.append(self.__class__.__name__)
+        image.events.append(('reduce', image.filename))
+        return image
+
+
+class FailingStage(Stage):
+    def do_stage(self, image):
+        raise ValueError('Failed to reduce')
+
+
+class StackingStage(Stage):
+    @property
+    def group_by_attributes(self):
+        return ['obstype']
+
+    def get_grouping(self, image):
+        return [image.obstype]
+
+    def do_stage(self, images):
+        images[0].events.append(('stack', [image.filename for image in images]))
+        return images[0]
+
+
+def make_context(**kwargs):
+    context = {'FRAME_FACTORY': 'banzai.tests.test_stage_utils.FakeFrameFactory',
+               'ORDERED_STAGES': ['banzai.tests.test_stage_utils.PassThroughStage'],
+               'LAST_STAGE': {'EXPOSE': None, 'BIAS': None, 'BAD': None},
+               'EXTRA_STAGES': {'EXPOSE': None, 'BIAS': ['banzai.tests.test_stage_utils.StackingStage'],
+                                'BAD': ['banzai.tests.test_stage_utils.FailingStage']},
+               'CALIBRATION_STACKER_STAGES': {'BIAS': ['banzai.tests.test_stage_utils.StackingStage']}}
+    context.update(kwargs)
+    return Context(context)
+
+
+@pytest.fixture
+def events():
+    FakeFrameFactory.events = []
+    yield FakeFrameFactory.events
+    FakeFrameFactory.events = None
+
+
+@pytest.mark.parametrize('depth', [0, 2])
+def test_frames_stream_through_the_pipeline(events, depth):
+    runtime_context = make_context(PIPELINE_PREFETCH_DEPTH=depth, PIPELINE_WRITE_DEPTH=depth)
+    stage_utils.run_pipeline_stages([{'filename': f'frame{i}.fits'} for i in range(5)], runtime_context)
+    writes = [filename for event, filename in events if event == 'write']
+    assert sorted(writes) == [f'frame{i}.fits' for i in range(5)]
+    # Frames are not held until the end: the first one is written before the later ones are reduced
+    assert events.index(('write', 'frame0.fits')) < events.index(('reduce', 'frame3.fits'))
+
+
+def test_prefetch_is_bounded(events):
+    runtime_context = make_context(PIPELINE_PREFETCH_DEPTH=2, PIPELINE_PREFETCH_WORKERS=4)
+    file_infos = [{'filename': f'frame{i}.fits'} for i in range(10)]
+    for i, image in enumerate(stage_utils._open_images(FakeFrameFactory(), file_infos, runtime_context)):
+        assert image.filename == f'frame{i}.fits'
+        # The frame being reduced plus at most two read ahead
+        assert len(events) <= i + 3
+
+
+def test_grouped_stages_are_barriers(events):
+    runtime_context = make_context(PIPELINE_PREFETCH_DEPTH=2, PIPELINE_WRITE_DEPTH=2)
+    file_infos = [{'filename': 'bias1.fits', 'obstype': 'BIAS'}, {'filename': 'science1.fits'},
+                  {'filename': 'bias2.fits', 'obstype': 'BIAS'}, {'filename': 'bad.fits', 'bad': True}]
+    stage_utils.run_pipeline_stages(file_infos, runtime_context)
+    assert ('stack', ['bias1.fits', 'bias2.fits']) in events
+    # The science frame does not wait for the biases
+    assert events.index(('reduce', 'science1.fits')) < events.index(('stack', ['bias1.fits', 'bias2.fits']))
+    assert sorted(filename for event, filename in events if event == 'write') == ['bias1.fits', 'science1.fits']
+
+
+def test_calibration_maker(events):
+    runtime_context = make_context()
+    stage_utils.run_pipeline_stages([{'filename': 'bias1.fits', 'obstype': 'BIAS'},
+                                     {'filename': 'bias2.fits', 'obstype': 'BIAS'}], runtime_context,
+                                    calibration_maker=True)
+    assert ('stack', ['bias1.fits', 'bias2.fits']) in events
+    assert ('reduce', 'bias1.fits') not in events
+
+
+def test_failed_frames_are_not_written(events):
+    runtime_context = make_context(PIPELINE_WRITE_DEPTH=2)
+    stage_utils.run_pipeline_stages([{'filename': 'bad.fits', 'obstype': 'BAD'}, {'filename': 'good.fits'}],
+                                    runtime_context)
+    assert [filename for event, filename in events if event == 'write'] == ['good.fits']
+
+
+def test_write_errors_are_raised():
+    runtime_context = make_context(PIPELINE_WRITE_DEPTH=2)
+    image = mock.MagicMock()
+    image.write.side_effect = IOError('Disk full')
+    with pytest.raises(IOError):
+        with stage_utils.ImageWriter(runtime_context) as image_writer:
+            image_writer.write(image)
+
+
+def test_writes_happen_in_the_background():
+    runtime_context = make_context(PIPELINE_WRITE_DEPTH=2)
+    write_started = threading.Event()
+    release_write = threading.Event()
+    image = mock.MagicMock()
+    image.write.side_effect = lambda runtime_context: write_started.set() or release_write.wait(5)
+    with stage_utils.ImageWriter(runtime_context) as image_writer:
+        image_writer.write(image)
+        assert write_started.wait(5)
+        # We got control back while the write is still going
+        assert not release_write.is_set()
+        release_write.set()
+    assert image.write.called
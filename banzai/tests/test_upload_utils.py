@@ -0,0 +1,168 @@
+import io
+import os
+import time
+
+import mock
+import pytest
+from ocs_ingester.exceptions import DoNotRetryError, RetryError
+
+from banzai.utils import file_utils, upload_utils
+from banzai.tests.utils import FakeContext
+
+pytestmark = pytest.mark.upload_utils
+
+
+def make_spool(tmpdir, contents=b'frame', calibration=False):
+    spool = upload_utils.UploadSpool(str(tmpdir.join('spool')))
+    frame_path = str(tmpdir.join('test_image_91.fits.fz'))
+    with open(frame_path, 'wb') as frame_file:
+        frame_file.write(contents)
+    entry_id = spool.add(frame_path, '/archive/cpt/fa16/20160101/processed/test_image_91.fits.fz',
+                         calibration=calibration)
+    return spool, entry_id
+
+
+def make_context(**kwargs):
+    return FakeContext(UPLOAD_MAX_TRIES=3, UPLOAD_BACKOFF_BASE=10.0, UPLOAD_BACKOFF_MAX=60.0, **kwargs)
+
+
+def test_add_to_spool(tmpdir):
+    spool, entry_id = make_spool(tmpdir)
+    assert spool.entries() == [entry_id]
+    assert spool.due_entries() == [entry_id]
+    with open(spool.data_path(entry_id), 'rb') as data_file:
+        assert data_file.read() == b'frame'
+    manifest = spool.read_manifest(entry_id)
+    assert manifest['output_filename'] == '/archive/cpt/fa16/20160101/processed/test_image_91.fits.fz'
+    assert manifest['tries'] == 0
+    assert manifest['frameid'] is None
+    # No temporary files should be left behind
+    assert sorted(os.listdir(spool.pending_directory)) == [entry_id, entry_id + '.json']
+
+
+def test_entries_are_in_the_order_they_were_added(tmpdir):
+    spool, first_entry_id = make_spool(tmpdir)
+    _, second_entry_id = make_spool(tmpdir)
+    assert spool.entries() == [first_entry_id, second_entry_id]
+
+
+@mock.patch('banzai.utils.upload_utils.ingester.upload_file_and_ingest_to_archive', return_value={'frameid': 1234})
+def test_upload_entry(mock_upload, tmpdir):
+    spool, entry_id = make_spool(tmpdir)
+    assert upload_utils.upload_entry(spool, entry_id, make_context()) == upload_utils.UPLOADED
+    assert mock_upload.call_args[1]['path'] == '/archive/cpt/fa16/20160101/processed/test_image_91.fits.fz'
+    assert spool.entries() == []
+    assert os.listdir(spool.pending_directory) == []
+
+
+@mock.patch('banzai.utils.upload_utils.ingester.upload_file_and_ingest_to_archive',
+            side_effect=RetryError('Archive is down'))
+def test_failed_upload_is_retried_later(mock_upload, tmpdir):
+    spool, entry_id = make_spool(tmpdir)
+    assert upload_utils.upload_entry(spool, entry_id, make_context()) == upload_utils.RETRY
+    manifest = spool.read_manifest(entry_id)
+    assert manifest['tries'] == 1
+    assert manifest['error'] == 'Archive is down'
+    # The first delay is between half and all of the base delay
+    assert time.time() + 4.0 < manifest['next_attempt'] <= time.time() + 10.0
+    assert spool.due_entries() == []
+
+
+@mock.patch('banzai.utils.upload_utils.ingester.upload_file_and_ingest_to_archive',
+            side_effect=Exception('Unexpected'))
+def test_upload_goes_to_dead_letters_after_max_tries(mock_upload, tmpdir):
+    spool, entry_id = make_spool(tmpdir)
+    context = make_context()
+    for _ in range(context.UPLOAD_MAX_TRIES - 1):
+        assert upload_utils.upload_entry(spool, entry_id, context) == upload_utils.RETRY
+    assert upload_utils.upload_entry(spool, entry_id, context) == upload_utils.DEAD_LETTER
+    assert mock_upload.call_count == context.UPLOAD_MAX_TRIES
+    assert spool.entries() == []
+    assert spool.dead_letters() == [entry_id]
+
+    assert spool.requeue_dead_letters() == 1
+    assert spool.due_entries() == [entry_id]
+    assert spool.read_manifest(entry_id)['tries'] == 0
+    with open(spool.data_path(entry_id), 'rb') as data_file:
+        assert data_file.read() == b'frame'
+
+
+@mock.patch('banzai.utils.upload_utils.ingester.upload_file_and_ingest_to_archive',
+            side_effect=DoNotRetryError('Bad file'))
+def test_rejected_upload_goes_to_dead_letters(mock_upload, tmpdir):
+    spool, entry_id = make_spool(tmpdir)
+    assert upload_utils.upload_entry(spool, entry_id, make_context()) == upload_utils.DEAD_LETTER
+    assert mock_upload.call_count == 1
+    assert spool.dead_letters() == [entry_id]
+    assert spool.read_manifest(entry_id, directory=spool.dead_letter_directory)['error'] == 'Bad file'
+
+
+@mock.patch('banzai.utils.upload_utils.dbs.save_frame_id')
+@mock.patch('banzai.utils.upload_utils.ingester.upload_file_and_ingest_to_archive', return_value={'frameid': 1234})
+def test_calibration_frame_id_is_saved(mock_upload, mock_save_frame_id, tmpdir):
+    spool, entry_id = make_spool(tmpdir, calibration=True)
+    context = make_context()
+    # The reduction worker has not saved the calibration record yet
+    mock_save_frame_id.return_value = 0
+    assert upload_utils.upload_entry(spool, entry_id, context) == upload_utils.RETRY
+    assert spool.read_manifest(entry_id)['frameid'] == 1234
+    assert not os.path.exists(spool.data_path(entry_id))
+
+    mock_save_frame_id.return_value = 1
+    assert upload_utils.upload_entry(spool, entry_id, context) == upload_utils.UPLOADED
+    # The frame is only posted once
+    assert mock_upload.call_count == 1
+    mock_save_frame_id.assert_called_with('test_image_91.fits.fz', 1234, context.db_address)
+    assert spool.entries() == []
+
+
+@mock.patch('banzai.utils.upload_utils.ingester.upload_file_and_ingest_to_archive', return_value={'frameid': 1234})
+def test_uploader_run_once(mock_upload, tmpdir):
+    spool, _ = make_spool(tmpdir)
+    make_spool(tmpdir)
+    counts = upload_utils.Uploader(spool, make_context(), n_workers=2).run_once()
+    assert counts[upload_utils.UPLOADED] == 2
+    assert mock_upload.call_count == 2
+    assert spool.entries() == []
+
+
+@mock.patch('banzai.utils.upload_utils.ingester.upload_file_and_ingest_to_archive')
+def test_only_one_uploader_per_spool(mock_upload, tmpdir):
+    spool, entry_id = make_spool(tmpdir)
+    with spool.lock():
+        counts = upload_utils.Uploader(spool, make_context()).run_once()
+    assert not mock_upload.called
+    assert spool.entries() == [entry_id]
+    assert counts[upload_utils.UPLOADED] == 0
+
+
+@mock.patch('banzai.utils.file_utils.sleep')
+@mock.patch('banzai.utils.file_utils.ingester.upload_file_and_ingest_to_archive')
+def test_post_to_ingester_gives_up_on_unexpected_errors(mock_upload, mock_sleep):
+    mock_upload.side_effect = Exception('Unexpected')
+    assert file_utils.post_to_ingester(io.BytesIO(b'frame'), None, 'test.fits', max_tries=3, backoff_base=1.0,
+                                       backoff_max=1.5) == {}
+    assert mock_upload.call_count == 3
+    assert mock_sleep.call_count == 2
+    assert all(0.5 <= args[0] <= 1.5 for args, _ in mock_sleep.call_args_list)
+
+
+@mock.patch('banzai.utils.file_utils.sleep')
+@mock.patch('banzai.utils.file_utils.ingester.upload_file_and_ingest_to_archive')
+def test_post_to_ingester_retries_from_the_start_of_the_file(mock_upload, mock_sleep):
+    uploaded = []
+
+    def upload(file_object, path):
+        uploaded.append(file_object.read())
+        if len(uploaded) == 1:
+            raise RetryError('Connection reset')
+        return {'frameid': 1234}
+    mock_upload.side_effect = upload
+    assert file_utils.post_to_ingester(io.BytesIO(b'frame'), None, 'test.fits') == {'frameid': 1234}
+    assert uploaded == [b'frame', b'frame']
+
+
+def test_backoff_delay_is_capped():
+    for try_number in range(1, 20):
+        delay = file_utils.backoff_delay(try_number, base=5.0, maximum=60.0)
+        assert min(60.0, 5.0 * 2 ** (try_number - 1)) / 2.0 <= delay <= 60.0
@@ -43,6 +43,7 @@ class FakeCCDData(CCDData):
             self.uncertainty = self.read_noise * np.ones(self.data.shape, dtype=self.data.dtype)
         else:
             self.uncertainty = uncertainty
+        self.memmap = False
 
         for keyword in kwargs:
             setattr(self, keyword, kwargs[keyword])
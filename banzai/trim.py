@@ -13,7 +13,9 @@ class Trimmer(Stage):
         # TODO: this enumeration might not actually work, add a replace method in the image class
         data_to_replace = []
         for i, data in enumerate(image.ccd_hdus):
-            trimmed_data = data.trim()
+            # The untrimmed data is thrown away, so the trimmed data can take over its buffers instead of copying them
+            trimmed_data = data.trim(copy=False)
+            trimmed_data.detach()
             data_to_replace.append((data, trimmed_data))
 
         for old_data, trimmed_data in data_to_replace:
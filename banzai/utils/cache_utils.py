@@ -0,0 +1,289 @@
+"""
+cache_utils.py: Caches for files downloaded from the archive and for opened master calibrations.
+
+    Downloaded files are stored on disk under a key made from their frame id (and md5 when we know it)
+    so that every worker on a node shares one copy of each master calibration. Opened master
+    calibration frames are kept in memory in each worker so they do not have to be read and decoded
+    for every science frame. Both caches are capped in size and evict the least recently used entries first.
+"""
+import copy
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger('banzai')
+
+LOCK_FILENAME = '.lock'
+TEMPORARY_PREFIX = '.'
+
+
+def file_info_to_key(file_info: dict) -> Optional[str]:
+    """
+    Make the cache key for a file record
+
+    Parameters
+    ----------
+    file_info : dict
+                File record from the archive or the calibration database
+
+    Returns
+    -------
+    key : str
+          None if the file does not have a frame id
+    """
+    frame_id = file_info.get('frameid')
+    if frame_id is None:
+        return None
+    key = str(frame_id)
+    version_set = file_info.get('version_set')
+    if version_set and version_set[0].get('md5'):
+        key += '-' + version_set[0]['md5']
+    return key
+
+
+class DownloadCache:
+    """
+    Least recently used cache of files on disk that can be shared between processes
+
+    Parameters
+    ----------
+    directory : str
+                Directory to keep the cached files in. It is created if it does not exist.
+    max_bytes : int
+                Total size of the files to keep. The least recently used files are removed when
+                the cache grows beyond this.
+
+    Notes
+    -----
+    Files are written to a temporary name and renamed into place so other processes never see a partial file.
+    Hits update the file's modification time, which is what eviction uses to find the least recently used files.
+    Eviction holds an exclusive lock on a lock file in the cache directory.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def open(self, key):
+        """
+        Get a read-only file handle to a cached file, or None if the file is not in the cache
+        """
+        path = self._path(key)
+        try:
+            cached_file = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # We were evicted in the meantime, but the open handle keeps the file around until we are done
+            pass
+        logger.debug(f'Found {key} in the download cache')
+        return cached_file
+
+    def store(self, key, write_function):
+        """
+        Add a file to the cache
+
+        Parameters
+        ----------
+        key : str
+              Cache key for the file
+        write_function : callable
+                         Called with a writable binary file handle to write the contents of the file
+
+        Returns
+        -------
+        cached_file : file
+                      Read-only file handle to the cached file. It stays valid even if the file is evicted.
+        """
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, prefix=TEMPORARY_PREFIX)
+        try:
+            with os.fdopen(file_descriptor, 'w+b') as output_file:
+                write_function(output_file)
+            cached_file = open(temporary_path, 'rb')
+            os.replace(temporary_path, self._path(key))
+        except Exception:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        self.evict()
+        return cached_file
+
+    def evict(self):
+        """Remove the least recently used files until the cache is under its size limit"""
+        with open(os.path.join(self.directory, LOCK_FILENAME), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                cached_files = []
+                with os.scandir(self.directory) as directory_entries:
+                    for entry in directory_entries:
+                        # Skip the lock file and files that are still being written
+                        if entry.name.startswith(TEMPORARY_PREFIX) or not entry.is_file():
+                            continue
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        cached_files.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size = sum(size for _, size, _ in cached_files)
+                for _, size, path in sorted(cached_files):
+                    if total_size <= self.max_bytes:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total_size -= size
+                    logger.debug(f'Evicted {os.path.basename(path)} from the download cache')
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_download_cache(runtime_context) -> Optional[DownloadCache]:
+    """
+    Get the download cache configured in the runtime context, or None if caching is turned off
+    """
+    directory = getattr(runtime_context, 'DOWNLOAD_CACHE_DIRECTORY', None)
+    if not directory:
+        return None
+    return DownloadCache(directory, getattr(runtime_context, 'DOWNLOAD_CACHE_MAX_BYTES', 0))
+
+
+def master_calibration_key(file_info: dict) -> Optional[tuple]:
+    """
+    Make the in-memory cache key for a master calibration record
+
+    Returns None if there is nothing to tell different versions of the file apart (neither a frame id nor a file on disk),
+    in which case the frame should not be cached.
+    """
+    frame_id = file_info.get('frameid')
+    path = file_info.get('path')
+    file_stats = None
+    if path is not None:
+        try:
+            stat = os.stat(path)
+            file_stats = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            pass
+    if frame_id is None and file_stats is None:
+        return None
+    return file_info.get('filename'), frame_id, file_stats
+
+
+def _frame_nbytes(frame) -> int:
+    nbytes = 0
+    for hdu in frame._hdus:
+        for array_name in ['data', 'mask', '_uncertainty']:
+            array = getattr(hdu, array_name, None)
+            if isinstance(array, np.ndarray):
+                nbytes += array.nbytes
+    return nbytes
+
+
+def _make_read_only(frame):
+    for hdu in frame._hdus:
+        if hasattr(hdu, '_share_buffers'):
+            hdu._share_buffers()
+        elif isinstance(getattr(hdu, 'data', None), np.ndarray):
+            hdu.data.flags.writeable = False
+
+
+def _shared_copy(frame):
+    """
+    Make a shallow copy of a frame whose extensions share the (read-only) arrays of the original but have their
+    own headers. CCDData extensions copy the shared arrays on the first write, so the copy can be modified
+    without changing the original.
+    """
+    frame_copy = copy.copy(frame)
+    frame_copy._hdus = []
+    for hdu in frame._hdus:
+        hdu_copy = copy.copy(hdu)
+        hdu_copy.meta = hdu.meta.copy()
+        if hasattr(hdu_copy, '_share_buffers'):
+            hdu_copy._shares_buffers = True
+        frame_copy._hdus.append(hdu_copy)
+    return frame_copy
+
+
+class MasterCalibrationCache:
+    """
+    Least recently used, in-memory cache of opened master calibration frames
+
+    Parameters
+    ----------
+    max_bytes : int
+                Total size of the arrays to keep in the cache. 0 turns the cache off.
+
+    Notes
+    -----
+    The cache keeps its own shallow copy of each frame and get returns a new shallow copy every time, so one science
+    frame cannot change the master that the next one uses. The copies share the cached arrays, which are made
+    read-only; CCDData extensions copy them on the first write and every copy has its own headers.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._frames:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._frames.move_to_end(key)
+            return _shared_copy(self._frames[key][0])
+
+    def add(self, key, frame):
+        nbytes = _frame_nbytes(frame)
+        if nbytes > self.max_bytes:
+            return
+        _make_read_only(frame)
+        with self._lock:
+            if key in self._frames:
+                self._nbytes -= self._frames.pop(key)[1]
+            self._frames[key] = _shared_copy(frame), nbytes
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._frames.popitem(last=False)
+                self._nbytes -= evicted_nbytes
+
+    def invalidate(self, filename):
+        """Remove every cached version of a file"""
+        with self._lock:
+            for key in [key for key in self._frames if key[0] == filename]:
+                self._nbytes -= self._frames.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._frames = OrderedDict()
+            self._nbytes = 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+
+_master_calibration_cache = MasterCalibrationCache(0)
+
+
+def get_master_calibration_cache(runtime_context=None) -> MasterCalibrationCache:
+    """
+    Get this process's master calibration cache, resizing it to the budget in the runtime context if one is given
+    """
+    if runtime_context is not None:
+        _master_calibration_cache.max_bytes = getattr(runtime_context, 'MASTER_CALIBRATION_CACHE_BYTES', 0)
+    return _master_calibration_cache
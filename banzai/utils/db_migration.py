@@ -1,7 +1,7 @@
 import argparse
 import logging
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, func, MetaData, Table
 from sqlalchemy import Column, Integer, String, Date, ForeignKey, Boolean, CHAR
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -155,3 +155,85 @@ def migrate_db():
         add_rows(new_db_session, dbs.ProcessedImage, preview_images)
 
         logger.info("Finished")
+
+
+def _index_names(engine, table_name):
+    return {index['name'] for index in inspect(engine).get_indexes(table_name)}
+
+
+def add_master_search_index(db_address):
+    """
+    Add the index that get_master_cal_record searches on to a calimages table made before 1.2.0
+
+    Notes
+    -----
+    create_all only adds indexes when it creates a table, so existing databases need this run once.
+    """
+    engine, _ = dbs.get_engine(db_address)
+    index = next(index for index in dbs.CalibrationImage.__table__.indexes
+                 if index.name == 'ix_calimages_master_search')
+    if index.name in _index_names(engine, dbs.CalibrationImage.__tablename__):
+        logger.info(f'Index {index.name} already exists')
+        return
+    logger.info(f'Creating index {index.name}')
+    index.create(engine)
+
+
+def make_processed_image_filenames_unique(db_address):
+    """
+    Remove duplicate rows from a processedimages table made before 1.2.0 and make its filename index unique
+
+    Notes
+    -----
+    For each file with more than one row, we keep a successful row if there is one, otherwise the row with
+    the most tries. The bulk bookkeeping in dbs upserts on the filename, which needs the unique index.
+    """
+    engine, _ = dbs.get_engine(db_address)
+    if dbs.processed_image_filenames_are_unique(engine):
+        logger.info('Filenames in the processedimages table are already unique')
+        return
+    table = dbs.ProcessedImage.__table__
+    with dbs.get_session(db_address=db_address) as db_session:
+        duplicated_filenames = [row.filename for row in db_session.query(dbs.ProcessedImage.filename)
+                                .group_by(dbs.ProcessedImage.filename).having(func.count() > 1)]
+        logger.info(f'Removing the duplicate rows of {len(duplicated_filenames)} files from the processedimages table')
+        for filename in duplicated_filenames:
+            rows = db_session.query(dbs.ProcessedImage).filter(dbs.ProcessedImage.filename == filename)\
+                .order_by(dbs.ProcessedImage.success.desc(), dbs.ProcessedImage.tries.desc(),
+                          dbs.ProcessedImage.id).all()
+            db_session.query(dbs.ProcessedImage).filter(dbs.ProcessedImage.id.in_([row.id for row in rows[1:]]))\
+                .delete(synchronize_session=False)
+        db_session.commit()
+    index = next(index for index in table.indexes if list(index.columns) == [table.c.filename])
+    # Replace the old index with a unique one of the same name
+    existing_table = Table(table.name, MetaData(), autoload_with=engine)
+    for existing_index in existing_table.indexes:
+        if existing_index.name == index.name:
+            existing_index.drop(engine)
+    logger.info(f'Creating unique index {index.name}')
+    index.create(engine)
+
+
+def upgrade_schema(db_address):
+    """
+    Bring the tables of a database made by an earlier version of banzai up to date
+
+    Every step checks whether it has already been done, so this is safe to run more than once.
+    """
+    add_master_search_index(db_address)
+    make_processed_image_filenames_unique(db_address)
+
+
+def upgrade_db():
+    parser = argparse.ArgumentParser("Add the indexes and constraints that newer versions of banzai need "
+                                     "to an existing database.")
+    parser.add_argument('--db-address', dest='db_address', default='sqlite:///test.db',
+                        help='Database address: Should be in SQLAlchemy form')
+    parser.add_argument("--log-level", default='debug', choices=['debug', 'info', 'warning',
+                                                                 'critical', 'fatal', 'error'])
+    args = parser.parse_args()
+
+    logs.set_log_level(args.log_level)
+    logger.info("Upgrading the database schema")
+    upgrade_schema(args.db_address)
+    logger.info("Finished")
@@ -1,5 +1,9 @@
 import hashlib
 import logging
+import os
+import random
+import threading
+from collections import OrderedDict
 from time import sleep
 
 from ocs_ingester import ingester
@@ -19,45 +23,120 @@ def post_to_archive_queue(image_path, broker_url, exchange_name='fits_files'):
         producer.release()
 
 
-def post_to_ingester(file_object, image, output_filename):
+def backoff_delay(try_number, base=5.0, maximum=600.0):
+    """
+    Time to wait in seconds before the next try: exponential backoff with jitter so that many workers that failed
+    at the same time do not all retry at the same time
+
+    Parameters
+    ----------
+    try_number : int
+                 Number of tries so far
+    base : float
+           Delay after the first try
+    maximum : float
+              Longest delay
+    """
+    delay = min(maximum, base * 2 ** (try_number - 1))
+    return delay / 2.0 + random.uniform(0.0, delay / 2.0)
+
+
+def post_to_ingester(file_object, image, output_filename, max_tries=5, backoff_base=5.0, backoff_max=600.0):
     logger.info(f'Posting file to the archive', image=image)
-    retry = True
-    try_counter = 1
-    ingester_response = {}
-    while retry:
+    for try_number in range(1, max_tries + 1):
+        # Start from the beginning of the file if an earlier try read some of it
+        file_object.seek(0)
         try:
             ingester_response = ingester.upload_file_and_ingest_to_archive(file_object, path=output_filename)
             logger.debug(f"Ingester response: {ingester_response}", image=image)
-            retry = False
+            return ingester_response
         except DoNotRetryError as exc:
             logger.warning('Exception occured: {0}. Aborting.'.format(exc), image=image)
-            retry = False
+            return {}
         except NonFatalDoNotRetryError as exc:
             logger.debug('Non-fatal Exception occured: {0}. Aborting.'.format(exc), image=image)
-            retry = False
-        except RetryError as exc:
+            return {}
+        except (RetryError, BackoffRetryError) as exc:
             logger.debug('Retry Exception occured: {0}. Retrying.'.format(exc), image=image)
-            retry = True
-            try_counter += 1
-        except BackoffRetryError as exc:
-            logger.debug('BackoffRetry Exception occured: {0}. Retrying.'.format(exc), image=image)
-            if try_counter > 5:
-                logger.warning('Giving up because we tried too many times.', image=image)
-                retry = False
-            else:
-                sleep(5 ** try_counter)
-                retry = True
-                try_counter += 1
         except Exception as exc:
-            logger.fatal('Unexpected exception: {0} Will retry.'.format(exc), image=image)
-            retry = True
-            try_counter += 1
-    return ingester_response
-
-
-def get_md5(filepath):
+            logger.error('Unexpected exception: {0} Will retry.'.format(exc), image=image)
+        if try_number < max_tries:
+            sleep(backoff_delay(try_number, base=backoff_base, maximum=backoff_max))
+    logger.warning('Giving up because we tried too many times.', image=image)
+    return {}
+
+
+class HashingWriter:
+    """
+    Writable file wrapper that computes the md5 of everything written through it, so a file does not have to be
+    read back to hash it
+    """
+    def __init__(self, file_object):
+        self.file_object = file_object
+        self._md5 = hashlib.md5()
+
+    def write(self, data):
+        self._md5.update(data)
+        return self.file_object.write(data)
+
+    def tell(self):
+        return self.file_object.tell()
+
+    def flush(self):
+        self.file_object.flush()
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+
+# Size of the blocks that files are read in to hash them
+MD5_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Number of files whose md5 we remember in each process
+MD5_CACHE_MAX_ENTRIES = 10000
+
+# md5s of the files we have hashed, keyed by path, along with the size, modification time, and inode of the file
+# when it was hashed
+_md5_cache = OrderedDict()
+_md5_cache_lock = threading.Lock()
+
+
+def _file_stats(filepath):
+    stat = os.stat(filepath)
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def get_md5(filepath, use_cache=False):
+    """
+    Get the md5 of a file, reading it a block at a time
+
+    Parameters
+    ----------
+    filepath : str
+               Path to the file
+    use_cache : bool
+                Use the md5 from the last time this process hashed the file if its size, modification time, and inode
+                have not changed since
+    """
+    if use_cache:
+        file_stats = _file_stats(filepath)
+        with _md5_cache_lock:
+            cached = _md5_cache.get(filepath)
+            if cached is not None and cached[0] == file_stats:
+                _md5_cache.move_to_end(filepath)
+                return cached[1]
+    md5_hash = hashlib.md5()
     with open(filepath, 'rb') as file:
-        md5 = hashlib.md5(file.read()).hexdigest()
+        for chunk in iter(lambda: file.read(MD5_CHUNK_SIZE), b''):
+            md5_hash.update(chunk)
+    md5 = md5_hash.hexdigest()
+    # Only remember the md5 if the file did not change while we were reading it
+    if use_cache and _file_stats(filepath) == file_stats:
+        with _md5_cache_lock:
+            _md5_cache[filepath] = file_stats, md5
+            _md5_cache.move_to_end(filepath)
+            while len(_md5_cache) > MD5_CACHE_MAX_ENTRIES:
+                _md5_cache.popitem(last=False)
     return md5
 
 
@@ -4,19 +4,38 @@ import requests
 from collections import OrderedDict
 
 from banzai import logs
+from banzai.utils import cache_utils
 
 import numpy as np
 from astropy.io import fits
 from astropy.coordinates import SkyCoord
 from astropy import units
 from tenacity import retry, wait_exponential, stop_after_attempt
-import io
+import multiprocessing
 import os
+import tempfile
+import time
+from io import BytesIO
 
 logger = logging.getLogger('banzai')
 
 FITS_MANDATORY_KEYWORDS = ['SIMPLE', 'BITPIX', 'NAXIS', 'EXTEND', 'COMMENT', 'CHECKSUM', 'DATASUM']
 
+# Size of the pieces we write to disk while downloading a file
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+FITS_BLOCK_SIZE = 2880
+
+# Number of bytes of image data to convert and write at a time
+WRITE_BLOCK_BYTES = 4 * 1024 * 1024
+
+# Compression settings for fpacked output
+QUANTIZE_LEVEL = 64
+DITHER_SEED = 2048
+
+# Values of the ZQUANTIZ keyword in compressed image headers
+QUANTIZE_METHODS = {'NO_DITHER': -1, 'SUBTRACTIVE_DITHER_1': 1, 'SUBTRACTIVE_DITHER_2': 2}
+
 
 def sanitize_header(header):
     # Remove the mandatory keywords from a header so it can be copied to a new
@@ -90,7 +109,13 @@ def get_primary_header(filename) -> Optional[fits.Header]:
 # Stop after 4 attempts, and back off exponentially with a minimum wait time of 4 seconds, and a maximum of 10.
 # If it fails after 4 attempts, "reraise" the original exception back up to the caller.
 @retry(wait=wait_exponential(multiplier=2, min=4, max=10), stop=stop_after_attempt(4), reraise=True)
-def download_from_s3(file_info, context, is_raw_frame=False):
+def download_from_s3(file_info, context, is_raw_frame=False, output_file=None):
+    """
+    Download a file from the archive
+
+    If output_file is given, the file is written into it (after truncating it) and it is returned. Otherwise the file
+    is streamed to a temporary file and a read-only handle to it is returned.
+    """
     frame_id = file_info.get('frameid')
 
     logger.info(f"Downloading file {file_info.get('filename')} from archive. ID: {frame_id}.",
@@ -104,12 +129,31 @@ def download_from_s3(file_info, context, is_raw_frame=False):
         url = f'{context.ARCHIVE_FRAME_URL}/{frame_id}'
         archive_auth_header = context.ARCHIVE_AUTH_HEADER
     response = requests.get(url, headers=archive_auth_header).json()
-    buffer = io.BytesIO()
-    buffer.write(requests.get(response['url'], stream=True).content)
+    if output_file is not None:
+        # Start from scratch if this is a retry
+        output_file.seek(0)
+        output_file.truncate()
+        _stream_to_file(response['url'], output_file)
+        return output_file
+
+    # Stream the file to disk rather than holding it in memory so that it can be memory mapped when we open it
+    with tempfile.TemporaryFile() as output_file:
+        _stream_to_file(response['url'], output_file)
+        # Hand back a read-only handle so that astropy opens the file in readonly mode.
+        # The file is already unlinked, so it goes away when this handle is closed.
+        buffer = os.fdopen(os.dup(output_file.fileno()), 'rb')
     buffer.seek(0)
     return buffer
 
 
+def _stream_to_file(url, output_file):
+    with requests.get(url, stream=True) as file_response:
+        file_response.raise_for_status()
+        for chunk in file_response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            output_file.write(chunk)
+    output_file.flush()
+
+
 def get_configuration_mode(header):
     configuration_mode = header.get('CONFMODE', 'default')
     # If the configuration mode is not in the header, fallback to default to support legacy data
@@ -126,13 +170,25 @@ def open_fits_file(file_info, context, is_raw_frame=False):
         filename = os.path.basename(file_info.get('path'))
         frame_id = None
     elif file_info.get('frameid') is not None:
-        buffer = download_from_s3(file_info, context, is_raw_frame=is_raw_frame)
+        download_cache = cache_utils.get_download_cache(context)
+        if download_cache is None:
+            buffer = download_from_s3(file_info, context, is_raw_frame=is_raw_frame)
+        else:
+            cache_key = cache_utils.file_info_to_key(file_info)
+            buffer = download_cache.open(cache_key)
+            if buffer is None:
+                buffer = download_cache.store(cache_key,
+                                              lambda output_file: download_from_s3(file_info, context,
+                                                                                   is_raw_frame=is_raw_frame,
+                                                                                   output_file=output_file))
         filename = file_info.get('filename')
         frame_id = file_info.get('frameid')
     else:
         raise ValueError('This file does not exist and there is no frame id to get it from S3.')
 
-    hdu_list = fits.open(buffer, memmap=False)
+    # The buffer is always a file on disk so we memory map it. Compressed extensions are decompressed straight into
+    # their data arrays and uncompressed extensions are only read in when they are used.
+    hdu_list = fits.open(buffer, memmap=True)
     uncompressed_hdu_list = unpack(hdu_list)
     hdu_list.close()
     buffer.close()
@@ -175,7 +231,8 @@ def unpack(compressed_hdulist: fits.HDUList) -> fits.HDUList:
                 data_type = getattr(np, 'u' + data_type)
                 data = np.array(hdu.data, data_type)
             else:
-                data = np.array(hdu.data, hdu.data.dtype)
+                # Decompressing already makes a new array, so there is no need to copy it again
+                data = hdu.data
             header = hdu.header
             hdulist.append(fits.ImageHDU(data=data, header=header))
         elif isinstance(hdu, fits.BinTableHDU):
@@ -192,20 +249,203 @@ def pack(uncompressed_hdulist: fits.HDUList) -> fits.HDUList:
     else:
         primary_hdu = fits.PrimaryHDU()
         compressed_hdu = fits.CompImageHDU(data=np.ascontiguousarray(uncompressed_hdulist[0].data),
-                                           header=uncompressed_hdulist[0].header, quantize_level=64,
-                                           dither_seed=2048, quantize_method=1)
+                                           header=uncompressed_hdulist[0].header, quantize_level=QUANTIZE_LEVEL,
+                                           dither_seed=DITHER_SEED, quantize_method=1)
         hdulist = [primary_hdu, compressed_hdu]
 
     for hdu in uncompressed_hdulist[1:]:
         if isinstance(hdu, fits.ImageHDU):
             compressed_hdu = fits.CompImageHDU(data=np.ascontiguousarray(hdu.data), header=hdu.header,
-                                               quantize_level=64, quantize_method=1)
+                                               quantize_level=QUANTIZE_LEVEL, quantize_method=1)
             hdulist.append(compressed_hdu)
         else:
             hdulist.append(hdu)
     return fits.HDUList(hdulist)
 
 
+def _extension_to_bytes(hdu, output_verify='silentfix') -> bytes:
+    """
+    Write a single extension (header, data, and padding) exactly as it would be written as part of a file
+    """
+    with BytesIO() as buffer:
+        fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(buffer, output_verify=output_verify)
+        # The empty primary HDU is a single header block
+        return buffer.getvalue()[FITS_BLOCK_SIZE:]
+
+
+def _compression_parameters(hdu: fits.CompImageHDU) -> dict:
+    """
+    The arguments that make a CompImageHDU with the same compression settings as hdu, including its dither seed
+    """
+    table_header = hdu._header
+    parameters = {'compression_type': table_header['ZCMPTYPE'],
+                  'tile_size': [table_header[f'ZTILE{i}'] for i in range(1, table_header['ZNAXIS'] + 1)]}
+    if 'ZQUANTIZ' in table_header:
+        parameters['quantize_method'] = QUANTIZE_METHODS[table_header['ZQUANTIZ']]
+    if 'ZDITHER0' in table_header:
+        parameters['dither_seed'] = table_header['ZDITHER0']
+    parameter_names = {'NOISEBIT': 'quantize_level', 'SCALE': 'hcomp_scale', 'SMOOTH': 'hcomp_smooth'}
+    i = 1
+    while f'ZNAME{i}' in table_header:
+        if table_header[f'ZNAME{i}'] in parameter_names:
+            parameters[parameter_names[table_header[f'ZNAME{i}']]] = table_header[f'ZVAL{i}']
+        i += 1
+    return parameters
+
+
+def _image_header(hdu: fits.CompImageHDU) -> fits.Header:
+    """
+    The header of the image that hdu compresses, as it was before it was compressed. The header of a compressed
+    HDU is always shown as an image extension, even if it was made from a primary HDU.
+    """
+    table_header = hdu._header
+    header = fits.Header(hdu.header)
+    if 'ZSIMPLE' in table_header:
+        for keyword in ['XTENSION', 'PCOUNT', 'GCOUNT']:
+            header.remove(keyword, ignore_missing=True)
+        header.insert(0, ('SIMPLE', table_header['ZSIMPLE'], table_header.comments['ZSIMPLE']))
+    if 'ZEXTEND' in table_header:
+        header['EXTEND'] = (table_header['ZEXTEND'], table_header.comments['ZEXTEND'])
+    return header
+
+
+def _compress_extension(data, header, compression_parameters, output_verify='silentfix') -> bytes:
+    """
+    Compress an image and write it as a single extension. The arguments are plain arrays and headers so that
+    they can be sent to a worker process.
+    """
+    hdu = fits.CompImageHDU(data=data, header=header, **compression_parameters)
+    return _extension_to_bytes(hdu, output_verify=output_verify)
+
+
+def _header_stand_in(hdu, dtype):
+    """
+    Make an image HDU with the header that hdu would have if its data were converted to dtype, without converting it
+    """
+    # Astropy fills in the header from a zero-strided stand in for the converted data, which takes no memory
+    stand_in = np.lib.stride_tricks.as_strided(np.zeros(1, dtype=dtype), shape=hdu.data.shape,
+                                               strides=(0,) * hdu.data.ndim)
+    return type(hdu)(data=stand_in, header=hdu.header)
+
+
+def _write_image(header_hdu, data, output_file, output_verify='silentfix'):
+    """
+    Write an image HDU (header, data, and padding) exactly as it would be written as part of a file, converting the
+    data to the type in the header a block of rows at a time rather than making a converted copy of the whole array
+    """
+    header_hdu.verify(output_verify)
+    output_file.write(header_hdu.header.tostring().encode('ascii'))
+    # FITS data are big-endian
+    dtype = header_hdu.data.dtype.newbyteorder('>')
+    bytes_per_row = max(1, data[0].size * dtype.itemsize)
+    rows_per_block = max(1, WRITE_BLOCK_BYTES // bytes_per_row)
+    for start in range(0, data.shape[0], rows_per_block):
+        output_file.write(data[start:start + rows_per_block].astype(dtype).data)
+    output_file.write(bytes(-data.size * dtype.itemsize % FITS_BLOCK_SIZE))
+
+
+def _streamable_dtype(hdu, extension_datatypes):
+    """
+    The data type to write an image HDU as, or None if it has to be left to astropy (e.g. it needs BZERO scaling)
+    """
+    if type(hdu) not in [fits.PrimaryHDU, fits.ImageHDU] or hdu.data is None or hdu.data.ndim == 0:
+        return None
+    if 'BZERO' in hdu.header or 'BSCALE' in hdu.header:
+        return None
+    dtype = np.dtype(extension_datatypes.get(hdu.name, hdu.data.dtype))
+    # These are the types that FITS stores directly. Other integer types are stored with an offset.
+    if dtype.kind == 'f' or dtype in [np.uint8, np.int16, np.int32, np.int64]:
+        return dtype
+    return None
+
+
+def write_fits(hdu_list: fits.HDUList, output_file, n_workers: int = 1, output_verify: str = 'silentfix',
+               extension_datatypes: dict = None) -> dict:
+    """
+    Write a (possibly fpacked) HDUList to a file object in a single pass, compressing the extensions in parallel
+
+    Parameters
+    ----------
+    hdu_list : astropy.io.fits.HDUList
+               HDUs to write, e.g. from pack
+    output_file : file-like object
+                  Writable binary file to write to. Only write and tell are used, so this can be a wrapper that
+                  passes the bytes on somewhere else (e.g. file_utils.HashingWriter).
+    n_workers : int (default is 1)
+                Number of processes to compress the extensions in. Each compressed extension is compressed in
+                a separate process, so using more workers than there are compressed extensions does not help.
+    output_verify : str
+                    Verification option passed to astropy when writing
+    extension_datatypes : dict
+                          Data types to write uncompressed image extensions as, keyed by extension name.
+                          The data are converted a block at a time as they are written.
+
+    Returns
+    -------
+    stats : dict
+            Time spent writing, the number of workers used, the size of the data that was compressed,
+            the number of bytes written, and the compression throughput in MB/s
+
+    Notes
+    -----
+    Astropy holds the GIL while it compresses, so we use processes rather than threads. Every extension is
+    self-contained in a FITS file, so the extensions are written out one at a time in order and the output is
+    byte-for-byte the same as writing the (converted) HDUList in one go. If we cannot start a pool
+    (e.g. inside a daemonic celery worker), everything is compressed in this process.
+
+    Frames are written from the pipeline's writer threads, so the workers are started from a forkserver
+    rather than forked from this (multithreaded) process, and each one is sent the data and header
+    of the extension it compresses.
+    """
+    if extension_datatypes is None:
+        extension_datatypes = {}
+    start = time.perf_counter()
+    start_position = output_file.tell()
+    compressed_extensions = [i for i, hdu in enumerate(hdu_list) if isinstance(hdu, fits.CompImageHDU)]
+    input_bytes = sum(hdu_list[i].data.nbytes for i in compressed_extensions)
+    streamed_dtypes = {i: _streamable_dtype(hdu, extension_datatypes) for i, hdu in enumerate(hdu_list)}
+    n_workers = min(n_workers, len(compressed_extensions))
+    pool = None
+    if n_workers > 1:
+        try:
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload([__name__])
+            pool = context.Pool(n_workers)
+        except (AssertionError, OSError, ValueError) as e:
+            logger.warning(f'Could not start a pool of {n_workers} compression workers, '
+                           f'compressing in one process: {e}')
+    if pool is None:
+        n_workers = 1
+        compressed_bytes = {}
+    else:
+        with pool:
+            arguments = [(hdu_list[i].data, _image_header(hdu_list[i]), _compression_parameters(hdu_list[i]),
+                          output_verify) for i in compressed_extensions]
+            compressed_bytes = dict(zip(compressed_extensions, pool.starmap(_compress_extension, arguments)))
+    if not compressed_bytes and not any(streamed_dtypes.values()):
+        hdu_list.writeto(output_file, overwrite=True, output_verify=output_verify)
+    else:
+        hdus_to_write = fits.HDUList([hdu if dtype is None else _header_stand_in(hdu, dtype)
+                                      for hdu, dtype in zip(hdu_list, streamed_dtypes.values())])
+        # This is what writeto does to the primary header before writing a file with extensions
+        hdus_to_write.update_extend()
+        for i, hdu in enumerate(hdus_to_write):
+            if i in compressed_bytes:
+                output_file.write(compressed_bytes[i])
+            elif streamed_dtypes[i] is not None:
+                _write_image(hdu, hdu_list[i].data, output_file, output_verify=output_verify)
+            elif i == 0:
+                fits.HDUList([hdu]).writeto(output_file, output_verify=output_verify)
+            else:
+                output_file.write(_extension_to_bytes(hdu, output_verify=output_verify))
+    write_time = time.perf_counter() - start
+    return {'fpack.workers': n_workers,
+            'fpack.time': write_time,
+            'fpack.input_bytes': input_bytes,
+            'fpack.output_bytes': output_file.tell() - start_position,
+            'fpack.throughput': input_bytes / write_time / 1e6 if write_time > 0 else 0.0}
+
+
 def to_fits_image_extension(data, master_extension_name, extension_name, context, extension_version=None):
     extension_name = master_extension_name + extension_name
     for extname_to_condense in context.EXTENSION_NAMES_TO_CONDENSE:
@@ -238,4 +478,4 @@ def convert_extension_datatypes(hdu_list: fits.HDUList, extension_datatypes: dic
     """
     for hdu in hdu_list:
         if hdu.name in extension_datatypes:
-            hdu.data = hdu.data.astype(extension_datatypes[hdu.name])
+            hdu.data = hdu.data.astype(extension_datatypes[hdu.name], copy=False)
@@ -4,6 +4,8 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 from libc.stdint cimport uint8_t
 from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy
+from libc.math cimport sqrt
 import numpy as np
 cimport numpy as np
 
@@ -14,6 +16,7 @@ np.import_array()
 
 cdef extern from "quick_select.h":
     float quick_select(float * k, int k, int n) nogil
+    float quick_select_pair(float * a, int k, int n, float * next) nogil
 
 
 @cython.boundscheck(False)
@@ -30,19 +33,23 @@ def _quick_select(float[::1] a not None, int k):
 @cython.wraparound(False)
 cdef float _cmedian1d(float* ptr, int n) nogil:
     cdef float med = 0.0
+    cdef float next_value
     cdef int k = (n - 1) // 2
     if n > 0:
-        med = quick_select(ptr, k, n)
         if n % 2 == 0:
-            med += quick_select(ptr, k + 1, n)
+            # Get both middle elements from a single selection
+            med = quick_select_pair(ptr, k, n, &next_value)
+            med += next_value
             med /= 2.0
+        else:
+            med = quick_select(ptr, k, n)
     return med
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def median1d(float[::1] d not None, uint8_t[::1] mask not None):
-    """_median1d(d, mask)\n
+def median1d(float[::1] d not None, uint8_t[::1] mask=None):
+    """_median1d(d, mask=None)\n
     Find the median of a numpy array. If an axis is provided, then find the median along
     the given axis. If mask is included, elements in d that have a non-zero mask value will
     be ignored.
@@ -50,7 +57,7 @@ def median1d(float[::1] d not None, uint8_t[::1] mask not None):
     ----------
     d : float numpy array
         Input array to find the median.
-    mask: unit8 numpy array
+    mask: unit8 numpy array (default is None)
           Numpy array of bitmask values. Non-zero values are ignored when calculating the median.
     Returns
     -------
@@ -68,41 +75,219 @@ def median1d(float[::1] d not None, uint8_t[::1] mask not None):
 
     cdef int n = d.shape[0]
 
-    cdef float[::1] median_array = np.empty(n, dtype=np.float32)
+    if n == 0:
+        return 0.0
 
+    cdef float[::1] median_array
     cdef int n_unmasked_pixels = 0
     cdef int i = 0
+
+    if mask is None:
+        # Nothing to skip, so just select on a copy
+        median_array = np.array(d, dtype=np.float32)
+        n_unmasked_pixels = n
+    else:
+        median_array = np.empty(n, dtype=np.float32)
+        for i in range(n):
+            if mask[i] == 0:
+                median_array[n_unmasked_pixels] = d[i]
+                n_unmasked_pixels += 1
+
+    return _cmedian1d(&median_array[0], n_unmasked_pixels)
+
+
+cdef inline bint _all_zero(const uint8_t* mask, int n) nogil:
+    cdef int i
+    for i in range(n):
+        if mask[i] != 0:
+            return False
+    return True
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _copy_unmasked(const float* d, const uint8_t* mask, float* output, int n) nogil:
+    """Copy the unmasked values of a row into output, returning how many there were"""
+    cdef int i
+    cdef int n_unmasked_pixels = 0
+    # Rows without any masked pixels (the usual case) are copied in one go
+    if mask == NULL or _all_zero(mask, n):
+        memcpy(output, d, n * sizeof(float))
+        return n
     for i in range(n):
         if mask[i] == 0:
-            median_array[n_unmasked_pixels] = d[i]
+            output[n_unmasked_pixels] = d[i]
             n_unmasked_pixels += 1
-
-    return _cmedian1d(&median_array[0], n_unmasked_pixels)
+    return n_unmasked_pixels
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def median2d(float[:, ::1] d, uint8_t[:, ::1] mask):
+def median2d(float[:, ::1] d, uint8_t[:, ::1] mask=None):
 
     cdef int nx = d.shape[1]
     cdef int ny = d.shape[0]
 
     cdef int j = 0
-    cdef int i
 
     cdef float[::1] output_array = np.empty(ny, dtype=np.float32)
     cdef float* median_array
     cdef int n_unmasked_pixels = 0
+    cdef bint has_mask = mask is not None
+
+    if nx == 0 or ny == 0:
+        return np.zeros(ny, dtype=np.float32)
 
     with nogil, parallel():
         median_array = <float *> malloc(nx * sizeof(float))
         for j in prange(ny):
-            n_unmasked_pixels = 0
-            for i in range(nx):
-                if mask[j, i] == 0:
-                    median_array[n_unmasked_pixels] = d[j, i]
-                    n_unmasked_pixels = n_unmasked_pixels + 1
-
+            if has_mask:
+                n_unmasked_pixels = _copy_unmasked(&d[j, 0], &mask[j, 0], median_array, nx)
+            else:
+                n_unmasked_pixels = _copy_unmasked(&d[j, 0], NULL, median_array, nx)
             output_array[j] = _cmedian1d(median_array, n_unmasked_pixels)
         free(median_array)
     return output_array
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _sigma_clipped_stack_row(float[:, :, ::1] data, float[:, :, ::1] uncertainty, uint8_t[:, :, ::1] mask,
+                                   float nsigma_reject, int j, float* scratch, float[:, ::1] stacked_data,
+                                   float[:, ::1] stacked_uncertainty, uint8_t[:, ::1] stacked_mask,
+                                   int[:, ::1] n_good_pixels, float[:, ::1] median, float[:, ::1] mad) nogil:
+    """Stack row j of the images, using scratch (which has room for one pixel of every image) as workspace"""
+    cdef int n = data.shape[0]
+    cdef int nx = data.shape[2]
+    cdef int i, k, n_unmasked, n_good
+    cdef float pixel_median, pixel_mad, threshold, deviation
+    cdef double total, variance
+    cdef uint8_t combined_mask
+
+    for i in range(nx):
+        n_unmasked = 0
+        for k in range(n):
+            if mask[k, j, i] == 0:
+                scratch[n_unmasked] = data[k, j, i]
+                n_unmasked = n_unmasked + 1
+        pixel_median = _cmedian1d(scratch, n_unmasked)
+
+        n_unmasked = 0
+        for k in range(n):
+            if mask[k, j, i] == 0:
+                deviation = data[k, j, i] - pixel_median
+                scratch[n_unmasked] = deviation if deviation >= 0 else -deviation
+                n_unmasked = n_unmasked + 1
+        pixel_mad = _cmedian1d(scratch, n_unmasked)
+        threshold = <float> 1.4826 * pixel_mad
+        threshold = nsigma_reject * threshold
+
+        n_good = 0
+        total = 0.0
+        variance = 0.0
+        combined_mask = 0
+        for k in range(n):
+            combined_mask = combined_mask | mask[k, j, i]
+            deviation = data[k, j, i] - pixel_median
+            deviation = deviation if deviation >= 0 else -deviation
+            # Written this way so NaNs are kept, the same as an explicit abs_deviation > threshold mask
+            if mask[k, j, i] == 0 and not deviation > threshold:
+                n_good = n_good + 1
+                total = total + data[k, j, i]
+                variance = variance + uncertainty[k, j, i] * uncertainty[k, j, i]
+
+        n_good_pixels[j, i] = n_good
+        median[j, i] = pixel_median
+        mad[j, i] = pixel_mad
+        if n_good > 0:
+            stacked_mask[j, i] = 0
+            stacked_data[j, i] = total / n_good
+            stacked_uncertainty[j, i] = sqrt(variance) / n_good
+        else:
+            # Every pixel is bad so fall back to the mean of all of them and keep the mask bits
+            total = 0.0
+            variance = 0.0
+            for k in range(n):
+                total = total + data[k, j, i]
+                variance = variance + uncertainty[k, j, i] * uncertainty[k, j, i]
+            stacked_mask[j, i] = combined_mask
+            stacked_data[j, i] = total / n
+            stacked_uncertainty[j, i] = sqrt(variance) / n
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def sigma_clipped_stack(float[:, :, ::1] data not None, float[:, :, ::1] uncertainty not None,
+                        uint8_t[:, :, ::1] mask not None, float nsigma_reject, int num_threads=0):
+    """sigma_clipped_stack(data, uncertainty, mask, nsigma_reject, num_threads=0)\n
+    Combine a stack of images along the first axis with a sigma clipped mean in a single pass.
+    Parameters
+    ----------
+    data : float32 numpy array
+           (N, ny, nx) array of images to combine.
+    uncertainty : float32 numpy array
+                  (N, ny, nx) array of the per-pixel uncertainties of the images.
+    mask : uint8 numpy array
+           (N, ny, nx) array of bitmask values. Non-zero values are ignored.
+    nsigma_reject : float
+                    Pixels more than nsigma_reject * 1.4826 * MAD from the median are rejected.
+    num_threads : int (default is 0)
+                  Number of threads to use (see Notes)
+    Returns
+    -------
+    mean, uncertainty, mask, n_good, median, mad : numpy arrays
+        (ny, nx) arrays of the sigma clipped mean, its propagated uncertainty, the combined mask,
+        the number of pixels that went into the mean, the median, and the median absolute deviation.
+    Notes
+    -----
+    For each pixel, this does the same thing as taking the median and MAD with median2d, rejecting
+    outliers, and averaging what is left. If every pixel in a column is masked or rejected, the mean
+    and uncertainty use all of the pixels, the output mask is the bitwise or of the input masks, and
+    n_good is zero. Otherwise the output mask is zero. Sums are accumulated in double precision.
+    """
+    cdef int n = data.shape[0]
+    cdef int ny = data.shape[1]
+    cdef int nx = data.shape[2]
+
+    stacked_data = np.empty((ny, nx), dtype=np.float32)
+    stacked_uncertainty = np.empty((ny, nx), dtype=np.float32)
+    stacked_mask = np.empty((ny, nx), dtype=np.uint8)
+    n_good_pixels = np.empty((ny, nx), dtype=np.int32)
+    median = np.empty((ny, nx), dtype=np.float32)
+    mad = np.empty((ny, nx), dtype=np.float32)
+
+    cdef float[:, ::1] stacked_data_view = stacked_data
+    cdef float[:, ::1] stacked_uncertainty_view = stacked_uncertainty
+    cdef uint8_t[:, ::1] stacked_mask_view = stacked_mask
+    cdef int[:, ::1] n_good_view = n_good_pixels
+    cdef float[:, ::1] median_view = median
+    cdef float[:, ::1] mad_view = mad
+
+    cdef int j
+    cdef float* scratch
+
+    if num_threads == 1:
+        with nogil:
+            scratch = <float *> malloc(max(n, 1) * sizeof(float))
+            for j in range(ny):
+                _sigma_clipped_stack_row(data, uncertainty, mask, nsigma_reject, j, scratch, stacked_data_view,
+                                         stacked_uncertainty_view, stacked_mask_view, n_good_view, median_view,
+                                         mad_view)
+            free(scratch)
+    elif num_threads > 1:
+        with nogil, parallel(num_threads=num_threads):
+            scratch = <float *> malloc(max(n, 1) * sizeof(float))
+            for j in prange(ny):
+                _sigma_clipped_stack_row(data, uncertainty, mask, nsigma_reject, j, scratch, stacked_data_view,
+                                         stacked_uncertainty_view, stacked_mask_view, n_good_view, median_view,
+                                         mad_view)
+            free(scratch)
+    else:
+        with nogil, parallel():
+            scratch = <float *> malloc(max(n, 1) * sizeof(float))
+            for j in prange(ny):
+                _sigma_clipped_stack_row(data, uncertainty, mask, nsigma_reject, j, scratch, stacked_data_view,
+                                         stacked_uncertainty_view, stacked_mask_view, n_good_view, median_view,
+                                         mad_view)
+            free(scratch)
+    return stacked_data, stacked_uncertainty, stacked_mask, n_good_pixels, median, mad
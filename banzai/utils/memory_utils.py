@@ -0,0 +1,216 @@
+"""
+memory_utils.py: Pooled, memory-mapped storage for the arrays held by banzai.data objects.
+
+    Rather than making a new temporary file for every array, arrays are carved out of a small
+    number of large, unlinked temporary files. Slots are grouped into power-of-two size classes
+    and are handed back to the pool as soon as the array (and every view of it) is garbage
+    collected, so a long-running worker reuses the same file descriptors and disk blocks for
+    every frame it reduces.
+"""
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+
+logger = logging.getLogger('banzai')
+
+# Smallest slot we hand out. This keeps every slot page aligned.
+MIN_SLOT_SIZE = mmap.ALLOCATIONGRANULARITY
+
+# Target size of each backing file. Slots larger than this get a file to themselves.
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class _Chunk:
+    def __init__(self, size, directory=None):
+        self.size = size
+        self.file_handle = tempfile.TemporaryFile('w+b', dir=directory)
+        # Growing the file with truncate makes it sparse so we only use disk space for pages that are touched
+        self.file_handle.truncate(size)
+        self.buffer = mmap.mmap(self.file_handle.fileno(), size)
+        # Arrays are built on top of a memoryview so that they keep the mapping alive. Numpy does not hold
+        # on to the buffer export of the mmap object itself.
+        self.view = memoryview(self.buffer)
+        self.n_live_slots = 0
+
+    def close(self):
+        self.file_handle.close()
+        if self.n_live_slots == 0:
+            self.view.release()
+            self.buffer.close()
+        # Otherwise arrays are still pointing at this chunk. The mapping is released when they are garbage collected.
+        self.view = None
+        self.buffer = None
+
+
+class _SizeClass:
+    def __init__(self, slot_size, directory=None):
+        self.slot_size = slot_size
+        self.slots_per_chunk = max(1, CHUNK_SIZE // slot_size)
+        self.directory = directory
+        self.chunks = []
+        # Slots that have been handed back. We prefer these over untouched slots as their pages are already resident.
+        self.free_slots = []
+        self.untouched_slots = []
+
+    def add_chunk(self):
+        chunk = _Chunk(self.slot_size * self.slots_per_chunk, directory=self.directory)
+        self.chunks.append(chunk)
+        chunk_index = len(self.chunks) - 1
+        # Hand out slots from the start of the file first
+        self.untouched_slots += [(chunk_index, i * self.slot_size) for i in reversed(range(self.slots_per_chunk))]
+        return chunk
+
+    def close(self):
+        for chunk in self.chunks:
+            chunk.close()
+        self.chunks = []
+        self.free_slots = []
+        self.untouched_slots = []
+
+
+class MemoryMappedArena:
+    """
+    Size-classed pool of memory-mapped array slots.
+
+    Parameters
+    ----------
+    directory : str (default is None)
+                Directory to store the backing files. Defaults to the system temporary directory.
+
+    Notes
+    -----
+    Slots are returned to the pool by a finalizer on the array that was handed out. Numpy views keep
+    a reference to their base array so a slot is never reused while any view of it is still alive.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._size_classes = {}
+        # Slots are released from finalizers, which the garbage collector can run while we hold the lock
+        self._lock = threading.RLock()
+        self._closed = False
+        self._n_allocations = 0
+        self._n_reused = 0
+        self._n_released = 0
+        self._bytes_in_use = 0
+        self._peak_bytes_in_use = 0
+
+    @staticmethod
+    def slot_size(nbytes):
+        """Round a request up to the next power of two, with a minimum of one page"""
+        return max(MIN_SLOT_SIZE, 1 << (int(nbytes) - 1).bit_length())
+
+    def allocate(self, shape, dtype) -> np.ndarray:
+        """
+        Get an uninitialized array backed by a slot in the arena.
+
+        Parameters
+        ----------
+        shape : tuple
+                Shape of the array
+        dtype : numpy dtype
+                Data type of the array
+
+        Returns
+        -------
+        array : numpy array
+                Memory-mapped array. The contents of a reused slot are not cleared.
+        """
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        slot_size = self.slot_size(nbytes)
+        with self._lock:
+            if self._closed:
+                raise ValueError('Cannot allocate from a closed arena')
+            size_class = self._size_classes.get(slot_size)
+            if size_class is None:
+                size_class = _SizeClass(slot_size, directory=self.directory)
+                self._size_classes[slot_size] = size_class
+            if size_class.free_slots:
+                self._n_reused += 1
+                chunk_index, offset = size_class.free_slots.pop()
+            else:
+                if not size_class.untouched_slots:
+                    size_class.add_chunk()
+                chunk_index, offset = size_class.untouched_slots.pop()
+            chunk = size_class.chunks[chunk_index]
+            chunk.n_live_slots += 1
+            self._n_allocations += 1
+            self._bytes_in_use += slot_size
+            self._peak_bytes_in_use = max(self._peak_bytes_in_use, self._bytes_in_use)
+            buffer = chunk.view
+        array = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+        weakref.finalize(array, self._release, size_class, chunk, chunk_index, offset)
+        return array
+
+    def _release(self, size_class, chunk, chunk_index, offset):
+        with self._lock:
+            self._n_released += 1
+            self._bytes_in_use -= size_class.slot_size
+            chunk.n_live_slots -= 1
+            # If the arena was closed (or this chunk was dropped) in the meantime, there is nothing to give back
+            if not self._closed and chunk_index < len(size_class.chunks) and size_class.chunks[chunk_index] is chunk:
+                size_class.free_slots.append((chunk_index, offset))
+
+    def stats(self) -> dict:
+        """
+        Usage statistics for the arena
+
+        Returns
+        -------
+        stats : dict
+                Number of allocations, how many of them reused a slot, number of slots released,
+                bytes currently handed out (and the peak), and the total size of the backing files.
+        """
+        with self._lock:
+            chunks = [chunk for size_class in self._size_classes.values() for chunk in size_class.chunks]
+            return {'arena.allocations': self._n_allocations,
+                    'arena.reused_slots': self._n_reused,
+                    'arena.released_slots': self._n_released,
+                    'arena.bytes_in_use': self._bytes_in_use,
+                    'arena.peak_bytes_in_use': self._peak_bytes_in_use,
+                    'arena.bytes_mapped': sum(chunk.size for chunk in chunks),
+                    'arena.open_files': len(chunks)}
+
+    def close(self):
+        """Release all of the backing files. Arrays that are still alive stay valid until they are collected."""
+        with self._lock:
+            self._closed = True
+            for size_class in self._size_classes.values():
+                size_class.close()
+            self._size_classes = {}
+
+
+_arena = None
+_arena_pid = None
+_arena_lock = threading.Lock()
+
+
+def get_arena() -> MemoryMappedArena:
+    """
+    Get the arena for this process.
+
+    Notes
+    -----
+    The backing files are shared mappings, so a forked child (e.g. a celery worker) must not hand out
+    slots from its parent's arena. We make a fresh arena whenever the process id changes.
+    """
+    global _arena, _arena_pid
+    with _arena_lock:
+        if _arena is None or _arena_pid != os.getpid():
+            _arena = MemoryMappedArena(directory=os.getenv('BANZAI_MEMMAP_DIRECTORY'))
+            _arena_pid = os.getpid()
+        return _arena
+
+
+def close_arena():
+    global _arena, _arena_pid
+    with _arena_lock:
+        if _arena is not None and _arena_pid == os.getpid():
+            _arena.close()
+        _arena = None
+        _arena_pid = None
@@ -0,0 +1,203 @@
+"""
+metrics.py: Timing and resource usage of the pipeline stages.
+
+    When STAGE_METRICS is turned on, every stage records its wall time, CPU time, increase in the peak resident
+    memory of the process, bytes read and written, and the number of arrays allocated from the memory arena.
+    The measurements are logged, added up per stage in each process (and served in the Prometheus/OpenMetrics
+    text format if STAGE_METRICS_PORT is set), and a summary for each frame is saved with its QC results.
+
+    The counters are for the whole process, so work done by other threads (e.g. reading the next frame in the
+    background) while a stage runs is included in its numbers.
+"""
+import http.server
+import logging
+import os
+import resource
+import threading
+import time
+from collections import OrderedDict
+
+from banzai.utils import memory_utils, qc
+
+logger = logging.getLogger('banzai')
+
+# Name and help text for each thing we measure
+STAGE_METRICS = [('wall_time', 'Wall clock time in seconds'),
+                 ('cpu_time', 'CPU time used by the process in seconds'),
+                 ('peak_rss_increase', 'Increase in the peak resident memory of the process in bytes'),
+                 ('read_bytes', 'Bytes read by the process'),
+                 ('write_bytes', 'Bytes written by the process'),
+                 ('allocations', 'Arrays allocated from the memory arena')]
+
+# Number of ports to try after STAGE_METRICS_PORT, so every worker on a node can serve its own metrics
+MAX_PORT_OFFSET = 64
+
+
+def _read_io_counters():
+    # rchar/wchar count everything that goes through read/write system calls (including sockets), not just disk
+    try:
+        with open('/proc/self/io') as io_file:
+            counters = dict(line.split(':') for line in io_file)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+class Measurement:
+    """Snapshot of the process's resource usage at the start of a stage"""
+    def __init__(self):
+        self.wall_time = time.perf_counter()
+        self.cpu_time = time.process_time()
+        # ru_maxrss is in kilobytes on Linux
+        self.max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        self.read_bytes, self.write_bytes = _read_io_counters()
+        self.allocations = memory_utils.get_arena().stats()['arena.allocations']
+
+    def finish(self) -> dict:
+        end = Measurement()
+        return {'wall_time': end.wall_time - self.wall_time,
+                'cpu_time': end.cpu_time - self.cpu_time,
+                'peak_rss_increase': end.max_rss - self.max_rss,
+                'read_bytes': end.read_bytes - self.read_bytes,
+                'write_bytes': end.write_bytes - self.write_bytes,
+                'allocations': end.allocations - self.allocations}
+
+
+class StageMetricsRegistry:
+    """Running totals of the stage measurements in this process"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = OrderedDict()
+
+    def add(self, stage_name, measurements):
+        with self._lock:
+            totals = self._totals.setdefault(stage_name, {'runs': 0, **{name: 0 for name, _ in STAGE_METRICS}})
+            totals['runs'] += 1
+            for name, _ in STAGE_METRICS:
+                totals[name] += measurements[name]
+
+    def totals(self) -> dict:
+        with self._lock:
+            return {stage_name: dict(totals) for stage_name, totals in self._totals.items()}
+
+    def to_openmetrics(self) -> str:
+        """Format the totals in the Prometheus/OpenMetrics text format"""
+        totals = self.totals()
+        lines = ['# HELP banzai_stage_runs Number of times the stage has run',
+                 '# TYPE banzai_stage_runs counter']
+        lines += [f'banzai_stage_runs_total{{stage="{stage_name}"}} {stage_totals["runs"]}'
+                  for stage_name, stage_totals in totals.items()]
+        for name, help_text in STAGE_METRICS:
+            lines += [f'# HELP banzai_stage_{name} {help_text}', f'# TYPE banzai_stage_{name} counter']
+            lines += [f'banzai_stage_{name}_total{{stage="{stage_name}"}} {stage_totals[name]}'
+                      for stage_name, stage_totals in totals.items()]
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        lines += ['# HELP banzai_process_max_rss_bytes Peak resident memory of the process',
+                  '# TYPE banzai_process_max_rss_bytes gauge',
+                  f'banzai_process_max_rss_bytes {max_rss}',
+                  '# EOF']
+        return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = get_registry().to_openmetrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent and not interesting
+        pass
+
+
+def start_metrics_server(port):
+    """
+    Serve this process's stage metrics over HTTP from a background thread
+
+    Notes
+    -----
+    Each worker process needs its own port, so if the port is taken we try the next ones.
+
+    Returns
+    -------
+    server : http.server.HTTPServer
+             None if no port was free
+    """
+    for port_to_try in range(port, port + MAX_PORT_OFFSET):
+        try:
+            server = http.server.ThreadingHTTPServer(('', port_to_try), _MetricsHandler)
+        except OSError:
+            continue
+        threading.Thread(target=server.serve_forever, name='stage-metrics', daemon=True).start()
+        logger.info('Serving stage metrics', extra_tags={'port': port_to_try})
+        return server
+    logger.error('Could not find a free port to serve stage metrics', extra_tags={'port': port})
+    return None
+
+
+_registry = None
+_registry_pid = None
+_registry_lock = threading.Lock()
+
+
+def get_registry(runtime_context=None) -> StageMetricsRegistry:
+    """
+    Get the stage metrics for this process
+
+    Notes
+    -----
+    Forked workers start their own totals (and metrics server, if STAGE_METRICS_PORT is set in the runtime context).
+    """
+    global _registry, _registry_pid
+    with _registry_lock:
+        if _registry is None or _registry_pid != os.getpid():
+            _registry = StageMetricsRegistry()
+            _registry_pid = os.getpid()
+            port = getattr(runtime_context, 'STAGE_METRICS_PORT', None)
+            if port:
+                start_metrics_server(int(port))
+        return _registry
+
+
+def start_measurement(runtime_context):
+    """
+    Start measuring a stage
+
+    Returns
+    -------
+    measurement : Measurement
+                  None if stage metrics are turned off
+    """
+    if not getattr(runtime_context, 'STAGE_METRICS', False):
+        return None
+    return Measurement()
+
+
+def record_stage(stage_name, image, measurement, runtime_context):
+    """
+    Finish measuring a stage, log the results, and add them to the totals for the process and for the frame
+    """
+    measurements = measurement.finish()
+    get_registry(runtime_context).add(stage_name, measurements)
+    logger.info('Finished {0}'.format(stage_name), image=image, extra_tags=measurements)
+    frame_metrics = getattr(image, 'stage_metrics', None)
+    if frame_metrics is None:
+        frame_metrics = OrderedDict()
+        image.stage_metrics = frame_metrics
+    frame_metrics[stage_name] = measurements
+
+
+def save_frame_summary(image, runtime_context):
+    """Save the measurements of each stage for a frame with its QC results"""
+    frame_metrics = getattr(image, 'stage_metrics', None)
+    if not frame_metrics:
+        return
+    totals = {name: sum(measurements[name] for measurements in frame_metrics.values()) for name, _ in STAGE_METRICS}
+    qc.save_qc_results(runtime_context, {'stage_metrics': {'total': totals,
+                                                           'stages': [{'stage': stage_name, **measurements}
+                                                                      for stage_name, measurements
+                                                                      in frame_metrics.items()]}},
+                       image)
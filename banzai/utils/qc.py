@@ -1,7 +1,13 @@
+import atexit
 import logging
+import os
+import threading
+import time
+from collections import OrderedDict
 
 import numpy as np
 import elasticsearch
+import elasticsearch.helpers
 
 from banzai import logs
 
@@ -24,7 +30,184 @@ def format_qc_results(qc_results, image):
     return filename, results_to_save
 
 
-def save_qc_results(runtime_context, qc_results, image, **kwargs):
+class QCShipper:
+    """
+    Send QC results to ElasticSearch in the background
+
+    Parameters
+    ----------
+    elasticsearch_url : str
+    index : str
+            ElasticSearch index for the QC documents
+    doc_type : str
+               ElasticSearch document type for the QC documents
+    max_pending : int
+                  Maximum number of documents waiting to be sent. Results for new documents are dropped
+                  (and counted) when this is full.
+    batch_size : int
+                 Maximum number of documents to send in one bulk request
+    flush_interval : float
+                     Maximum time in seconds that results wait before being sent
+    max_retries : int
+                  Number of times to retry sending a document before dropping it
+
+    Notes
+    -----
+    All of the results for a frame (keyed by filename) that arrive before a flush are merged into a single document
+    and sent as one upsert, so the reduction never waits on ElasticSearch. Failed requests are retried with
+    exponential backoff.
+    """
+    def __init__(self, elasticsearch_url, index, doc_type, max_pending=1000, batch_size=100, flush_interval=1.0,
+                 max_retries=5):
+        self.elasticsearch_url = elasticsearch_url
+        self.index = index
+        self.doc_type = doc_type
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.client = elasticsearch.Elasticsearch(elasticsearch_url)
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._n_in_flight = 0
+        self._flush_requested = False
+        self._closed = False
+        self._stats = {'qc.queued': 0, 'qc.merged': 0, 'qc.sent': 0, 'qc.retries': 0, 'qc.dropped': 0}
+        self._thread = threading.Thread(target=self._run, name='qc-shipper', daemon=True)
+        self._thread.start()
+
+    def add(self, filename, results):
+        with self._condition:
+            if filename in self._pending:
+                self._pending[filename].update(results)
+                self._stats['qc.merged'] += 1
+            elif len(self._pending) >= self.max_pending:
+                self._stats['qc.dropped'] += 1
+                logger.warning('Too many QC results are waiting to be sent. Dropping them.',
+                               extra_tags={'filename': filename})
+                return
+            else:
+                self._pending[filename] = dict(results)
+                self._stats['qc.queued'] += 1
+            self._condition.notify_all()
+
+    def _take_batch(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending or self._closed)
+            # Give the rest of the results for these frames a chance to arrive so they go out together
+            self._condition.wait_for(lambda: len(self._pending) >= self.batch_size or self._flush_requested
+                                     or self._closed, timeout=self.flush_interval)
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popitem(last=False))
+            self._n_in_flight = len(batch)
+            if not self._pending:
+                self._flush_requested = False
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            self._send(batch)
+            with self._condition:
+                self._n_in_flight = 0
+                self._condition.notify_all()
+
+    def _send(self, batch):
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self._stats['qc.retries'] += 1
+                time.sleep(min(30.0, 0.5 * 2 ** (attempt - 1)))
+            actions = [{'_op_type': 'update', '_index': self.index, '_type': self.doc_type, '_id': filename,
+                        '_retry_on_conflict': 5, 'doc': document, 'doc_as_upsert': True}
+                       for filename, document in batch]
+            try:
+                n_sent, errors = elasticsearch.helpers.bulk(self.client, actions, raise_on_error=False)
+            except Exception:
+                error_message = 'Cannot update elasticsearch index to URL \"{url}\": {exception}'
+                logger.error(error_message.format(url=self.elasticsearch_url, exception=logs.format_exception()))
+                continue
+            self._stats['qc.sent'] += n_sent
+            failed_ids = {list(error.values())[0].get('_id') for error in errors}
+            batch = [(filename, document) for filename, document in batch if filename in failed_ids]
+            if not batch:
+                return
+            logger.error('Elasticsearch could not save some QC results', extra_tags={'errors': str(errors[:5])})
+        self._stats['qc.dropped'] += len(batch)
+        logger.error('Giving up on sending QC results', extra_tags={'filenames': [filename for filename, _ in batch]})
+
+    def flush(self, timeout=None):
+        """
+        Wait until all of the pending results have been sent (or dropped)
+
+        Returns
+        -------
+        flushed : bool
+                  False if we timed out
+        """
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: not self._pending and self._n_in_flight == 0, timeout=timeout)
+
+    def close(self, timeout=None):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self._condition:
+            stats = dict(self._stats)
+            stats['qc.pending'] = len(self._pending)
+        return stats
+
+
+_qc_shipper = None
+_qc_shipper_pid = None
+_qc_shipper_lock = threading.Lock()
+
+
+def get_qc_shipper(runtime_context) -> QCShipper:
+    """
+    Get this process's QC shipper, starting it if needed
+
+    Notes
+    -----
+    The shipper's thread does not survive a fork, so a forked worker starts its own.
+    """
+    global _qc_shipper, _qc_shipper_pid
+    with _qc_shipper_lock:
+        if _qc_shipper is None or _qc_shipper_pid != os.getpid() \
+                or _qc_shipper.elasticsearch_url != runtime_context.elasticsearch_url:
+            _qc_shipper = QCShipper(runtime_context.elasticsearch_url, runtime_context.elasticsearch_qc_index,
+                                    runtime_context.elasticsearch_doc_type,
+                                    max_pending=getattr(runtime_context, 'QC_MAX_PENDING', 1000),
+                                    batch_size=getattr(runtime_context, 'QC_BATCH_SIZE', 100),
+                                    flush_interval=getattr(runtime_context, 'QC_FLUSH_INTERVAL', 1.0),
+                                    max_retries=getattr(runtime_context, 'QC_MAX_RETRIES', 5))
+            _qc_shipper_pid = os.getpid()
+        return _qc_shipper
+
+
+def close_qc_shipper(timeout=30.0):
+    """Send any QC results that are still waiting and stop this process's shipper"""
+    global _qc_shipper, _qc_shipper_pid
+    with _qc_shipper_lock:
+        if _qc_shipper is not None and _qc_shipper_pid == os.getpid():
+            _qc_shipper.flush(timeout)
+            _qc_shipper.close(timeout)
+            logger.info('Closed QC shipper', extra_tags=_qc_shipper.stats())
+        _qc_shipper = None
+        _qc_shipper_pid = None
+
+
+atexit.register(close_qc_shipper)
+
+
+def save_qc_results(runtime_context, qc_results, image):
     """
     Save the Quality Control results to ElasticSearch
 
@@ -37,22 +220,18 @@ def save_qc_results(runtime_context, qc_results, image, **kwargs):
     image : banzai.frames.ObservationFrame
             Image that should be linked
 
+    Returns
+    -------
+    results_to_save : dict
+                      The results that were queued to be sent. Empty if we are not posting to ElasticSearch.
+
     Notes
     -----
     File name, site, camera, dayobs and timestamp are always saved in the database.
+    Results are sent in the background by the process's QCShipper.
     """
-
-    es_output = {}
-    if getattr(runtime_context, 'post_to_elasticsearch', False):
-        filename, results_to_save = format_qc_results(qc_results, image)
-        es = elasticsearch.Elasticsearch(runtime_context.elasticsearch_url)
-        try:
-            es_output = es.update(index=runtime_context.elasticsearch_qc_index,
-                                  doc_type=runtime_context.elasticsearch_doc_type,
-                                  id=filename, body={'doc': results_to_save, 'doc_as_upsert': True},
-                                  retry_on_conflict=5, timestamp=results_to_save['@timestamp'], **kwargs)
-        except Exception:
-            error_message = 'Cannot update elasticsearch index to URL \"{url}\": {exception}'
-            logger.error(error_message.format(url=runtime_context.elasticsearch_url,
-                                              exception=logs.format_exception()))
-    return es_output
+    if not getattr(runtime_context, 'post_to_elasticsearch', False):
+        return {}
+    filename, results_to_save = format_qc_results(qc_results, image)
+    get_qc_shipper(runtime_context).add(filename, results_to_save)
+    return results_to_save
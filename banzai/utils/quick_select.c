@@ -5,6 +5,25 @@
 #define ELEM_SWAP(a,b) { float t=(a); (a)=(b); (b)=t; }
 
 
+static void
+insertion_sort(float* a, int n)
+{
+    /* Sort a short array in place. For the handful of values in a typical calibration stack
+     * this beats partitioning because the loop is short, predictable, and stays in registers. */
+    int i, j;
+    float value;
+    for (i = 1; i < n; i++) {
+        value = a[i];
+        j = i - 1;
+        while (j >= 0 && a[j] > value) {
+            a[j + 1] = a[j];
+            j--;
+        }
+        a[j + 1] = value;
+    }
+}
+
+
 float
 quick_select(float* a, int k, int n)
 {
@@ -28,8 +47,10 @@ quick_select(float* a, int k, int n)
     /* The value to return */
     float value;
 
-    /* running index i */
-    int i;
+    if (n <= SMALL_SELECT_SIZE) {
+        insertion_sort(a, n);
+        return a[k];
+    }
 
     /* Start an infinite loop */
     while (1) {
@@ -87,4 +108,31 @@ quick_select(float* a, int k, int n)
 
 }
 
+
+
+float
+quick_select_pair(float* a, int k, int n, float* next)
+{
+    /* Get the kth and the (k+1)th elements of an array "a" with length "n" (k + 1 < n).
+     * The (k+1)th element is stored in "next". This saves a second selection when taking
+     * the median of an even number of values.
+     */
+    int i;
+    float value;
+    if (n <= SMALL_SELECT_SIZE) {
+        insertion_sort(a, n);
+        *next = a[k + 1];
+        return a[k];
+    }
+    value = quick_select(a, k, n);
+    /* Quickselect leaves everything after position k greater than or equal to the kth element,
+     * so the next element is the smallest of those. */
+    *next = a[k + 1];
+    for (i = k + 2; i < n; i++) {
+        if (a[i] < *next)
+            *next = a[i];
+    }
+    return value;
+}
+
 #undef ELEM_SWAP
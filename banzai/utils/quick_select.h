@@ -3,5 +3,11 @@
  */
 #include <stdint.h>
 
+/* Arrays with at most this many elements are sorted with an insertion sort rather than partitioned */
+#define SMALL_SELECT_SIZE 16
+
 /*Get the kth element of an array "a" with length "n" using the Quickselect algorithm. */
 float quick_select(float* a, int k, int n);
+
+/* Get the kth and (k+1)th elements of an array "a" with length "n". The (k+1)th element is stored in "next". */
+float quick_select_pair(float* a, int k, int n, float* next);
@@ -2,24 +2,76 @@ import logging
 
 import os
 from banzai import dbs
-from banzai.utils import file_utils, import_utils, image_utils
+from banzai.utils import file_utils, fits_utils, import_utils, image_utils
 from banzai.data import HeaderOnly
 from banzai import logs
 logger = logging.getLogger('banzai')
 
 
 def set_file_as_processed(path, db_address):
-    image = dbs.get_processed_image(path, db_address=db_address)
-    if image is not None:
-        image.success = True
-        dbs.commit_processed_image(image, db_address=db_address)
+    set_files_as_processed([path], db_address)
+
+
+def set_files_as_processed(paths, db_address):
+    dbs.mark_processed_images_as_successful([os.path.basename(path) for path in paths], db_address=db_address)
 
 
 def increment_try_number(path, db_address):
-    image = dbs.get_processed_image(path, db_address=db_address)
-    # Otherwise increment the number of tries
-    image.tries += 1
-    dbs.commit_processed_image(image, db_address=db_address)
+    increment_try_numbers([path], db_address)
+
+
+def increment_try_numbers(paths, db_address):
+    dbs.increment_processed_image_tries([os.path.basename(path) for path in paths], db_address=db_address)
+
+
+def header_can_be_processed(header, filename, context):
+    """
+    Check from its header alone whether a frame is a raw frame that we can reduce
+
+    Parameters
+    ----------
+    header: dict-like
+          Primary header of the frame (or a queue message from the archive, which has the same keywords)
+    filename: str
+          Name of the frame for the log messages
+    context: banzai.context.Context
+          Context object with runtime environment info
+
+    Returns
+    -------
+    can_be_processed: bool
+          True if the frame is raw, has a supported OBSTYPE, and is from an instrument in the database
+          that passes the frame selection criteria
+
+    Notes
+    -----
+    The checks that only need the header come first, so the database is only queried for frames that pass them.
+    """
+    if header is None:
+        return False
+    try:
+        if image_utils.get_reduction_level(header) != '00':
+            logger.error('Image has nonzero reduction level. Aborting.', extra_tags={'filename': filename})
+            return False
+        if header.get('OBSTYPE') not in context.SUPPORTED_FRAME_TYPES:
+            logger.debug('Image has an obstype that is not supported.', extra_tags={'filename': filename})
+            return False
+        factory = import_utils.import_attribute(context.FRAME_FACTORY)()
+        test_image = factory.observation_frame_class(hdu_list=[HeaderOnly(header)], file_path=filename)
+        test_image.instrument = factory.get_instrument_from_header(header, db_address=context.db_address)
+        if test_image.instrument is None:
+            logger.error('This frame has an instrument that is not currently in the DB. Aborting:',
+                         extra_tags={'filename': filename})
+            return False
+        if not image_utils.image_can_be_processed(test_image, context):
+            logger.error('The header of this frame appears to not be complete enough to make a Frame object',
+                         extra_tags={'filename': filename})
+            return False
+    except Exception:
+        logger.error('Issue creating Image object from the header', extra_tags={"filename": filename})
+        logger.error(logs.format_exception())
+        return False
+    return True
 
 
 def need_to_process_image(file_info, context):
@@ -42,17 +94,17 @@ def need_to_process_image(file_info, context):
     -----
     If the file has changed, we reset the success flags and the number of tries to zero.
     We only attempt to make images if the instrument is in the database and passes the given criteria.
+    For files on disk, only the headers are read to check this, and the file is only hashed (in chunks,
+    and only if it has changed since we last hashed it when MD5_CACHE is on) if it passes.
     """
     if 'path' not in file_info and 'frameid' not in file_info:
         logger.error('Ill formed queue message. Aborting')
         return False
 
     if 'frameid' in file_info:
-        checksum = file_info['version_set'][0].get('md5')
         filename = file_info['filename']
     else:
         filename = os.path.basename(file_info['path'])
-        checksum = file_utils.get_md5(file_info['path'])
 
     logger.info("Checking if file needs to be processed", extra_tags={"filename": filename})
     if not (filename.endswith('.fits') or filename.endswith('.fits.fz')):
@@ -60,6 +112,20 @@ def need_to_process_image(file_info, context):
                      extra_tags={"filename": filename})
         return False
 
+    # Make sure that the header can make a valid image object before bothering to hash the file or pull it from s3.
+    # Messages from the archived_fits queue have the header keywords in them.
+    if 'frameid' in file_info:
+        header = file_info
+    else:
+        header = fits_utils.get_primary_header(file_info['path'])
+    if not header_can_be_processed(header, filename, context):
+        return False
+
+    if 'frameid' in file_info:
+        checksum = file_info['version_set'][0].get('md5')
+    else:
+        checksum = file_utils.get_md5(file_info['path'], use_cache=getattr(context, 'MD5_CACHE', False))
+
     # Get the image in db. If it doesn't exist add it.
     image = dbs.get_processed_image(filename, db_address=context.db_address)
     # If this is an message on the archived_fits queue, then update the frameid
@@ -80,27 +146,4 @@ def need_to_process_image(file_info, context):
         need_to_process = True
         dbs.commit_processed_image(image, context.db_address)
 
-    # if we are pulling off the archived fits queue, make sure that the header can make a valid image object before
-    # bothering to pull it from s3
-    if 'frameid' in file_info:
-        try:
-            factory = import_utils.import_attribute(context.FRAME_FACTORY)()
-            test_image = factory.observation_frame_class(hdu_list=[HeaderOnly(file_info)], file_path=file_info['filename'])
-            test_image.instrument = factory.get_instrument_from_header(file_info, db_address=context.db_address)
-            if image_utils.get_reduction_level(test_image.meta) != '00':
-                logger.error('Image has nonzero reduction level. Aborting.', extra_tags={'filename': filename})
-                need_to_process = False
-            elif test_image.instrument is None:
-                logger.error('This queue message has an instrument that is not currently in the DB. Aborting:',
-                             extra_tags={'filename': filename})
-                need_to_process = False
-            elif not image_utils.image_can_be_processed(test_image, context):
-                logger.error('The header in this queue message appears to not be complete enough to make a Frame object',
-                             extra_tags={'filename': filename})
-                need_to_process = False
-        except Exception:
-            logger.error('Issue creating Image object with given queue message', extra_tags={"filename": filename})
-            logger.error(logs.format_exception())
-            need_to_process = False
-
     return need_to_process
@@ -0,0 +1,140 @@
+"""
+reprocessing_utils.py: Reduce a large set of frames on one machine with a pool of worker processes.
+
+    Frames that have already been reduced successfully (according to the processedimages table) are skipped,
+    so an interrupted run picks up where it left off when it is restarted.
+"""
+import glob
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+import time
+
+from banzai import logs
+from banzai.context import Context
+from banzai.utils import realtime_utils, stage_utils, qc
+
+logger = logging.getLogger('banzai')
+
+FITS_PATTERNS = ['*.fits', '*.fits.fz']
+
+REDUCED = 'reduced'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+# Runtime context for the worker processes. This is set by the pool initializer so that the (large) context is only
+# sent to each worker once rather than with every frame.
+_worker_runtime_context = None
+
+
+def find_frames(directory=None, pattern=None) -> list:
+    """
+    Find the frames to reduce
+
+    Parameters
+    ----------
+    directory : str
+                Directory with the frames to reduce. Only files ending in .fits or .fits.fz are used.
+    pattern : str
+              Glob pattern to match the frames to reduce (e.g. "/archive/ogg/kb27/2021*/raw/*e00.fits*").
+              ** matches any number of subdirectories.
+
+    Returns
+    -------
+    paths : list
+            Paths to the frames, sorted and with only one copy of each filename
+    """
+    paths = []
+    if directory is not None:
+        for fits_pattern in FITS_PATTERNS:
+            paths += glob.glob(os.path.join(directory, fits_pattern))
+    if pattern is not None:
+        paths += glob.glob(pattern, recursive=True)
+    # processedimages is keyed by filename so we can only keep track of one copy of each file
+    paths_by_filename = {}
+    for path in sorted(paths):
+        paths_by_filename.setdefault(os.path.basename(path), path)
+    return sorted(paths_by_filename.values())
+
+
+def _init_worker(runtime_context):
+    global _worker_runtime_context
+    _worker_runtime_context = Context(runtime_context)
+    # Pool workers skip atexit handlers when they exit, so send any QC results they are still holding explicitly
+    multiprocessing.util.Finalize(None, qc.close_qc_shipper, exitpriority=10)
+
+
+def reduce_frame(path, runtime_context=None):
+    """
+    Reduce a single frame if it has not already been reduced
+
+    Returns
+    -------
+    status, path, elapsed : tuple
+                            Whether the frame was reduced, skipped, or failed, the path to the frame,
+                            and the time we spent on it in seconds
+    """
+    if runtime_context is None:
+        runtime_context = _worker_runtime_context
+    start = time.perf_counter()
+    filename = os.path.basename(path)
+    try:
+        # This also checks from the header that the frame is one we can reduce
+        if not realtime_utils.need_to_process_image({'path': path}, runtime_context):
+            return SKIPPED, path, time.perf_counter() - start
+        realtime_utils.increment_try_number(path, db_address=runtime_context.db_address)
+        stage_utils.run_pipeline_stages([{'path': path}], runtime_context)
+        realtime_utils.set_file_as_processed(path, db_address=runtime_context.db_address)
+    except Exception:
+        logger.error(logs.format_exception(), extra_tags={'filename': filename})
+        return FAILED, path, time.perf_counter() - start
+    elapsed = time.perf_counter() - start
+    logger.info('Reduced frame', extra_tags={'filename': filename, 'reduction_time': elapsed})
+    return REDUCED, path, elapsed
+
+
+def reduce_frames(paths, runtime_context, n_processes=1) -> dict:
+    """
+    Reduce a set of frames in a pool of worker processes
+
+    Parameters
+    ----------
+    paths : list
+            Paths to the frames to reduce
+    runtime_context : banzai.context.Context
+                      Context object with runtime environment info
+    n_processes : int
+                  Number of worker processes. With 1, the frames are reduced in this process.
+
+    Returns
+    -------
+    summary : dict
+              Number of frames that were reduced, skipped, and failed, along with the total wall time
+              and the throughput
+    """
+    start = time.perf_counter()
+    counts = {REDUCED: 0, SKIPPED: 0, FAILED: 0}
+    reduction_time = 0.0
+    logger.info('Reducing frames', extra_tags={'n_frames': len(paths), 'n_processes': n_processes})
+    if n_processes > 1 and len(paths) > 1:
+        # Fork so that workers do not have to import everything again
+        with multiprocessing.get_context('fork').Pool(n_processes, initializer=_init_worker,
+                                                      initargs=(vars(runtime_context),)) as pool:
+            results = list(pool.imap_unordered(reduce_frame, paths))
+    else:
+        results = [reduce_frame(path, runtime_context) for path in paths]
+    for status, path, elapsed in results:
+        counts[status] += 1
+        if status == REDUCED:
+            reduction_time += elapsed
+    wall_time = time.perf_counter() - start
+    summary = {'n_frames': len(paths),
+               'n_reduced': counts[REDUCED],
+               'n_skipped': counts[SKIPPED],
+               'n_failed': counts[FAILED],
+               'wall_time': wall_time,
+               'frames_per_hour': 3600.0 * counts[REDUCED] / wall_time if wall_time > 0 else 0.0,
+               'mean_reduction_time': reduction_time / counts[REDUCED] if counts[REDUCED] else 0.0}
+    logger.info('Finished reducing frames', extra_tags=summary)
+    return summary
@@ -1,5 +1,7 @@
-from banzai.utils import import_utils
-from collections import Iterable
+from banzai.utils import import_utils, metrics
+from collections import Iterable, deque
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 import logging
 from banzai.context import Context
 
@@ -39,27 +41,142 @@ def get_stages_for_individual_frame(ordered_stages, last_stage=None, extra_stage
     return stages_todo
 
 
-def run_pipeline_stages(image_paths: list, runtime_context: Context, calibration_maker: bool = False):
-    frame_factory = import_utils.import_attribute(runtime_context.FRAME_FACTORY)()
-    images = [frame_factory.open(image_path, runtime_context) for image_path in image_paths]
-    images = [image for image in images if image is not None]
-    if len(images) == 0:
+def _open_images(frame_factory, image_paths: list, runtime_context: Context):
+    """
+    Open frames in order, reading up to PIPELINE_PREFETCH_DEPTH frames ahead in background threads
+
+    Notes
+    -----
+    Frames that could not be opened are yielded as None.
+    """
+    prefetch_depth = getattr(runtime_context, 'PIPELINE_PREFETCH_DEPTH', 0)
+    if prefetch_depth <= 0:
+        for image_path in image_paths:
+            yield frame_factory.open(image_path, runtime_context)
         return
-    if calibration_maker:
-        stages_to_do = runtime_context.CALIBRATION_STACKER_STAGES[images[0].obstype.upper()]
-    else:
-        stages_to_do = get_stages_for_individual_frame(runtime_context.ORDERED_STAGES,
-                                                       last_stage=runtime_context.LAST_STAGE[images[0].obstype.upper()],
-                                                       extra_stages=runtime_context.EXTRA_STAGES[images[0].obstype.upper()])
+    n_workers = max(1, getattr(runtime_context, 'PIPELINE_PREFETCH_WORKERS', 1))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        image_paths = iter(image_paths)
+        pending = deque(executor.submit(frame_factory.open, image_path, runtime_context)
+                        for image_path in itertools.islice(image_paths, prefetch_depth))
+        try:
+            while pending:
+                image = pending.popleft().result()
+                for image_path in itertools.islice(image_paths, 1):
+                    pending.append(executor.submit(frame_factory.open, image_path, runtime_context))
+                yield image
+        finally:
+            # If the caller gave up on us, don't bother reading the rest of the frames
+            for future in pending:
+                future.cancel()
 
-    for stage_name in stages_to_do:
-        stage_constructor = import_utils.import_attribute(stage_name)
-        stage = stage_constructor(runtime_context)
-        images = stage.run(images)
 
-        if not images :
-            logger.error('Reduction stopped', extra_tags={'filename': image_paths})
+class ImageWriter:
+    """
+    Write reduced frames, in background threads if PIPELINE_WRITE_DEPTH is set
+
+    Notes
+    -----
+    At most PIPELINE_WRITE_DEPTH frames wait to be written at once; write blocks until there is room.
+    The first error from a background write is raised by the next call to write or when the writer is closed.
+    """
+    def __init__(self, runtime_context: Context):
+        self.runtime_context = runtime_context
+        self.write_depth = getattr(runtime_context, 'PIPELINE_WRITE_DEPTH', 0)
+        if self.write_depth > 0:
+            n_workers = max(1, getattr(runtime_context, 'PIPELINE_WRITE_WORKERS', 1))
+            self.executor = ThreadPoolExecutor(max_workers=n_workers)
+        else:
+            self.executor = None
+        self.pending = deque()
+
+    def write(self, image):
+        if self.executor is None:
+            image.write(self.runtime_context)
+            return
+        while len(self.pending) >= self.write_depth:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(image.write, self.runtime_context))
+
+    def close(self):
+        if self.executor is None:
             return
+        try:
+            while self.pending:
+                self.pending.popleft().result()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Let the writes that are in flight finish, but report the original error
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+
+
+def get_stages(stage_names: list, runtime_context: Context) -> list:
+    return [import_utils.import_attribute(stage_name)(runtime_context) for stage_name in stage_names]
+
+
+def run_stages(stages: list, images: list, image_writer: ImageWriter):
+    filenames = [image.filename for image in images]
+    for stage in stages:
+        images = stage.run(images)
+        if not images:
+            logger.error('Reduction stopped', extra_tags={'filename': filenames})
+            return
     for image in images:
-        image.write(runtime_context)
+        metrics.save_frame_summary(image, image_writer.runtime_context)
+        image_writer.write(image)
+
+
+def run_pipeline_stages(image_paths: list, runtime_context: Context, calibration_maker: bool = False):
+    """
+    Reduce a set of frames
+
+    Parameters
+    ----------
+    image_paths : list
+                  File info for each frame to reduce
+    runtime_context : banzai.context.Context
+                      Context object with runtime environment info
+    calibration_maker : bool
+                        Stack the frames into a master calibration
+
+    Notes
+    -----
+    Frames stream through the pipeline: the next frames are read while the current one goes through its stages,
+    and reduced frames are written in the background. Only PIPELINE_PREFETCH_DEPTH + PIPELINE_WRITE_DEPTH + 1 frames
+    are held in memory at once. Stages that combine frames (e.g. the calibration stackers) are barriers: every frame
+    that goes through them is collected first and they are run once all of the frames have been read.
+    """
+    frame_factory = import_utils.import_attribute(runtime_context.FRAME_FACTORY)()
+    # Frames of each type go through their own stages
+    stages_for_type = {}
+    # Frames waiting for a stage that needs all of them at once
+    grouped_images = {}
+    with ImageWriter(runtime_context) as image_writer:
+        for image in _open_images(frame_factory, image_paths, runtime_context):
+            if image is None:
+                continue
+            image_type = image.obstype.upper()
+            if image_type not in stages_for_type:
+                if calibration_maker:
+                    stage_names = runtime_context.CALIBRATION_STACKER_STAGES[image_type]
+                else:
+                    stage_names = get_stages_for_individual_frame(runtime_context.ORDERED_STAGES,
+                                                                  last_stage=runtime_context.LAST_STAGE[image_type],
+                                                                  extra_stages=runtime_context.EXTRA_STAGES[image_type])
+                stages_for_type[image_type] = get_stages(stage_names, runtime_context)
+            stages = stages_for_type[image_type]
+            if calibration_maker or any(stage.group_by_attributes for stage in stages):
+                grouped_images.setdefault(image_type, []).append(image)
+            else:
+                run_stages(stages, [image], image_writer)
+        for image_type, images in grouped_images.items():
+            run_stages(stages_for_type[image_type], images, image_writer)
@@ -35,11 +35,10 @@ def median(d, axis=None, mask=None):
     """
     if axis is None:
         if mask is not None:
-            median_mask = mask.ravel()
+            median_mask = np.ascontiguousarray(mask.ravel(), dtype=np.uint8)
         else:
-            median_mask = np.zeros(d.size, dtype=np.uint8)
-        output_median = median_utils.median1d(np.ascontiguousarray(d.ravel(), dtype=np.float32),
-                                              np.ascontiguousarray(median_mask, dtype=np.uint8))
+            median_mask = None
+        output_median = median_utils.median1d(np.ascontiguousarray(d.ravel(), dtype=np.float32), median_mask)
     else:
 
         nx = d.shape[axis]
@@ -48,12 +47,12 @@ def median(d, axis=None, mask=None):
         output_shape = np.delete(d.shape, axis)
 
         if mask is not None:
-            median_mask = np.rollaxis(mask, axis, len(d.shape)).reshape(ny, nx).astype(np.uint8)
+            median_mask = np.ascontiguousarray(np.rollaxis(mask, axis, len(d.shape)).reshape(ny, nx), dtype=np.uint8)
         else:
-            median_mask = np.zeros((ny, nx), dtype=np.uint8)
+            median_mask = None
 
         med = median_utils.median2d(np.ascontiguousarray(np.rollaxis(d, axis, len(d.shape)).reshape(ny, nx), dtype=np.float32),
-                                    mask=np.ascontiguousarray(median_mask, dtype=np.uint8))
+                                    mask=median_mask)
         median_array = np.array(med)
         output_median = median_array.reshape(output_shape)
 
@@ -0,0 +1,394 @@
+"""
+upload_utils.py: Durable spool of frames waiting to be posted to the archive.
+
+    Reduction workers add each output frame to a spool directory (a hard link when the frame is already on the same
+    file system, a copy otherwise) and move on as soon as the frame is safely on disk. A separate uploader
+    (banzai_run_uploader) posts the spooled frames to the ingester from a bounded pool of threads and retries failures
+    with jittered exponential backoff. Frames that the ingester rejects, or that still fail after UPLOAD_MAX_TRIES
+    attempts, are moved to a dead-letter directory to be looked at by hand.
+
+    Each entry in the spool is a data file and a JSON manifest with the same name. The manifest is written last, so an
+    entry only exists once its data are on disk, and it keeps track of the attempts so far so that a restarted uploader
+    picks up where the last one left off. Once a frame is in the archive, its frame id is saved in the manifest before
+    the database is updated, so a failed database update is retried without uploading the frame again.
+"""
+import fcntl
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Optional
+
+from ocs_ingester import ingester
+from ocs_ingester.exceptions import DoNotRetryError, NonFatalDoNotRetryError
+
+from banzai import dbs, logs
+from banzai.utils import file_utils
+
+logger = logging.getLogger('banzai')
+
+PENDING_DIRECTORY = 'pending'
+DEAD_LETTER_DIRECTORY = 'dead-letter'
+MANIFEST_SUFFIX = '.json'
+LOCK_FILENAME = '.lock'
+TEMPORARY_PREFIX = '.'
+
+UPLOADED = 'uploaded'
+RETRY = 'retry'
+DEAD_LETTER = 'dead-letter'
+
+
+def _fsync_directory(directory):
+    directory_descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_descriptor)
+    finally:
+        os.close(directory_descriptor)
+
+
+def _write_manifest(path, manifest):
+    # Write to a temporary file and rename it into place so the manifest is never seen half written
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TEMPORARY_PREFIX)
+    try:
+        with os.fdopen(file_descriptor, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    _fsync_directory(os.path.dirname(path))
+
+
+class UploadSpool:
+    """
+    Directory of frames waiting to be posted to the archive
+
+    Parameters
+    ----------
+    directory : str
+                Directory to keep the spool in. It is created if it does not exist. Hard links are used to add
+                frames, so it is best to put it on the same file system as the processed data.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.pending_directory = os.path.join(directory, PENDING_DIRECTORY)
+        self.dead_letter_directory = os.path.join(directory, DEAD_LETTER_DIRECTORY)
+        os.makedirs(self.pending_directory, exist_ok=True)
+        os.makedirs(self.dead_letter_directory, exist_ok=True)
+
+    def data_path(self, entry_id, directory=None):
+        return os.path.join(directory or self.pending_directory, entry_id)
+
+    def manifest_path(self, entry_id, directory=None):
+        return self.data_path(entry_id, directory=directory) + MANIFEST_SUFFIX
+
+    def add(self, path, output_filename, calibration=False) -> str:
+        """
+        Add a frame to the spool
+
+        Parameters
+        ----------
+        path : str
+               Path to the frame to upload
+        output_filename : str
+                          Path to give the ingester for the frame
+        calibration : bool
+                      Whether the frame is a calibration with a record in the calimages table to save the
+                      frame id to
+
+        Returns
+        -------
+        entry_id : str
+                   Name of the entry in the spool
+
+        Notes
+        -----
+        The data and the manifest are synced to disk before this returns, so the frame survives a crash.
+        """
+        # Entries sort by when they were added
+        entry_id = f'{time.time_ns()}-{uuid.uuid4().hex[:8]}-{os.path.basename(output_filename)}'
+        temporary_path = self.data_path(TEMPORARY_PREFIX + entry_id)
+        try:
+            try:
+                os.link(path, temporary_path)
+            except OSError:
+                # Different file system (or no hard links), so fall back to a copy
+                shutil.copyfile(path, temporary_path)
+            with open(temporary_path, 'rb') as data_file:
+                os.fsync(data_file.fileno())
+            os.replace(temporary_path, self.data_path(entry_id))
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        _write_manifest(self.manifest_path(entry_id), {'output_filename': output_filename,
+                                                        'calibration': calibration,
+                                                        'tries': 0,
+                                                        'next_attempt': 0.0,
+                                                        'frameid': None,
+                                                        'error': None})
+        logger.info('Added frame to the upload spool', extra_tags={'filename': os.path.basename(output_filename)})
+        return entry_id
+
+    def entries(self) -> list:
+        """The entries waiting to be uploaded"""
+        return sorted(filename[:-len(MANIFEST_SUFFIX)] for filename in os.listdir(self.pending_directory)
+                      if filename.endswith(MANIFEST_SUFFIX) and not filename.startswith(TEMPORARY_PREFIX))
+
+    def dead_letters(self) -> list:
+        """The entries that could not be uploaded"""
+        return sorted(filename[:-len(MANIFEST_SUFFIX)] for filename in os.listdir(self.dead_letter_directory)
+                      if filename.endswith(MANIFEST_SUFFIX) and not filename.startswith(TEMPORARY_PREFIX))
+
+    def read_manifest(self, entry_id, directory=None) -> dict:
+        with open(self.manifest_path(entry_id, directory=directory)) as manifest_file:
+            return json.load(manifest_file)
+
+    def save_manifest(self, entry_id, manifest):
+        _write_manifest(self.manifest_path(entry_id), manifest)
+
+    def due_entries(self, now=None) -> list:
+        """The entries whose next attempt is due, oldest first"""
+        if now is None:
+            now = time.time()
+        due = []
+        for entry_id in self.entries():
+            try:
+                manifest = self.read_manifest(entry_id)
+            except FileNotFoundError:
+                # Finished by another uploader in the meantime
+                continue
+            if manifest['next_attempt'] <= now:
+                due.append(entry_id)
+        return due
+
+    def lock(self):
+        """
+        Claim the spool so that only one uploader works on it at a time
+
+        Returns
+        -------
+        lock_file : file
+                    Open file holding the lock, which is released when it is closed. None if another uploader
+                    has the spool.
+        """
+        lock_file = open(os.path.join(self.directory, LOCK_FILENAME), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def remove(self, entry_id):
+        for path in [self.data_path(entry_id), self.manifest_path(entry_id)]:
+            if os.path.exists(path):
+                os.remove(path)
+        _fsync_directory(self.pending_directory)
+
+    def move_to_dead_letters(self, entry_id):
+        # The manifest goes last so the entry is never in both places
+        for path_function in [self.data_path, self.manifest_path]:
+            if os.path.exists(path_function(entry_id)):
+                os.replace(path_function(entry_id), path_function(entry_id, directory=self.dead_letter_directory))
+        _fsync_directory(self.dead_letter_directory)
+        _fsync_directory(self.pending_directory)
+
+    def requeue_dead_letters(self) -> int:
+        """
+        Move the dead letters back into the spool to be tried again
+
+        Returns
+        -------
+        n_requeued : int
+                     Number of entries that were put back in the spool
+        """
+        entry_ids = self.dead_letters()
+        for entry_id in entry_ids:
+            manifest = self.read_manifest(entry_id, directory=self.dead_letter_directory)
+            manifest.update({'tries': 0, 'next_attempt': 0.0, 'error': None})
+            _write_manifest(self.manifest_path(entry_id, directory=self.dead_letter_directory), manifest)
+            for path_function in [self.data_path, self.manifest_path]:
+                if os.path.exists(path_function(entry_id, directory=self.dead_letter_directory)):
+                    os.replace(path_function(entry_id, directory=self.dead_letter_directory), path_function(entry_id))
+        _fsync_directory(self.pending_directory)
+        return len(entry_ids)
+
+
+def get_upload_spool(runtime_context) -> Optional[UploadSpool]:
+    """
+    Get the upload spool configured in the runtime context, or None if frames are posted to the archive directly
+    """
+    directory = getattr(runtime_context, 'UPLOAD_SPOOL_DIRECTORY', None)
+    if not directory:
+        return None
+    return UploadSpool(directory)
+
+
+def _retry_later(spool, entry_id, manifest, error, runtime_context):
+    manifest['tries'] += 1
+    manifest['error'] = error
+    filename = os.path.basename(manifest['output_filename'])
+    max_tries = getattr(runtime_context, 'UPLOAD_MAX_TRIES', 5)
+    if manifest['tries'] >= max_tries:
+        spool.save_manifest(entry_id, manifest)
+        spool.move_to_dead_letters(entry_id)
+        logger.error('Giving up on posting frame to the archive', extra_tags={'filename': filename,
+                                                                               'tries': manifest['tries'],
+                                                                               'error': error})
+        return DEAD_LETTER
+    delay = file_utils.backoff_delay(manifest['tries'], base=getattr(runtime_context, 'UPLOAD_BACKOFF_BASE', 5.0),
+                                     maximum=getattr(runtime_context, 'UPLOAD_BACKOFF_MAX', 600.0))
+    manifest['next_attempt'] = time.time() + delay
+    spool.save_manifest(entry_id, manifest)
+    logger.warning('Could not post frame to the archive. Will retry.', extra_tags={'filename': filename,
+                                                                                  'tries': manifest['tries'],
+                                                                                  'retry_delay': delay,
+                                                                                  'error': error})
+    return RETRY
+
+
+def upload_entry(spool, entry_id, runtime_context) -> str:
+    """
+    Post a spooled frame to the archive and save its frame id
+
+    Returns
+    -------
+    status : str
+             UPLOADED if the entry is finished, RETRY if it will be tried again later, or DEAD_LETTER if it was moved
+             to the dead-letter directory
+
+    Notes
+    -----
+    The caller must hold the lock on the spool.
+    """
+    manifest = spool.read_manifest(entry_id)
+    filename = os.path.basename(manifest['output_filename'])
+    if manifest['frameid'] is None:
+        try:
+            with open(spool.data_path(entry_id), 'rb') as data_file:
+                ingester_response = ingester.upload_file_and_ingest_to_archive(data_file,
+                                                                               path=manifest['output_filename'])
+        except DoNotRetryError as exc:
+            manifest['error'] = str(exc)
+            spool.save_manifest(entry_id, manifest)
+            spool.move_to_dead_letters(entry_id)
+            logger.error('The archive rejected the frame', extra_tags={'filename': filename, 'error': str(exc)})
+            return DEAD_LETTER
+        except NonFatalDoNotRetryError as exc:
+            logger.debug('Non-fatal Exception occured: {0}. Aborting.'.format(exc),
+                         extra_tags={'filename': filename})
+            spool.remove(entry_id)
+            return UPLOADED
+        except Exception as exc:
+            return _retry_later(spool, entry_id, manifest, str(exc), runtime_context)
+        logger.debug(f"Ingester response: {ingester_response}", extra_tags={'filename': filename})
+        manifest['frameid'] = ingester_response.get('frameid')
+        spool.save_manifest(entry_id, manifest)
+        # The frame is in the archive, so we only need the manifest to finish the database update
+        os.remove(spool.data_path(entry_id))
+    if manifest['calibration'] and manifest['frameid'] is not None:
+        try:
+            n_updated = dbs.save_frame_id(filename, manifest['frameid'], runtime_context.db_address)
+        except Exception:
+            return _retry_later(spool, entry_id, manifest, logs.format_exception(), runtime_context)
+        if n_updated == 0:
+            # The reduction worker saves the calibration record just after spooling the frame
+            return _retry_later(spool, entry_id, manifest, 'The calibration record has not been saved yet',
+                                runtime_context)
+    spool.remove(entry_id)
+    logger.info('Posted frame to the archive', extra_tags={'filename': filename, 'frameid': manifest['frameid']})
+    return UPLOADED
+
+
+class Uploader:
+    """
+    Post the frames in a spool to the archive from a bounded pool of threads
+
+    Parameters
+    ----------
+    spool : UploadSpool
+            Spool to upload the frames from
+    runtime_context : banzai.context.Context
+                      Context object with runtime environment info
+    n_workers : int
+                Maximum number of frames to upload at once
+    """
+    def __init__(self, spool, runtime_context, n_workers=1):
+        self.spool = spool
+        self.runtime_context = runtime_context
+        self.n_workers = max(1, n_workers)
+        self.in_flight = {}
+        # Entries that failed in a way the manifest does not record (e.g. the spool could not be read), and when
+        # to try them again
+        self.not_before = {}
+
+    def _upload(self, entry_id):
+        try:
+            return upload_entry(self.spool, entry_id, self.runtime_context)
+        except Exception:
+            logger.error(logs.format_exception(), extra_tags={'entry': entry_id})
+            self.not_before[entry_id] = time.time() + getattr(self.runtime_context, 'UPLOAD_BACKOFF_BASE', 5.0)
+            return RETRY
+
+    def _lock_spool(self):
+        lock_file = self.spool.lock()
+        if lock_file is None:
+            logger.error('Another uploader is already running on this spool',
+                         extra_tags={'spool': self.spool.directory})
+        return lock_file
+
+    def _due_entries(self):
+        now = time.time()
+        return [entry_id for entry_id in self.spool.due_entries(now=now)
+                if self.not_before.get(entry_id, 0.0) <= now and entry_id not in self.in_flight.values()]
+
+    def run_once(self) -> dict:
+        """
+        Try each of the frames that are due once
+
+        Returns
+        -------
+        counts : dict
+                 Number of entries with each status (UPLOADED, RETRY, and DEAD_LETTER)
+        """
+        counts = {UPLOADED: 0, RETRY: 0, DEAD_LETTER: 0}
+        lock_file = self._lock_spool()
+        if lock_file is None:
+            return counts
+        with lock_file, ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            for status in executor.map(self._upload, self._due_entries()):
+                counts[status] += 1
+        logger.info('Finished uploading frames', extra_tags=counts)
+        return counts
+
+    def run(self, poll_interval=1.0):
+        """
+        Upload frames as they are added to the spool, until interrupted
+
+        Parameters
+        ----------
+        poll_interval : float
+                      Seconds between looks for frames that are due
+        """
+        lock_file = self._lock_spool()
+        if lock_file is None:
+            return
+        logger.info('Starting uploader', extra_tags={'spool': self.spool.directory, 'n_workers': self.n_workers})
+        with lock_file, ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            while True:
+                for entry_id in self._due_entries()[:self.n_workers - len(self.in_flight)]:
+                    self.in_flight[executor.submit(self._upload, entry_id)] = entry_id
+                if not self.in_flight:
+                    time.sleep(poll_interval)
+                    continue
+                finished, _ = wait(list(self.in_flight), timeout=poll_interval, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    self.in_flight.pop(future)
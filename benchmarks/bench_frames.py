@@ -0,0 +1,85 @@
+"""
+Reading and writing frames
+"""
+import os
+from io import BytesIO
+
+from benchmarks import synthetic
+from banzai import settings
+from banzai.utils import fits_utils, stage_utils
+
+
+def setup_cache():
+    return synthetic.setup_observatory(os.getcwd())
+
+
+class TimeOpen:
+    params = (list(synthetic.CAMERAS), ['EXPOSE', 'BIAS', 'DARK', 'SKYFLAT'])
+    param_names = ['camera', 'obstype']
+    timeout = 300
+
+    def setup(self, observatory, camera, obstype):
+        self.runtime_context = synthetic.load_context(observatory)
+        self.path = observatory['raw'][camera][obstype]
+
+    def time_open(self, observatory, camera, obstype):
+        synthetic.open_frame(self.path, self.runtime_context)
+
+    def peakmem_open(self, observatory, camera, obstype):
+        synthetic.open_frame(self.path, self.runtime_context)
+
+
+class TimeOpenMaster:
+    params = (list(synthetic.CAMERAS), synthetic.CALIBRATION_TYPES)
+    param_names = ['camera', 'calibration_type']
+    timeout = 300
+
+    def setup(self, observatory, camera, calibration_type):
+        self.runtime_context = synthetic.load_context(observatory)
+        self.path = observatory['masters'][camera][calibration_type]
+
+    def time_open_master(self, observatory, camera, calibration_type):
+        synthetic.open_frame(self.path, self.runtime_context)
+
+
+class TimeWrite:
+    params = (list(synthetic.CAMERAS), [False, True])
+    param_names = ['camera', 'fpack']
+    timeout = 600
+    # Writing saves processing metadata in the header, so only write each reduced frame once
+    number = 1
+    repeat = 5
+
+    def setup(self, observatory, camera, fpack):
+        self.runtime_context = synthetic.load_context(observatory, fpack=fpack)
+        self.image = synthetic.open_frame(observatory['raw'][camera]['EXPOSE'], self.runtime_context)
+        stage_names = [stage_name for stage_name in settings.ORDERED_STAGES
+                       if stage_name not in synthetic.NETWORK_STAGES]
+        self.image = synthetic.run_stages(self.image, stage_utils.get_stages(stage_names, self.runtime_context))
+
+    def time_write(self, observatory, camera, fpack):
+        self.image.write(self.runtime_context)
+
+    def track_output_size(self, observatory, camera, fpack):
+        self.image.write(self.runtime_context)
+        return os.path.getsize(self.image.get_output_filename(self.runtime_context))
+
+    track_output_size.unit = 'bytes'
+
+
+class TimePack:
+    params = (list(synthetic.CAMERAS), [1, 3])
+    param_names = ['camera', 'n_workers']
+    timeout = 600
+
+    def setup(self, observatory, camera, n_workers):
+        runtime_context = synthetic.load_context(observatory)
+        image = synthetic.open_frame(observatory['raw'][camera]['EXPOSE'], runtime_context)
+        stage_names = [stage_name for stage_name in settings.ORDERED_STAGES
+                       if stage_name not in synthetic.NETWORK_STAGES]
+        image = synthetic.run_stages(image, stage_utils.get_stages(stage_names, runtime_context))
+        self.hdu_list = image.to_fits(runtime_context)
+
+    def time_write_fits(self, observatory, camera, n_workers):
+        with BytesIO() as buffer:
+            fits_utils.write_fits(self.hdu_list, buffer, n_workers=n_workers)
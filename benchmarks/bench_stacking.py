@@ -0,0 +1,27 @@
+"""
+Stacking frames into master calibrations
+"""
+import numpy as np
+from astropy.io import fits
+
+from benchmarks import synthetic
+from banzai.data import CCDData, stack
+
+
+class TimeStack:
+    params = (list(synthetic.CAMERAS), [5, 9])
+    param_names = ['camera', 'n_images']
+    timeout = 600
+
+    def setup(self, camera, n_images):
+        rng = np.random.default_rng(0)
+        shape = synthetic._trimmed_shape(synthetic.CAMERAS[camera])
+        header = fits.Header({'GAIN': 1.0, 'RDNOISE': synthetic.CAMERAS[camera]['read_noise']})
+        self.data_to_stack = [CCDData(data=rng.standard_normal(shape, dtype=np.float32), meta=header.copy())
+                              for _ in range(n_images)]
+
+    def time_stack(self, camera, n_images):
+        stack(self.data_to_stack, 3.0)
+
+    def peakmem_stack(self, camera, n_images):
+        stack(self.data_to_stack, 3.0)
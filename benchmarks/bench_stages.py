@@ -0,0 +1,35 @@
+"""
+Each of the stages that science frames go through
+"""
+import os
+
+from benchmarks import synthetic
+from banzai import settings
+from banzai.utils import stage_utils
+
+
+def setup_cache():
+    return synthetic.setup_observatory(os.getcwd())
+
+
+class TimeStage:
+    params = (list(synthetic.CAMERAS), settings.ORDERED_STAGES)
+    param_names = ['camera', 'stage']
+    timeout = 600
+    # Stages change the frame in place, so every sample needs a fresh frame from setup
+    number = 1
+    repeat = 5
+    warmup_time = 0
+
+    def setup(self, observatory, camera, stage_name):
+        if stage_name in synthetic.NETWORK_STAGES:
+            raise NotImplementedError('{0} needs network services'.format(stage_name))
+        runtime_context = synthetic.load_context(observatory)
+        stage_index = settings.ORDERED_STAGES.index(stage_name)
+        stages = stage_utils.get_stages(settings.ORDERED_STAGES[:stage_index + 1], runtime_context)
+        self.image = synthetic.open_frame(observatory['raw'][camera]['EXPOSE'], runtime_context)
+        self.image = synthetic.run_stages(self.image, stages[:-1])
+        self.stage = stages[-1]
+
+    def time_stage(self, observatory, camera, stage_name):
+        self.stage.run([self.image])
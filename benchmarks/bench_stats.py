@@ -0,0 +1,42 @@
+"""
+Robust statistics on full frames and on stacks of frames
+"""
+import numpy as np
+
+from benchmarks import synthetic
+from banzai.utils import stats
+
+
+class TimeStats:
+    # Statistics of a whole frame and along the stacking axis of a stack of frames
+    params = ['frame', 'stack']
+    param_names = ['shape']
+    timeout = 300
+
+    def setup(self, shape):
+        rng = np.random.default_rng(0)
+        rows, columns = synthetic._trimmed_shape(synthetic.CAMERAS['sinistro'])
+        if shape == 'frame':
+            self.data = rng.standard_normal((rows, columns), dtype=np.float32)
+            self.axis = None
+        else:
+            # The stacking code works on tiles of the stack, so a tile of 9 frames is what matters
+            self.data = rng.standard_normal((9, rows // 8, columns), dtype=np.float32)
+            self.axis = 0
+        self.mask = np.zeros(self.data.shape, dtype=np.uint8)
+        self.mask.flat[rng.integers(0, self.data.size, self.data.size // 100)] = 1
+
+    def time_median(self, shape):
+        stats.median(self.data, axis=self.axis, mask=self.mask)
+
+    def time_absolute_deviation(self, shape):
+        stats.absolute_deviation(self.data, axis=self.axis, mask=self.mask)
+
+    def time_median_absolute_deviation(self, shape):
+        stats.median_absolute_deviation(self.data, axis=self.axis, mask=self.mask)
+
+    def time_robust_standard_deviation(self, shape):
+        stats.robust_standard_deviation(self.data, axis=self.axis, mask=self.mask)
+
+    def time_sigma_clipped_mean(self, shape):
+        stats.sigma_clipped_mean(self.data, 3.0, axis=self.axis, mask=self.mask)
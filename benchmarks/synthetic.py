@@ -0,0 +1,357 @@
+"""
+synthetic.py: Synthetic LCO frames and a calibration database for the benchmarks.
+
+    Raw frames are made with the same layout (extensions, sections, and header keywords) as the frames that come off
+    the telescopes, so they go through the same code paths in the pipeline. Master calibrations are written directly
+    rather than stacked, and are registered in a sqlite database along with the sites and instruments.
+
+    Set BANZAI_BENCHMARK_SCALE to shrink every frame by that factor in each direction (e.g. for a quick check that
+    the benchmarks run). Results are only comparable between runs with the same scale.
+"""
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from banzai import dbs, logs, settings
+from banzai.context import Context
+from banzai.utils import fits_utils, import_utils
+
+SCALE = int(os.getenv('BANZAI_BENCHMARK_SCALE', 1))
+
+# Layout of each camera before any binning. Amplifier shapes are (rows, columns) of the data section.
+# Overscan columns are added to the right of the data section.
+CAMERAS = {'sinistro': {'site': 'lsc', 'camera': 'fa15', 'telescope': '1m0-05', 'type': '1m0-SciCam-Sinistro',
+                        'n_amps': 4, 'amp_shape': (2048, 2048), 'overscan': 32, 'trim': 16, 'binning': 1,
+                        'gain': 1.0, 'read_noise': 7.5, 'configuration_mode': 'full_frame'},
+           'sbig': {'site': 'ogg', 'camera': 'kb27', 'telescope': '0m4-14', 'type': '0m4-SciCam-SBIG',
+                    'n_amps': 1, 'amp_shape': (2532, 3352), 'overscan': 0, 'trim': 4, 'binning': 1,
+                    'gain': 1.4, 'read_noise': 14.5, 'configuration_mode': 'default'},
+           'spectral': {'site': 'coj', 'camera': 'fs02', 'telescope': '2m0-01', 'type': '2m0-SciCam-Spectral',
+                        'n_amps': 1, 'amp_shape': (4096, 4096), 'overscan': 64, 'trim': 16, 'binning': 2,
+                        'gain': 7.7, 'read_noise': 7.7, 'configuration_mode': 'default'}}
+
+SITES = {'lsc': {'code': 'lsc', 'longitude': -70.8049, 'latitude': -30.1673, 'elevation': 2198.0, 'timezone': -4},
+         'ogg': {'code': 'ogg', 'longitude': -156.2589, 'latitude': 20.7075, 'elevation': 3055.0, 'timezone': -10},
+         'coj': {'code': 'coj', 'longitude': 149.0708, 'latitude': -31.2728, 'elevation': 1168.0, 'timezone': 10}}
+
+DAY_OBS = '20210301'
+CALIBRATION_DATE_OBS = '2021-03-01T19:00:00.000'
+SCIENCE_DATE_OBS = '2021-03-02T04:00:00.000'
+FILTER = 'rp'
+
+BIAS_LEVEL = 1000.0
+DARK_CURRENT = 0.01
+SKY_LEVEL = 400.0
+FLAT_LEVEL = 20000.0
+SATURATE = 65000.0
+N_STARS = 500
+
+CALIBRATION_TYPES = ['BPM', 'BIAS', 'DARK', 'SKYFLAT']
+
+# Stages that call out to the astrometry service, which we do not want to benchmark
+NETWORK_STAGES = ['banzai.astrometry.WCSSolver', 'banzai.qc.pointing.PointingTest']
+
+
+def _binned_amp_shape(camera):
+    # The scale and binning both shrink the data section, but the overscan is always read out at full width
+    rows, columns = camera['amp_shape']
+    binning = camera['binning'] * SCALE
+    return rows // binning, columns // binning
+
+
+def _trimmed_shape(camera):
+    rows, columns = _binned_amp_shape(camera)
+    trim = camera['trim'] // SCALE
+    if camera['n_amps'] == 4:
+        rows, columns = 2 * rows, 2 * columns
+    return rows - 2 * trim, columns - 2 * trim
+
+
+def _frame_prefix(camera):
+    return '{site}{telescope}-{camera}'.format(site=camera['site'], telescope=camera['telescope'].replace('-', ''),
+                                               camera=camera['camera'])
+
+
+def _primary_header(camera, obstype, date_obs, exptime):
+    binning = '{0} {0}'.format(camera['binning'])
+    header = fits.Header({'OBSTYPE': obstype, 'SITEID': camera['site'], 'INSTRUME': camera['camera'],
+                          'TELESCOP': camera['telescope'], 'DATE-OBS': date_obs, 'DATE': date_obs,
+                          'DAY-OBS': DAY_OBS, 'BLKSDATE': date_obs, 'EXPTIME': exptime, 'FILTER': FILTER,
+                          'PROPID': 'calibrate',
+                          'REQNUM': 1, 'CONFMODE': camera['configuration_mode'], 'CCDSUM': binning,
+                          'RLEVEL': 0, 'RA': '10:00:00.000', 'DEC': '-30:00:00.00', 'CAT-RA': '10:00:00.000',
+                          'CAT-DEC': '-30:00:00.00', 'OFST-RA': '10:00:00.000', 'OFST-DEC': '-30:00:00.00',
+                          'TPT-RA': '10:00:00.000', 'TPT-DEC': '-30:00:00.00', 'CRVAL1': 150.0, 'CRVAL2': -30.0,
+                          'CRPIX1': 0.0, 'CRPIX2': 0.0, 'PIXSCALE': 0.389 * camera['binning'],
+                          'SATURATE': SATURATE, 'MAXLIN': SATURATE, 'RDNOISE': camera['read_noise']})
+    if camera['n_amps'] == 4:
+        rows, columns = _binned_amp_shape(camera)
+        trim = camera['trim'] // SCALE
+        header['TRIMSEC'] = '[{0}:{1},{2}:{3}]'.format(trim + 1, 2 * columns - trim, trim + 1, 2 * rows - trim)
+    return header
+
+
+def _amp_header(camera, amp_index):
+    rows, columns = _binned_amp_shape(camera)
+    overscan = camera['overscan']
+    binning = camera['binning']
+    header = fits.Header({'EXTNAME': 'SCI', 'EXTVER': amp_index + 1, 'CCDSUM': '{0} {0}'.format(binning),
+                          'GAIN': camera['gain'], 'RDNOISE': camera['read_noise'], 'SATURATE': SATURATE,
+                          'MAXLIN': SATURATE, 'DATASEC': '[1:{0},1:{1}]'.format(columns, rows)})
+    if overscan:
+        header['BIASSEC'] = '[{0}:{1},1:{2}]'.format(columns + 1, columns + overscan, rows)
+    else:
+        header['BIASSEC'] = 'N/A'
+    if camera['n_amps'] == 4:
+        # Amplifiers read out from each corner of the detector, so three of them are flipped
+        x_size, y_size = columns * binning, rows * binning
+        x_sections = ['1:{0}'.format(x_size), '{0}:{1}'.format(2 * x_size, x_size + 1)]
+        y_sections = ['1:{0}'.format(y_size), '{0}:{1}'.format(2 * y_size, y_size + 1)]
+        x_section, y_section = [(0, 0), (1, 0), (1, 1), (0, 1)][amp_index]
+        header['DETSEC'] = '[{0},{1}]'.format(x_sections[x_section], y_sections[y_section])
+    else:
+        header['DETSEC'] = '[1:{0},1:{1}]'.format(columns * binning, rows * binning)
+        trim = camera['trim'] // SCALE
+        header['TRIMSEC'] = '[{0}:{1},{2}:{3}]'.format(trim + 1, columns - trim, trim + 1, rows - trim)
+    return header
+
+
+def _add_stars(data, rng, n_stars=N_STARS, fwhm=4.0):
+    rows, columns = data.shape
+    sigma = fwhm / 2.355
+    half_width = int(4 * sigma) + 1
+    y, x = np.mgrid[-half_width:half_width + 1, -half_width:half_width + 1]
+    for _ in range(n_stars):
+        x_center = rng.integers(half_width, columns - half_width)
+        y_center = rng.integers(half_width, rows - half_width)
+        flux = 10.0 ** rng.uniform(3.0, 6.0)
+        star = flux / (2.0 * np.pi * sigma ** 2.0) * np.exp(-(x ** 2.0 + y ** 2.0) / (2.0 * sigma ** 2.0))
+        data[y_center - half_width:y_center + half_width + 1, x_center - half_width:x_center + half_width + 1] += star
+
+
+def _raw_amp_data(camera, obstype, exptime, rng):
+    rows, columns = _binned_amp_shape(camera)
+    signal = np.zeros((rows, columns), dtype=np.float32)
+    if obstype != 'BIAS':
+        signal += DARK_CURRENT * exptime
+    if obstype == 'SKYFLAT':
+        y, x = np.mgrid[0:rows, 0:columns]
+        signal += FLAT_LEVEL * (1.0 - 0.1 * ((x / columns - 0.5) ** 2.0 + (y / rows - 0.5) ** 2.0))
+    elif obstype == 'EXPOSE':
+        signal += SKY_LEVEL
+        _add_stars(signal, rng, n_stars=max(1, N_STARS // camera['n_amps'] // SCALE ** 2))
+    # Approximate the Poisson noise with a Gaussian to keep making the frames fast
+    noise = rng.standard_normal((rows, columns), dtype=np.float32)
+    noise *= np.sqrt(signal + camera['read_noise'] ** 2.0)
+    electrons = signal + noise
+    data = np.full((rows, columns + camera['overscan']), BIAS_LEVEL, dtype=np.float32)
+    data[:, :columns] += electrons / camera['gain']
+    data[:, columns:] += camera['read_noise'] / camera['gain'] * rng.standard_normal((rows, camera['overscan']),
+                                                                                  dtype=np.float32)
+    return np.clip(np.round(data), 0, 65535).astype(np.uint16)
+
+
+def make_raw_frame(directory, camera_name, obstype, frame_number, exptime=60.0, date_obs=SCIENCE_DATE_OBS,
+                   seed=None) -> str:
+    """
+    Write an fpacked raw frame
+
+    Parameters
+    ----------
+    directory : str
+                Directory to write the frame to
+    camera_name : str
+                  One of the keys of CAMERAS
+    obstype : str
+              BIAS, DARK, SKYFLAT, or EXPOSE
+    frame_number : int
+                   Frame number in the filename
+    exptime : float
+              Exposure time in seconds (ignored for biases)
+    date_obs : str
+               Start of the exposure
+    seed : int
+           Seed for the random number generator. Defaults to the frame number.
+
+    Returns
+    -------
+    path : str
+           Path to the new frame
+    """
+    camera = CAMERAS[camera_name]
+    if obstype == 'BIAS':
+        exptime = 0.0
+    rng = np.random.default_rng(frame_number if seed is None else seed)
+    filename = '{prefix}-{day_obs}-{frame_number:04d}-{type}00.fits.fz'.format(prefix=_frame_prefix(camera),
+                                                                             day_obs=DAY_OBS,
+                                                                             frame_number=frame_number,
+                                                                             type=obstype[0].lower())
+    header = _primary_header(camera, obstype, date_obs, exptime)
+    if camera['n_amps'] == 1:
+        # Single amplifier cameras write everything to one extension
+        header.update(_amp_header(camera, 0))
+        hdu_list = [fits.PrimaryHDU(data=_raw_amp_data(camera, obstype, exptime, rng), header=header)]
+    else:
+        hdu_list = [fits.PrimaryHDU(header=header)]
+        for amp_index in range(camera['n_amps']):
+            hdu_list.append(fits.ImageHDU(data=_raw_amp_data(camera, obstype, exptime, rng),
+                                          header=_amp_header(camera, amp_index)))
+    path = os.path.join(directory, filename)
+    fits_utils.pack(fits.HDUList(hdu_list)).writeto(path, overwrite=True)
+    return path
+
+
+def _master_data(camera, calibration_type, rng):
+    rows, columns = _trimmed_shape(camera)
+    if calibration_type == 'BIAS':
+        return rng.standard_normal((rows, columns), dtype=np.float32)
+    elif calibration_type == 'DARK':
+        return DARK_CURRENT + 0.001 * rng.standard_normal((rows, columns), dtype=np.float32)
+    y, x = np.mgrid[0:rows, 0:columns]
+    data = 1.0 - 0.1 * ((x / columns - 0.5) ** 2.0 + (y / rows - 0.5) ** 2.0)
+    return (data / np.mean(data)).astype(np.float32)
+
+
+def make_master_frame(directory, camera_name, calibration_type, seed=0) -> str:
+    """
+    Write an fpacked master calibration frame
+
+    Notes
+    -----
+    Bad pixel masks have one extension per amplifier, matching the raw frames. Other masters are trimmed and
+    mosaiced like the reduced frames the pipeline would stack them from.
+
+    Returns
+    -------
+    path : str
+           Path to the new master
+    """
+    camera = CAMERAS[camera_name]
+    rng = np.random.default_rng(seed)
+    exptime = 0.0 if calibration_type == 'BIAS' else 60.0
+    header = _primary_header(camera, calibration_type, CALIBRATION_DATE_OBS, exptime)
+    header['ISMASTER'] = True
+    header['RLEVEL'] = 91
+    filename = '{prefix}-{day_obs}-{type}-bin{binning}x{binning}.fits'.format(prefix=_frame_prefix(camera),
+                                                                            day_obs=DAY_OBS,
+                                                                            type=calibration_type.lower(),
+                                                                            binning=camera['binning'])
+    if calibration_type == 'BPM':
+        rows, columns = _binned_amp_shape(camera)
+        hdu_list = [fits.PrimaryHDU(header=header)]
+        for amp_index in range(camera['n_amps']):
+            bpm = np.zeros((rows, columns + camera['overscan']), dtype=np.uint8)
+            bad_pixels = rng.integers(0, bpm.size, bpm.size // 1000)
+            bpm.flat[bad_pixels] = 1
+            amp_header = _amp_header(camera, amp_index)
+            amp_header['EXTNAME'] = 'BPM'
+            hdu_list.append(fits.ImageHDU(data=bpm, header=amp_header))
+    else:
+        data = _master_data(camera, calibration_type, rng)
+        rows, columns = data.shape
+        header.update({'EXTNAME': 'SCI', 'GAIN': camera['gain'],
+                       'DATASEC': '[1:{0},1:{1}]'.format(columns, rows),
+                       'DETSEC': '[1:{0},1:{1}]'.format(columns * camera['binning'], rows * camera['binning'])})
+        if calibration_type == 'BIAS':
+            header['BIASLVL'] = BIAS_LEVEL * camera['gain']
+        header.remove('TRIMSEC', ignore_missing=True)
+        hdu_list = [fits.PrimaryHDU(data=data, header=header),
+                    fits.ImageHDU(data=np.zeros(data.shape, dtype=np.uint8), header=fits.Header({'EXTNAME': 'BPM'})),
+                    fits.ImageHDU(data=0.01 * np.ones(data.shape, dtype=np.float32),
+                                  header=fits.Header({'EXTNAME': 'ERR'}))]
+    path = os.path.join(directory, filename + '.fz')
+    fits_utils.pack(fits.HDUList(hdu_list)).writeto(path, overwrite=True)
+    return path
+
+
+def make_context(directory, **overrides) -> Context:
+    """
+    Make a runtime context with the default settings, a sqlite database, and output paths in the given directory
+    """
+    # Importing main pulls in the celery app, so only do it when we actually need a context
+    from banzai.main import parse_args
+    context_values = vars(parse_args(settings, parse_system_args=False))
+    context_values.update({'db_address': 'sqlite:///' + os.path.join(directory, 'benchmark.db'),
+                           'processed_path': os.path.join(directory, 'processed'),
+                           'post_to_archive': False, 'post_to_elasticsearch': False,
+                           'no_file_cache': False, 'fpack': True})
+    context_values.update(overrides)
+    logs.set_log_level('WARNING')
+    return Context(context_values)
+
+
+def register_master(path, runtime_context):
+    """Add a master calibration to the database the same way banzai_add_bpm does"""
+    frame_factory = import_utils.import_attribute(runtime_context.FRAME_FACTORY)()
+    master = frame_factory.open({'path': path}, runtime_context)
+    master.is_bad = False
+    master.is_master = True
+    dbs.save_calibration_info(path, master, runtime_context.db_address)
+
+
+def setup_observatory(directory, cameras=None) -> dict:
+    """
+    Make a database, master calibrations, and one raw frame of each type for each camera
+
+    Parameters
+    ----------
+    directory : str
+                Directory for the database and the frames
+    cameras : list
+              Names of the cameras to make frames for. Defaults to all of CAMERAS.
+
+    Returns
+    -------
+    observatory : dict
+                  Runtime context values under 'context', and the paths to the raw frames and masters for each
+                  camera under 'raw' and 'masters' (keyed by camera name, then OBSTYPE)
+    """
+    if cameras is None:
+        cameras = list(CAMERAS)
+    directory = os.path.abspath(directory)
+    raw_directory = os.path.join(directory, 'raw')
+    master_directory = os.path.join(directory, 'masters')
+    os.makedirs(raw_directory, exist_ok=True)
+    os.makedirs(master_directory, exist_ok=True)
+    runtime_context = make_context(directory)
+    dbs.create_db(runtime_context.db_address)
+    observatory = {'context': vars(runtime_context), 'raw': {}, 'masters': {}}
+    for camera_name in cameras:
+        camera = CAMERAS[camera_name]
+        dbs.add_site(SITES[camera['site']], runtime_context.db_address)
+        dbs.add_instrument({'site': camera['site'], 'camera': camera['camera'], 'name': camera['camera'],
+                            'type': camera['type']}, runtime_context.db_address)
+        observatory['raw'][camera_name] = {obstype: make_raw_frame(raw_directory, camera_name, obstype, frame_number)
+                                           for frame_number, obstype in enumerate(['BIAS', 'DARK', 'SKYFLAT',
+                                                                                   'EXPOSE'], start=1)}
+        observatory['masters'][camera_name] = {}
+        for calibration_type in CALIBRATION_TYPES:
+            path = make_master_frame(master_directory, camera_name, calibration_type)
+            register_master(path, runtime_context)
+            observatory['masters'][camera_name][calibration_type] = path
+    dbs.dispose_engines()
+    return observatory
+
+
+def load_context(observatory, **overrides) -> Context:
+    """Rebuild the runtime context saved by setup_observatory"""
+    context_values = dict(observatory['context'])
+    context_values.update(overrides)
+    logs.set_log_level('WARNING')
+    return Context(context_values)
+
+
+def open_frame(path, runtime_context):
+    frame_factory = import_utils.import_attribute(runtime_context.FRAME_FACTORY)()
+    return frame_factory.open({'path': path}, runtime_context)
+
+
+def run_stages(image, stages):
+    """Run a frame through a list of stages, raising an exception if any of them rejects it"""
+    for stage in stages:
+        images = stage.run([image])
+        if not images:
+            raise RuntimeError('{0} rejected {1}'.format(type(stage).__name__, image.filename))
+        image = images[0]
+    return image